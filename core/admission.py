@@ -0,0 +1,145 @@
+"""Admission control for HA site connections.
+
+After a restart every HA instance reconnects and authenticates at once,
+and each authentication costs several queries. Three limits flatten that:
+
+- a token bucket per source address, taken on connect;
+- a token bucket per site (email and site name), taken on authenticate
+  and user_registration;
+- a cap of OPP_AUTH_CONCURRENCY authentications in flight; others wait up
+  to OPP_AUTH_QUEUE_TIMEOUT seconds for a slot.
+
+A rejected client gets an error with ``retry_after`` seconds and the
+connection is closed with code 4029 and reason ``retry_after=<seconds>``.
+The delay is the time until the bucket refills (or a backlog estimate when
+busy) plus random jitter of up to the same again, so rejected clients
+spread their retries instead of coming back together.
+"""
+from contextlib import asynccontextmanager
+import asyncio
+import logging
+import random
+import time
+
+from django.conf import settings
+
+from .metrics import metrics
+
+_LOGGER = logging.getLogger(__name__)
+
+# Connections per second and burst allowed from one address (0 disables)
+SOURCE_RATE = getattr(settings, 'OPP_ADMISSION_SOURCE_RATE', 2)
+SOURCE_BURST = getattr(settings, 'OPP_ADMISSION_SOURCE_BURST', 20)
+# Authentications per second and burst allowed for one site (0 disables)
+SITE_RATE = getattr(settings, 'OPP_ADMISSION_SITE_RATE', 0.1)
+SITE_BURST = getattr(settings, 'OPP_ADMISSION_SITE_BURST', 3)
+# Authentications processed at once, and seconds one waits for a slot
+AUTH_CONCURRENCY = getattr(settings, 'OPP_AUTH_CONCURRENCY', 4)
+AUTH_QUEUE_TIMEOUT = getattr(settings, 'OPP_AUTH_QUEUE_TIMEOUT', 2)
+# Shortest retry_after suggested to a rejected client, in seconds
+RETRY_AFTER_MIN = 1
+
+THROTTLED_CLOSE_CODE = 4029
+
+
+class Throttled(Exception):
+    """Raised when a connection or authentication is not admitted."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Too many requests ({reason}), retry after {retry_after} seconds")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def with_jitter(delay):
+    """Return ``delay`` (at least RETRY_AFTER_MIN) plus up to as much again."""
+    delay = max(delay, RETRY_AFTER_MIN)
+    return round(delay + random.uniform(0, delay), 1)
+
+
+class TokenBuckets:
+    """One token bucket per key, refilled at ``rate`` tokens per second."""
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = {}  # key -> (tokens, monotonic time of last update)
+
+    def take(self, key):
+        """Take a token; returns 0, or the seconds until one is available."""
+        if not self.rate:
+            return 0
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self._buckets[key] = (tokens - 1, now)
+        if len(self._buckets) > self.max_keys:
+            self._prune(now)
+        return 0
+
+    def _prune(self, now):
+        """Forget buckets that have refilled; they behave like new ones."""
+        for key, (tokens, updated) in list(self._buckets.items()):
+            if tokens + (now - updated) * self.rate >= self.burst:
+                del self._buckets[key]
+        # Everything still limited is kept; grow rather than prune on every call
+        self.max_keys = max(self.max_keys, 2 * len(self._buckets))
+
+
+class AdmissionController:
+    """Rate and concurrency limits of the connect and authenticate path."""
+
+    def __init__(self, concurrency=AUTH_CONCURRENCY, queue_timeout=AUTH_QUEUE_TIMEOUT):
+        self.sources = TokenBuckets(SOURCE_RATE, SOURCE_BURST)
+        self.sites = TokenBuckets(SITE_RATE, SITE_BURST)
+        self.concurrency = concurrency
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self._slots = None
+        self._in_flight_gauge = metrics.gauge('auth_in_flight')
+        self._wait = metrics.histogram('auth_wait_seconds')
+
+    def admit_connection(self, source):
+        """Take a connection token of ``source``; raises Throttled if there is none."""
+        delay = self.sources.take(source)
+        if delay:
+            self._reject('source', delay)
+
+    @asynccontextmanager
+    async def authentication(self, site_key):
+        """Hold an authentication slot; raises Throttled if none is free in time."""
+        delay = self.sites.take(site_key)
+        if delay:
+            self._reject('site', delay)
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        start = time.monotonic()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            # Roughly how long the clients already queued will take
+            self._reject('busy', self.queue_timeout * self.waiting / self.concurrency)
+        finally:
+            self.waiting -= 1
+        self._wait.observe(time.monotonic() - start)
+        self.in_flight += 1
+        self._in_flight_gauge.set(self.in_flight)
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._in_flight_gauge.set(self.in_flight)
+            self._slots.release()
+
+    def _reject(self, reason, delay):
+        metrics.counter('admission_rejected', reason=reason).inc()
+        raise Throttled(reason, with_jitter(delay))
+
+
+admission = AdmissionController()
@@ -0,0 +1,19 @@
+"""Django's MySQL backend, with connections from a per-process pool.
+
+Use ``'ENGINE': 'core.backends.mysql'`` and a ``pool`` entry in OPTIONS; see
+``core.backends.pool``.
+"""
+from django.db.backends.mysql import base
+
+from core.backends.pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+
+    def check_connection(self, connection):
+        # A ping is a round trip without a query
+        try:
+            connection.ping()
+        except self.Database.Error:
+            return False
+        return True
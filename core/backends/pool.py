@@ -0,0 +1,237 @@
+"""Database connections pooled per process.
+
+Django's MySQL backend opens a connection per thread and, with the default
+CONN_MAX_AGE of 0, closes it after every request or consumer database call,
+so a burst pays connection setup on every call and can exhaust
+max_connections. A backend using ``PooledDatabaseWrapperMixin`` instead
+hands the connection back to a ``ConnectionPool`` shared by all threads of
+the worker process, and takes one from it the next time a thread needs one.
+
+The pool is enabled with a ``pool`` entry in the database OPTIONS, like
+Django's PostgreSQL pool::
+
+    'OPTIONS': {'pool': {'max_size': 10, 'timeout': 5, 'max_age': 600, 'check_idle': 30}}
+
+Up to ``max_size`` connections are open at once; a thread needing one when
+all are checked out waits up to ``timeout`` seconds and then gets
+``PoolTimeout``. Connections are replaced after ``max_age`` seconds, and
+pinged before reuse when they have been idle ``check_idle`` seconds or
+more. Checkouts, waits, timeouts and failed checks are counted in
+``core.metrics``.
+"""
+from collections import deque
+from functools import partial
+import logging
+import os
+import threading
+import time
+
+from django.db.utils import OperationalError
+
+from core.metrics import metrics
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class PoolTimeout(OperationalError):
+    """No pooled connection became free within the pool's timeout."""
+
+
+class ConnectionPool:
+    """Up to ``max_size`` open connections, shared by the threads of a process."""
+
+    def __init__(self, label, max_size=10, timeout=5, max_age=600, check_idle=30):
+        self.label = label
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_age = max_age
+        self.check_idle = check_idle
+        self._size = 0  # connections open or being opened
+        self._idle = deque()  # (connection, returned at), most recently returned last
+        self._opened = {}  # id(connection) -> opened at
+        self._condition = threading.Condition()
+        self._pid = os.getpid()
+        self._checkouts = metrics.counter('db_pool_checkouts', pool=label)
+        self._waits = metrics.counter('db_pool_waits', pool=label)
+        self._timeouts = metrics.counter('db_pool_timeouts', pool=label)
+        self._failed_checks = metrics.counter('db_pool_failed_checks', pool=label)
+        self._wait_seconds = metrics.histogram('db_pool_wait_seconds', pool=label)
+        self._size_gauge = metrics.gauge('db_pool_connections', pool=label)
+        self._in_use_gauge = metrics.gauge('db_pool_in_use', pool=label)
+
+    def checkout(self, connect, check):
+        """Return ``(connection, new)``, opening a connection with ``connect()`` if needed.
+
+        ``check(connection)`` returns whether an idle connection still works.
+        """
+        self._checkouts.inc()
+        while True:
+            with self._condition:
+                self._forget_after_fork()
+                if not self._idle and self._size >= self.max_size:
+                    self._wait()
+                if self._idle:
+                    connection, returned = self._idle.pop()
+                    opened = self._opened[id(connection)]
+                else:
+                    connection = None
+                    self._size += 1
+                self._update_gauges()
+            if connection is None:
+                return self._open(connect), True
+            now = time.monotonic()
+            if now - opened >= self.max_age:
+                self._discard(connection)
+            elif now - returned >= self.check_idle and not check(connection):
+                self._failed_checks.inc()
+                self._discard(connection)
+            else:
+                return connection, False
+
+    def checkin(self, connection, reusable=True):
+        """Give back a connection; close it instead unless ``reusable``."""
+        with self._condition:
+            opened = self._opened.get(id(connection))
+            if self._forget_after_fork() or opened is None:
+                # Opened by the parent process, whose session it still is
+                return
+            if reusable and time.monotonic() - opened < self.max_age:
+                self._idle.append((connection, time.monotonic()))
+                self._update_gauges()
+                self._condition.notify()
+                return
+        self._discard(connection)
+
+    def _wait(self):
+        """Wait, with the lock held, until a connection is idle or may be opened."""
+        start = time.monotonic()
+        self._waits.inc()
+        try:
+            while not self._idle and self._size >= self.max_size:
+                remaining = start + self.timeout - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts.inc()
+                    raise PoolTimeout(
+                        f"No connection of pool {self.label} free after {self.timeout} seconds, "
+                        f"{self.max_size} in use"
+                    )
+                self._condition.wait(remaining)
+        finally:
+            self._wait_seconds.observe(time.monotonic() - start)
+
+    def _open(self, connect):
+        try:
+            connection = connect()
+        except BaseException:
+            self._release()
+            raise
+        with self._condition:
+            self._opened[id(connection)] = time.monotonic()
+        return connection
+
+    def _discard(self, connection):
+        with self._condition:
+            del self._opened[id(connection)]
+        self._release()
+        try:
+            connection.close()
+        except Exception as error:
+            _LOGGER.debug(f"Error closing pooled connection of {self.label}: {error}")
+
+    def _release(self):
+        """Free the slot of a connection that is closed or failed to open."""
+        with self._condition:
+            self._size -= 1
+            self._update_gauges()
+            self._condition.notify()
+
+    def _forget_after_fork(self):
+        """Drop, without closing, connections inherited from a parent process."""
+        if self._pid == os.getpid():
+            return False
+        self._pid = os.getpid()
+        self._size = 0
+        self._idle.clear()
+        self._opened.clear()
+        self._update_gauges()
+        return True
+
+    def _update_gauges(self):
+        self._size_gauge.set(self._size)
+        self._in_use_gauge.set(self._size - len(self._idle))
+
+
+class PooledDatabaseWrapperMixin:
+    """Take the connections of a DatabaseWrapper from a ``ConnectionPool``.
+
+    Mixed in before the backend's own DatabaseWrapper. Without a ``pool``
+    entry in OPTIONS the backend behaves as its parent.
+    """
+
+    _connection_pools = {}
+    _connection_pools_lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pool = None
+        self._pooled_connection_new = False
+
+    def get_pool(self):
+        """The pool of this alias and database, or None if pooling is off."""
+        options = self.settings_dict['OPTIONS'].get('pool')
+        if not options:
+            return None
+        # Keyed by database too, so the test database gets its own pool
+        key = (self.alias, self.settings_dict['HOST'], self.settings_dict['PORT'], self.settings_dict['NAME'])
+        pool = self._connection_pools.get(key)
+        if pool is None:
+            with self._connection_pools_lock:
+                pool = self._connection_pools.get(key)
+                if pool is None:
+                    pool = ConnectionPool(self.alias, **({} if options is True else options))
+                    self._connection_pools[key] = pool
+        return pool
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        params.pop('pool', None)
+        return params
+
+    def get_new_connection(self, conn_params):
+        self._pool = self.get_pool()
+        if self._pool is None:
+            return super().get_new_connection(conn_params)
+        connection, self._pooled_connection_new = self._pool.checkout(
+            partial(super().get_new_connection, conn_params), self.check_connection
+        )
+        return connection
+
+    def init_connection_state(self):
+        # A reused connection keeps the session state set when it was opened
+        if self._pool is None or self._pooled_connection_new:
+            super().init_connection_state()
+
+    def check_connection(self, connection):
+        """Whether an idle pooled connection still works."""
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute('SELECT 1')
+            finally:
+                cursor.close()
+        except self.Database.Error:
+            return False
+        return True
+
+    def _close(self):
+        if self._pool is None or self.connection is None:
+            return super()._close()
+        # Only connections left as they came out of the pool go back in:
+        # no transaction open, the configured autocommit, no unhandled error
+        reusable = not (
+            self.in_atomic_block or self.errors_occurred
+            or self.autocommit != self.settings_dict['AUTOCOMMIT']
+        )
+        pool, self._pool = self._pool, None
+        with self.wrap_database_errors:
+            pool.checkin(self.connection, reusable)
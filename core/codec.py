@@ -0,0 +1,147 @@
+"""JSON encoding and decoding for every consumer and view.
+
+All websocket frames and JSON responses go through ``dumps``/``loads`` so
+the implementation can be swapped in one place. orjson or ujson is used
+when installed (pick one with ``OPP_JSON_BACKEND``), otherwise the standard
+library. Every backend uses compact separators, writes non-ASCII characters
+as UTF-8, ``Decimal`` as a number and dates as ISO 8601 strings, and decodes
+to the same values. The bytes are not always identical:
+
+- orjson writes floats in exponent notation differently (``1e-05`` is
+  ``0.00001``, ``1e+16`` is ``1e16``); ujson writes ``1e-5``.
+- orjson raises ``TypeError`` on integers wider than 64 bits.
+- NaN and infinity are written as ``null`` by orjson and as ``NaN`` /
+  ``Infinity`` (not valid JSON) by the others.
+
+None of these occur in prices or Home Assistant states, which are compared
+across backends in the tests; don't rely on the exact bytes elsewhere.
+
+Decode errors are always raised as ``json.JSONDecodeError`` (exported as
+``DecodeError``) so callers don't depend on the backend.
+"""
+from datetime import date, datetime, time
+from decimal import Decimal
+import json
+import logging
+import uuid
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.functional import Promise
+
+_LOGGER = logging.getLogger(__name__)
+
+# 'auto' picks the fastest installed backend
+JSON_BACKEND = getattr(settings, 'OPP_JSON_BACKEND', 'auto')
+BACKENDS = ('orjson', 'ujson', 'json')
+
+DecodeError = json.JSONDecodeError
+
+
+def default(value):
+    """Encode the non-JSON types that appear in our payloads."""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, (uuid.UUID, Promise)):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _stdlib_backend():
+    encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False, default=default)
+
+    def dumps(value):
+        return encoder.encode(value)
+
+    def dumpb(value):
+        return encoder.encode(value).encode()
+
+    return dumps, dumpb, json.loads
+
+
+def _orjson_backend():
+    import orjson
+
+    options = orjson.OPT_NON_STR_KEYS
+
+    def dumpb(value):
+        return orjson.dumps(value, default=default, option=options)
+
+    def dumps(value):
+        return dumpb(value).decode()
+
+    # orjson.JSONDecodeError subclasses json.JSONDecodeError
+    return dumps, dumpb, orjson.loads
+
+
+def _ujson_backend():
+    import ujson
+
+    def dumps(value):
+        return ujson.dumps(value, ensure_ascii=False, escape_forward_slashes=False, default=default)
+
+    def dumpb(value):
+        return dumps(value).encode()
+
+    def loads(data):
+        try:
+            return ujson.loads(data)
+        except ValueError as e:
+            if isinstance(data, bytes):
+                data = data.decode('utf-8', 'replace')
+            raise DecodeError(str(e), data, 0) from None
+
+    return dumps, dumpb, loads
+
+
+_FACTORIES = {
+    'orjson': _orjson_backend,
+    'ujson': _ujson_backend,
+    'json': _stdlib_backend,
+}
+
+
+def load_backend(name):
+    """Return (dumps, dumpb, loads) of a backend. ImportError if not installed."""
+    if name not in _FACTORIES:
+        raise ValueError(f"Unknown JSON backend {name!r}, expected one of {', '.join(BACKENDS)}")
+    return _FACTORIES[name]()
+
+
+def available_backends():
+    """Return the names of the installed backends, fastest first."""
+    names = []
+    for name in BACKENDS:
+        try:
+            load_backend(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def _select_backend(name):
+    if name != 'auto':
+        try:
+            return name, load_backend(name)
+        except ImportError:
+            _LOGGER.warning(f"JSON backend {name} is not installed, using the standard library")
+            return 'json', load_backend('json')
+    backend = available_backends()[0]
+    return backend, load_backend(backend)
+
+
+# dumps returns str, dumpb UTF-8 bytes; loads accepts either
+backend, (dumps, dumpb, loads) = _select_backend(JSON_BACKEND)
+
+
+class JsonResponse(HttpResponse):
+    """django.http.JsonResponse encoded with the configured backend."""
+
+    def __init__(self, data, safe=True, **kwargs):
+        if safe and not isinstance(data, dict):
+            raise TypeError("In order to allow non-dict objects to be serialized set the safe parameter to False.")
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(content=dumpb(data), **kwargs)
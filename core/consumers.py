@@ -1,63 +1,96 @@
-import json
 from datetime import datetime
-import asyncio
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from django.contrib.auth import get_user_model
 from django.apps import apps
+from . import codec, registration
+from .admission import THROTTLED_CLOSE_CODE, Throttled, admission
+from .db import run_sync
+from .dispatch import MessageDispatchMixin, handles
+from .hashing import hashing_pool
+from .idle import FRONTEND_IDLE_TIMEOUT, IdleTimeoutMixin
+from .layers import group_has_members
+from .presence import presence
+from .routers import replica_configured, replica_reads
+from .states import STATE_COALESCE_WINDOW, StateUpdateBuffer, site_states
+from .outbound import OutboundQueueMixin
+from .wire import JSON_WIRE, WireProtocolMixin
+from .relay import (
+    RelayRequestMixin, TooManyPendingRequests, command_event, event_command, peek_message,
+    response_event, upstream_group, upstreams
+)
+from .prices import (
+    get_current_prices, price_broadcaster, price_frames, price_resolver, price_update_message
+)
 
-User = get_user_model()  # This will get your CustomUser model
+# Each runs in one transaction on the database threads
+register_site_owner = run_sync(registration.register_site_owner)
+authenticate_site = run_sync(registration.authenticate_site)
+
+# Entities reported by the mock get_states handlers until real state is wired in
+MOCK_ENTITIES = {
+    "light.living_room": {
+        "entity_id": "light.living_room",
+        "state": "on",
+        "attributes": {"friendly_name": "Living Room Light", "brightness": 255}
+    },
+    "switch.kitchen": {
+        "entity_id": "switch.kitchen",
+        "state": "off",
+        "attributes": {"friendly_name": "Kitchen Switch"}
+    },
+    "sensor.temperature": {
+        "entity_id": "sensor.temperature",
+        "state": "21.5",
+        "attributes": {"friendly_name": "Living Room Temperature", "unit_of_measurement": "°C"}
+    }
+}
+
+# Entities answered to a remote get_states command; last_changed and
+# last_updated are added per response
+MOCK_REMOTE_ENTITIES = {
+    **MOCK_ENTITIES,
+    "sensor.electricity_price": {
+        "entity_id": "sensor.electricity_price",
+        "state": "0.28",
+        "attributes": {"friendly_name": "Electricity Buy Price", "unit_of_measurement": "$/kWh"}
+    },
+    "sensor.solar_sellback_price": {
+        "entity_id": "sensor.solar_sellback_price",
+        "state": "0.03",
+        "attributes": {"friendly_name": "Solar Sell Price", "unit_of_measurement": "$/kWh"}
+    }
+}
 
 """ OPP Energey Consumer """
-class OppEnergyConsumer(AsyncWebsocketConsumer):
+class OppEnergyConsumer(MessageDispatchMixin, RelayRequestMixin, IdleTimeoutMixin, WireProtocolMixin,
+                        AsyncWebsocketConsumer):
+    # False for the instances SiteFrontendConsumer relays messages through:
+    # their channel is a browser's, which must not stand in for the site's
+    # HA connection
+    is_upstream = True
+
     @property
     def Site(self):
         return apps.get_model('core', 'Site')
 
-    @database_sync_to_async
-    def create_or_update_user(self, email, password, username):
-        """Create a user if they don't exist, or update them if they do."""
-        try:
-            # Split the display name into first_name and last_name if provided
-            first_name = ""
-            last_name = ""
-            if username and " " in username:
-                name_parts = username.split(" ", 1)
-                first_name = name_parts[0]
-                last_name = name_parts[1]
-            elif username:
-                first_name = username
-                
-            # Use email as username as per requirements
-            user, created = User.objects.update_or_create(
-                username=email,  # Use email as username
-                defaults={
-                    'email': email,
-                    'first_name': first_name,
-                    'last_name': last_name
-                }
-            )
-            
-            if password:
-                user.set_password(password)
-                user.save()
-                
-            return user
-        except Exception as e:
-            print(f"Error creating or updating user: {e}")
-            return None
-        
     async def connect(self):
         print("\n=== WebSocket Connection Attempt ===")
         try:
             await self.accept()
             print("WebSocket connection successfully accepted")
             self.authenticated = False
-            self.price_updates_task = None
-            self.ping_timeout_task = None
             self.last_ping = datetime.now()
             self.site = None  # Will be set during authentication
             self.site_id = None
+            self.presence_site_id = None  # Site registered with the presence registry
+            
+            # Turn away addresses reconnecting too fast, e.g. after a restart
+            client = self.scope.get('client')
+            try:
+                admission.admit_connection(client[0] if client else None)
+            except Throttled as e:
+                print(f"Connection throttled: {e}")
+                await self.reject_throttled(e)
+                return
             print("Connection established")
         except Exception as e:
             print(f"Error during connection: {str(e)}")
@@ -66,8 +99,8 @@ class OppEnergyConsumer(AsyncWebsocketConsumer):
     async def disconnect(self, close_code):
         print("\n=== WebSocket Disconnection ===")
         print(f"Close code: {close_code}")
-        if self.price_updates_task:
-            self.price_updates_task.cancel()
+        await price_broadcaster.unsubscribe(self.channel_name, self.channel_layer)
+        self.discard_requests()
             
         # Update site connection status
         if hasattr(self, 'site') and self.site:
@@ -75,179 +108,107 @@ class OppEnergyConsumer(AsyncWebsocketConsumer):
             site_group = f"site_{self.site.id}"
             await self.channel_layer.group_discard(site_group, self.channel_name)
             
+            # Stop routing the site's commands to this connection
+            await upstreams.unregister(self.site.id, self.channel_name, self.channel_layer)
+            self._release_states(self.site.id)
+            
             # Update site connection status
-            self.site.ws_connected = False
-            await database_sync_to_async(self.site.save)()
+            self._mark_offline()
             
         if hasattr(self, 'user_name'):
             print(f"User disconnected: {self.user_name}")
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            # Parse the incoming data
-            data = json.loads(text_data)
+            # Parse the incoming data in the negotiated encoding
+            data = self.decode_frame(text_data, bytes_data)
             print(f"\n=== Frontend message received ===")
             print(f"Message: {data}")
             
-            # Special handling for common requests
-            message_type = data.get('type')
-            message_id = data.get('id', 'unknown')
-            
-            # Direct handling for registration and authentication
-            if message_type == 'user_registration':
-                print("Handling user registration directly in OppEnergyConsumer")
-                await self.handle_user_registration(data)
-                return
-                    
-            if message_type == 'authenticate':
-                print("Handling authentication directly in OppEnergyConsumer")
-                await self.handle_authentication(data)
-                return
-            
-            # Handle get_prices directly without requiring site_id
-            if message_type == 'get_prices':
-                print("Handling get_prices directly in OppEnergyConsumer")
-                await self.handle_get_prices(data)
-                return
-                    
-            # Handle subscribe_prices directly without requiring site_id
-            if message_type == 'subscribe_prices':
-                print("Handling subscribe_prices directly in OppEnergyConsumer")
-                await self.handle_price_subscription(data)
-                return
-            
-            # Handle remote command from HA integration
-            if message_type == 'remote_command':
-                print("Handling remote command from HA integration")
-                await self.handle_remote_command(data)
-                return
-            
-            # Handle get_states separately
-            if message_type == 'get_states':
-                # For testing, respond with mock entities
-                mock_entities = {
-                    "light.living_room": {
-                        "entity_id": "light.living_room",
-                        "state": "on",
-                        "attributes": {"friendly_name": "Living Room Light", "brightness": 255}
-                    },
-                    "switch.kitchen": {
-                        "entity_id": "switch.kitchen",
-                        "state": "off",
-                        "attributes": {"friendly_name": "Kitchen Switch"}
-                    },
-                    "sensor.temperature": {
-                        "entity_id": "sensor.temperature",
-                        "state": "21.5",
-                        "attributes": {"friendly_name": "Living Room Temperature", "unit_of_measurement": "°C"}
-                    }
-                }
-                
-                await self.send(text_data=json.dumps({
-                    "id": message_id,
-                    "type": "result",
-                    "success": True,
-                    "result": mock_entities
-                }))
-                print(f"Sent mock entity data in response to get_states (ID: {message_id})")
-                return
-                    
-            # Handle call_service
-            elif message_type == 'call_service':
-                domain = data.get('domain')
-                service = data.get('service')
-                service_data = data.get('service_data', {})
-                
-                print(f"Service call: {domain}.{service} with {service_data}")
-                
-                # Mock successful service call
-                await self.send(text_data=json.dumps({
-                    "id": message_id,
-                    "type": "result",
-                    "success": True,
-                    "result": {}
-                }))
-                print(f"Sent success response for service call (ID: {message_id})")
-                return
-            
-            # Handle ping messages directly
-            elif message_type == 'ping':
-                await self.send(text_data=json.dumps({
-                    "type": "pong"
-                }))
-                print("Responded to ping with pong")
-                return
-                    
-            # Only forward other messages if we have a site_id
-            if not hasattr(self, 'site_id') or self.site_id is None:
-                print(f"Cannot forward message - no site_id available")
-                await self.send(text_data=json.dumps({
-                    "type": "error",
-                    "message": "Not connected to a site",
-                    "id": message_id
-                }))
-                return
-                    
-            # Forward other messages to the site group
-            site_group = f"site_{self.site_id}"
+            # Any traffic from an authenticated site counts as a heartbeat
+            if self.presence_site_id is not None:
+                presence.heartbeat(self.presence_site_id)
             
-            # Forward the command to any OppEnergyConsumer in the site group
-            await self.channel_layer.group_send(
-                site_group,
-                {
-                    'type': 'ha_command',
-                    'command': data,
-                    'relay_channel': self.channel_name,
-                    'command_id': message_id,
-                    # Pass the site_id explicitly as a parameter
-                    'site_id': self.site_id
-                }
-            )
-            print(f"Forwarded {message_type} command to site group (ID: {message_id})")
+            message_id = data.get('id', 'unknown')
+            await self.dispatch_message(data)
             
-        except json.JSONDecodeError as e:
+        except TooManyPendingRequests:
+            await self.send_message({
+                "type": "error",
+                "message": "Too many pending requests",
+                "id": message_id
+            })
+        except Throttled as e:
+            print(f"Authentication throttled: {e}")
+            await self.reject_throttled(e, message_id)
+        except codec.DecodeError as e:
             print(f"Invalid JSON received from frontend client: {e}")
         except Exception as e:
             print(f"Error in OppEnergyConsumer.receive: {str(e)}")
-            await self.send(text_data=json.dumps({
+            await self.send_message({
                 'type': 'error',
                 'message': f'Failed to process request: {str(e)}'
-            }))
+            })
 
-    @database_sync_to_async
-    def verify_user_credentials(self, email, password):
-        """Verify user credentials against the database."""
-        try:
-            # For remote access, we can skip the password check since the user
-            # is already authenticated with Django
-            user = User.objects.get(email=email)
-            return user
-        except User.DoesNotExist:
-            print(f"No user found with email: {email}")
-            return None
-        except Exception as e:
-            print(f"Error verifying credentials: {e}")
-            return None
+    async def handle_unhandled(self, data):
+        """Forward messages without a handler to the site's HA connection."""
+        message_type = data.get('type')
+        message_id = data.get('id', 'unknown')
         
-    @database_sync_to_async
-    def register_site(self, username, site_name):
-        """Register a site for a user."""
-        try:
-            user = User.objects.get(username=username)
-            site, created = self.Site.objects.get_or_create(
-                user=user,
-                name=site_name,
-                defaults={
-                    'user': user
-                }
+        # Only forward messages if we have a site_id
+        if not hasattr(self, 'site_id') or self.site_id is None:
+            print(f"Cannot forward message - no site_id available")
+            await self.send_message({
+                "type": "error",
+                "message": "Not connected to a site",
+                "id": message_id
+            })
+            return
+        
+        # Forward the command straight to the site's HA connection. It
+        # is tracked so only the first ha_response is passed on and the
+        # client gets an error if nobody answers
+        forwarded = await self.forward_command(
+            self.site_id,
+            message_id,
+            command_event(
+                message_id,
+                self.channel_name,
+                data=data,
+                # Pass the site_id explicitly as a parameter
+                site_id=self.site_id
             )
-            print(f"Site {'created' if created else 'retrieved'} for user {username}")
-            return site
-        except Exception as e:
-            print(f"Error registering site: {str(e)}")
-            return None
+        )
+        if not forwarded:
+            await self.send_error_result(message_id, 'not_connected', 'Home Assistant is not connected')
+            return
+        print(f"Forwarded {message_type} command to site {self.site_id} (ID: {message_id})")
+
+    async def handle_unauthenticated(self, data):
+        await self.send_message({
+            "type": "error",
+            "message": "Not authenticated",
+            "id": data.get("id", "unknown")
+        })
+
+    async def reject_throttled(self, throttled, message_id=None):
+        """Tell the client when to retry and close the connection."""
+        await self.send_message({
+            "type": "error",
+            "code": "rate_limited",
+            "message": str(throttled),
+            "retry_after": throttled.retry_after,
+            "id": message_id
+        })
+        await self.close(code=THROTTLED_CLOSE_CODE, reason=f"retry_after={throttled.retry_after}")
 
+    @handles('user_registration')
     async def handle_user_registration(self, data):
+        """Register a user and site, within the admission limits."""
+        async with admission.authentication((data.get("email"), data.get("site_name"))):
+            await self._register_user(data)
+
+    async def _register_user(self, data):
         print("\n=== User Registration Attempt ===")
         display_name = data.get("user_name")  # We'll split this into first_name and last_name
         email = data.get("email")
@@ -260,22 +221,10 @@ class OppEnergyConsumer(AsyncWebsocketConsumer):
         print(f"Site Name: {site_name}")
 
         try:
-            # Create or update the user
-            user = await self.create_or_update_user(
-                email=email,
-                password=password,
-                username=display_name  # Pass display name to be split into first_name/last_name
-            )
-            
-            if not user:
-                raise Exception("Failed to create user")
-
-            # Register the site
-            site = await self.register_site(email, site_name)  # Use email as username for site registration
-            if not site:
-                # Rollback user creation if site registration fails
-                await database_sync_to_async(user.delete)()
-                raise Exception("Failed to register site")
+            # Hash the password in the worker pool, then create or update the
+            # user and its site in one transaction
+            password_hash = await hashing_pool.make_password(password) if password else None
+            user, site = await register_site_owner(email, display_name, password_hash, site_name)
                 
             # Initialize site_id after successful registration
             self.site = site
@@ -283,31 +232,41 @@ class OppEnergyConsumer(AsyncWebsocketConsumer):
             self.authenticated = True
             self.user_name = display_name
 
-            # Add this connection to the site group
-            site_group = f"site_{site.id}"
-            await self.channel_layer.group_add(site_group, self.channel_name)
-            
-            # Update site connection status
-            site.ws_connected = True
-            site.last_connected = datetime.now()
-            await database_sync_to_async(site.save)()
+            if self.is_upstream:
+                # Add this connection to the site group
+                site_group = f"site_{site.id}"
+                await self.channel_layer.group_add(site_group, self.channel_name)
+                
+                # Route the site's commands to this connection
+                await self._register_upstream(site)
+                
+                # Update site connection status
+                self._mark_online(site)
 
-            await self.send(json.dumps({
+            await self.send_message({
                 "type": "registration_success",
                 "message": "User and site registered successfully",
                 "id": message_id
-            }))
+            })
             
+        except Throttled:
+            # Answered by receive() with retry_after
+            raise
         except Exception as e:
             print(f"Error during registration: {str(e)}")
-            await self.send(json.dumps({
+            await self.send_message({
                 "type": "error",
                 "message": f"Registration failed: {str(e)}",
                 "id": message_id
-            }))
+            })
         
+    @handles('authenticate')
     async def handle_authentication(self, data):
-        """Handle authentication request."""
+        """Handle authentication request, within the admission limits."""
+        async with admission.authentication((data.get("email"), data.get("site_name"))):
+            await self._authenticate(data)
+
+    async def _authenticate(self, data):
         print("\n=== Authentication Attempt ===")
         username = data.get("user_name")
         email = data.get("email")
@@ -317,75 +276,177 @@ class OppEnergyConsumer(AsyncWebsocketConsumer):
         print(f"Attempting authentication for email: {email}")
         
         try:
-            user = await self.verify_user_credentials(email, password)
-            if user:
-                print(f"User verified, registering site: {site_name}")
-                site = await self.register_site(user.username, site_name)
-                if site:
-                    self.authenticated = True
-                    self.user_name = username
-                    self.site = site
-                    self.site_id = site.id 
-                    
-                    # Generate a unique site ID if not already set
-                    if not site.site_id:
-                        site.site_id = f"opp_energy_{email}_{site_name}"
-                        await database_sync_to_async(site.save)()
-                    
-                    # Add this connection to a group specific to this site
-                    site_group = f"site_{site.id}"
-                    await self.channel_layer.group_add(site_group, self.channel_name)
-                    
-                    # Update site connection status
-                    site.ws_connected = True
-                    site.last_connected = datetime.now()
-                    await database_sync_to_async(site.save)()
-                    
-                    await self.send(json.dumps({
-                        "type": "auth_success",
-                        "message": "Authentication successful"
-                    }))
-                    print(f"Authentication successful for user: {username}")
-                else:
-                    print("Site registration failed")
-                    await self.send(json.dumps({
-                        "type": "error",
-                        "message": "Site registration failed"
-                    }))
+            # For remote access, we can skip the password check since the user
+            # is already authenticated with Django. Looks up the user's site,
+            # creating it and assigning its site_id if needed.
+            authenticated = await authenticate_site(email, site_name)
+            if authenticated:
+                user, site = authenticated
+                self.authenticated = True
+                self.user_name = username
+                self.site = site
+                self.site_id = site.id 
+                
+                # Add this connection to a group specific to this site
+                site_group = f"site_{site.id}"
+                await self.channel_layer.group_add(site_group, self.channel_name)
+                
+                # Route the site's commands to this connection
+                await self._register_upstream(site)
+                
+                # Update site connection status
+                self._mark_online(site)
+                
+                await self.send_message({
+                    "type": "auth_success",
+                    "message": "Authentication successful"
+                })
+                print(f"Authentication successful for user: {username}")
             else:
                 print("Invalid credentials")
-                await self.send(json.dumps({
+                await self.send_message({
                     "type": "error",
                     "message": "Invalid credentials"
-                }))
+                })
         except Exception as e:
             print(f"Authentication error: {str(e)}")
-            await self.send(json.dumps({
+            await self.send_message({
                 "type": "error",
                 "message": f"Authentication error: {str(e)}"
-            }))
+            })
 
-    async def handle_ping(self):
-        """Handle ping message from client."""
+    @handles('ping')
+    async def handle_ping(self, data=None):
+        """Handle ping message from client.
+
+        Like any frame, a ping restarts the connection's idle timeout.
+        """
         self.last_ping = datetime.now()
-        await self.send(json.dumps({"type": "pong"}))
+        await self.send_message({"type": "pong"})
+
+    @handles('pong')
+    async def handle_pong(self, data=None):
+        """Reply to the server's keepalive ping; receiving it restarted the idle timeout."""
 
+    @handles('get_states')
+    async def handle_get_states(self, data):
+        """Answer get_states with the mock entities, for testing."""
+        message_id = data.get('id', 'unknown')
+        await self.send_message({
+            "id": message_id,
+            "type": "result",
+            "success": True,
+            "result": MOCK_ENTITIES
+        })
+        print(f"Sent mock entity data in response to get_states (ID: {message_id})")
+
+    @handles('call_service')
+    async def handle_call_service(self, data):
+        """Acknowledge a service call without performing it."""
+        message_id = data.get('id', 'unknown')
+        print(f"Service call: {data.get('domain')}.{data.get('service')} with {data.get('service_data', {})}")
+        
+        # Mock successful service call
+        await self.send_message({
+            "id": message_id,
+            "type": "result",
+            "success": True,
+            "result": {}
+        })
+        print(f"Sent success response for service call (ID: {message_id})")
+
+    async def _register_upstream(self, site):
+        """Make this connection the upstream of ``site``, leaving any previous site."""
+        previous = getattr(self, 'upstream_site_id', None)
+        if previous is not None and previous != site.id:
+            await upstreams.unregister(previous, self.channel_name, self.channel_layer)
+            self._release_states(previous)
+        await upstreams.register(site.id, self.channel_name, self.channel_layer)
+        self.upstream_site_id = site.id
+
+    def _release_states(self, site_id):
+        """Drop the site's state cache unless another HA connection here took over."""
+        if not upstreams.is_local(site_id):
+            site_states.discard(site_id)
+
+    @handles('state_snapshot', requires_auth=True)
+    async def handle_state_snapshot(self, data):
+        """Seed the site's state cache with every entity of Home Assistant."""
+        states = data.get('states') or {}
+        if isinstance(states, list):
+            states = {state['entity_id']: state for state in states}
+        since = site_states.site(self.site_id).version
+        site_states.replace(self.site_id, states)
+        await self._publish_states(since)
+
+    @handles('event', 'state_changed', requires_auth=True)
+    async def handle_state_changed(self, data):
+        """Apply a state_changed event to the site's state cache.
+
+        Accepts Home Assistant's event message (``{"type": "event", "event":
+        {"event_type": "state_changed", "data": {...}}}``) or the event data
+        sent directly as a ``state_changed`` message.
+        """
+        event = data.get('event', data)
+        if event.get('event_type', 'state_changed') != 'state_changed':
+            return
+        since = site_states.site(self.site_id).version
+        site_states.apply_event(self.site_id, event.get('data', event))
+        await self._publish_states(since)
+
+    async def _publish_states(self, since):
+        """Send the entities changed after version ``since`` to the site's frontends."""
+        delta = site_states.snapshot(self.site_id, since)
+        if not delta['states'] and not delta['removed']:
+            return
+        await self.channel_layer.group_send(f"frontend_{self.site_id}", {
+            'type': 'ha_state_update',
+            'states': delta['states'],
+            'removed': delta['removed'],
+            'version': delta['version'],
+            'epoch': delta['epoch'],
+        })
+
+    def _mark_online(self, site):
+        """Register this connection with the presence registry."""
+        if getattr(self, 'presence_site_id', None) == site.id:
+            presence.heartbeat(site.id)
+            return
+        self._mark_offline()
+        presence.online(site.id)
+        self.presence_site_id = site.id
+
+    def _mark_offline(self):
+        """Remove this connection from the presence registry."""
+        if getattr(self, 'presence_site_id', None) is not None:
+            presence.offline(self.presence_site_id)
+            self.presence_site_id = None
+
+    @handles('subscribe_prices', requires_auth=True)
     async def handle_price_subscription(self, data):
         """Handle price subscription request."""
         if not self.authenticated:
-            await self.send(json.dumps({
+            await self.send_message({
                 "type": "error",
                 "message": "Not authenticated"
-            }))
+            })
             return
 
-        # Cancel existing price updates task if it exists
-        if self.price_updates_task:
-            self.price_updates_task.cancel()
+        # Join the shared prices group; the process-wide ticker and the
+        # EnergyPrice change push deliver everything after the first update
+        # and schedule, which are sent from here
+        await price_broadcaster.subscribe(self.channel_name, self.channel_layer)
+        for frame in await price_frames():
+            await self.send_json_frame(frame)
 
-        # Start new price updates task
-        self.price_updates_task = asyncio.create_task(self.send_price_updates())
+    async def price_broadcast(self, event):
+        """Send pre-serialized price messages from the prices group."""
+        if event.get('changed'):
+            price_resolver.invalidate()
+        for frame in event['frames']:
+            await self.send_json_frame(frame)
 
+    @handles('get_prices')
     async def handle_get_prices(self, data):
         """Handle request for current prices."""
         print("\n=== Price Request ===")
@@ -402,22 +463,14 @@ class OppEnergyConsumer(AsyncWebsocketConsumer):
             
             # Send immediate price update
             print(f"Sending price data: {prices}")
-            await self.send(json.dumps({
-                "type": "price_update",
-                "data": {  # Wrap in a data field to match what coordinator expects
-                    "buy_price": prices["buy_price"],
-                    "sell_price": prices["sell_price"],
-                    "timestamp": datetime.now().isoformat()
-                },
-                "id": message_id
-            }))
+            await self.send_message(price_update_message(prices, message_id))
         except Exception as e:
             print(f"Error handling price request: {str(e)}")
-            await self.send(json.dumps({
+            await self.send_message({
                 "type": "error",
                 "message": f"Error getting prices: {str(e)}",
                 "id": message_id
-            }))
+            })
 
     async def handle_get_hass_state(self, data):
         """Handle request for Home Assistant state."""
@@ -430,10 +483,10 @@ class OppEnergyConsumer(AsyncWebsocketConsumer):
         
         if not self.authenticated:
             print("User not authenticated for HA state request")
-            await self.send(json.dumps({
+            await self.send_message({
                 "type": "error",
                 "message": "Not authenticated"
-            }))
+            })
             return
             
         try:
@@ -441,53 +494,31 @@ class OppEnergyConsumer(AsyncWebsocketConsumer):
             message_id = data.get("id", str(datetime.now().timestamp()))
             
             # Send request to get HA state
-            await self.send(json.dumps({
+            await self.send_message({
                 "type": "get_hass_state_request",
                 "site_id": site_id,
                 "entity_id": entity_id,
                 "id": message_id
-            }))
+            })
             
             print(f"Sent Home Assistant state request to site {site_id}")
             
         except Exception as e:
             print(f"Error handling HA state request: {str(e)}")
-            await self.send(json.dumps({
+            await self.send_message({
                 "type": "error",
                 "message": f"Error requesting Home Assistant state: {str(e)}",
                 "id": data.get("id")
-            }))
+            })
 
-    async def send_price_updates(self):
-        """Send periodic price updates to the client."""
-        while True:
-            try:
-                # In practice, fetch real prices from database/service
-                prices = await self.get_current_prices()
-                print(f"Sending price update: {prices}")
-                
-                # Use the same format as the handle_get_prices handler
-                await self.send(json.dumps({
-                    "type": "price_update",
-                    "data": {  # Wrap in a data field to match what coordinator expects
-                        "buy_price": prices["buy_price"],
-                        "sell_price": prices["sell_price"],
-                        "timestamp": datetime.now().isoformat()
-                    }
-                }))
-                
-                await asyncio.sleep(30)  # Update every 30 seconds
-            except Exception as e:
-                print(f"Error sending price updates: {e}")
-                await asyncio.sleep(5)  # Wait before retrying
+    async def get_current_prices(self):
+        return await get_current_prices()
 
-    @database_sync_to_async
-    def get_current_prices(self):
-        # In practice, implement price fetching logic here
-        return {
-            "buy_price": 0.28,
-            "sell_price": 0.03 
-        }
+    async def ha_response(self, event):
+        """Pass on the response to a command this connection forwarded."""
+        frame = self.accept_response(event)
+        if frame is not None:
+            await self.send_frame(frame)
 
     async def ha_command(self, event):
         """Handle Home Assistant command relayed from the frontend."""
@@ -495,23 +526,37 @@ class OppEnergyConsumer(AsyncWebsocketConsumer):
             # Send error response
             await self.channel_layer.send(
                 event['relay_channel'],
-                {
-                    'type': 'ha_response',
-                    'response': {
-                        'id': event['command_id'],
-                        'success': False,
-                        'error': {
-                            'message': 'Not authenticated'
-                        }
+                response_event({
+                    'id': event['command_id'],
+                    'success': False,
+                    'error': {
+                        'message': 'Not authenticated'
                     }
-                }
+                })
             )
             return
                 
-        # Process the command
-        command = event['command']
-        command_type = command.get('type')
+        # Process the command; relayed raw frames are decoded here, and one
+        # that doesn't decode is answered with an error rather than taking
+        # this connection down
         command_id = event['command_id']
+        try:
+            command = event_command(event)
+        except codec.DecodeError as e:
+            print(f"Invalid relayed command {command_id}: {e}")
+            await self.channel_layer.send(
+                event['relay_channel'],
+                response_event({
+                    'id': command_id,
+                    'success': False,
+                    'error': {
+                        'code': 'invalid_format',
+                        'message': f'Invalid message: {e}'
+                    }
+                })
+            )
+            return
+        command_type = command.get('type')
         
         # Get the site_id from the command or the site object
         # This fixes the attribute error
@@ -523,55 +568,37 @@ class OppEnergyConsumer(AsyncWebsocketConsumer):
         
         print(f"Processing HA command: {command_type} (ID: {command_id}) for site {site_id}")
         
+        # Answer get_states from the site's state cache once it is seeded
+        if command_type == "get_states" and site_states.has(site_id):
+            await self.channel_layer.send(
+                event['relay_channel'],
+                response_event(site_states.result_message(site_id, command_id, command))
+            )
         # Handle get_states command
-        if command_type == "get_states":
+        elif command_type == "get_states":
             try:
-                # In a real implementation, you would get actual states
-                # For now, just respond with some mock data
-                mock_entities = {
-                    "light.living_room": {
-                        "entity_id": "light.living_room",
-                        "state": "on",
-                        "attributes": {"friendly_name": "Living Room Light", "brightness": 255}
-                    },
-                    "switch.kitchen": {
-                        "entity_id": "switch.kitchen",
-                        "state": "off",
-                        "attributes": {"friendly_name": "Kitchen Switch"}
-                    },
-                    "sensor.temperature": {
-                        "entity_id": "sensor.temperature",
-                        "state": "21.5",
-                        "attributes": {"friendly_name": "Living Room Temperature", "unit_of_measurement": "°C"}
-                    }
-                }
-                
+                # Until Home Assistant sends a state snapshot, respond with
+                # some mock data
                 await self.channel_layer.send(
                     event['relay_channel'],
-                    {
-                        'type': 'ha_response',
-                        'response': {
-                            'id': command_id,
-                            'success': True,
-                            'result': mock_entities
-                        }
-                    }
+                    response_event({
+                        'id': command_id,
+                        'success': True,
+                        'result': MOCK_ENTITIES
+                    })
                 )
                 print(f"Sent mock entity data response for {command_id}")
             except Exception as e:
                 print(f"Error handling get_states command: {str(e)}")
                 await self.channel_layer.send(
                     event['relay_channel'],
-                    {
-                        'type': 'ha_response',
-                        'response': {
-                            'id': command_id,
-                            'success': False,
-                            'error': {
-                                'message': str(e)
-                            }
+                    response_event({
+                        'id': command_id,
+                        'success': False,
+                        'error': {
+                            'message': str(e)
                         }
-                    }
+                    })
                 )
         # Other command handlers...
         else:
@@ -579,16 +606,14 @@ class OppEnergyConsumer(AsyncWebsocketConsumer):
             # Send a default response
             await self.channel_layer.send(
                 event['relay_channel'],
-                {
-                    'type': 'ha_response',
-                    'response': {
-                        'id': command_id,
-                        'success': True,
-                        'result': {}
-                    }
-                }
+                response_event({
+                    'id': command_id,
+                    'success': True,
+                    'result': {}
+                })
             )
 
+    @handles('remote_command')
     async def handle_remote_command(self, data):
         """Handle remote command from a web client."""
         print("\n=== Remote Command Request ===")
@@ -602,81 +627,49 @@ class OppEnergyConsumer(AsyncWebsocketConsumer):
             # Handle specific commands
             if command == "get_states":
                 # Create mock states to respond with
+                now = datetime.now().isoformat()
                 states = {
-                    "light.living_room": {
-                        "entity_id": "light.living_room",
-                        "state": "on",
-                        "attributes": {"friendly_name": "Living Room Light", "brightness": 255},
-                        "last_changed": datetime.now().isoformat(),
-                        "last_updated": datetime.now().isoformat()
-                    },
-                    "switch.kitchen": {
-                        "entity_id": "switch.kitchen",
-                        "state": "off",
-                        "attributes": {"friendly_name": "Kitchen Switch"},
-                        "last_changed": datetime.now().isoformat(),
-                        "last_updated": datetime.now().isoformat()
-                    },
-                    "sensor.temperature": {
-                        "entity_id": "sensor.temperature",
-                        "state": "21.5",
-                        "attributes": {"friendly_name": "Living Room Temperature", "unit_of_measurement": "°C"},
-                        "last_changed": datetime.now().isoformat(),
-                        "last_updated": datetime.now().isoformat()
-                    },
-                    "sensor.electricity_price": {
-                        "entity_id": "sensor.electricity_price",
-                        "state": "0.28",
-                        "attributes": {"friendly_name": "Electricity Buy Price", "unit_of_measurement": "$/kWh"},
-                        "last_changed": datetime.now().isoformat(),
-                        "last_updated": datetime.now().isoformat()
-                    },
-                    "sensor.solar_sellback_price": {
-                        "entity_id": "sensor.solar_sellback_price",
-                        "state": "0.03",
-                        "attributes": {"friendly_name": "Solar Sell Price", "unit_of_measurement": "$/kWh"},
-                        "last_changed": datetime.now().isoformat(),
-                        "last_updated": datetime.now().isoformat()
-                    }
+                    entity_id: {**entity, "last_changed": now, "last_updated": now}
+                    for entity_id, entity in MOCK_REMOTE_ENTITIES.items()
                 }
                 
                 # Send response
-                await self.send(json.dumps({
+                await self.send_message({
                     "type": "remote_response",
                     "session_id": session_id,
                     "command_id": command_id,
                     "success": True,
                     "result": states
-                }))
+                })
                 print(f"Sent state data response for remote command {command_id}")
                 return
                 
             # Handle register_remote_access
             elif command == "register_remote_access":
                 # Just acknowledge it
-                await self.send(json.dumps({
+                await self.send_message({
                     "type": "remote_response",
                     "session_id": session_id,
                     "command_id": command_id,
                     "success": True,
                     "result": {"registered": True}
-                }))
+                })
                 print(f"Acknowledged remote registration for {data.get('instance_id', 'unknown')}")
                 return
                 
             # Default response for other commands
-            await self.send(json.dumps({
+            await self.send_message({
                 "type": "remote_response",
                 "session_id": session_id,
                 "command_id": command_id,
                 "success": True,
                 "result": {}
-            }))
+            })
             print(f"Sent default success response for {command}")
             
         except Exception as e:
             print(f"Error handling remote command: {str(e)}")
-            await self.send(json.dumps({
+            await self.send_message({
                 "type": "remote_response",
                 "session_id": session_id,
                 "command_id": command_id,
@@ -684,18 +677,16 @@ class OppEnergyConsumer(AsyncWebsocketConsumer):
                 "error": {
                     "message": str(e)
                 }
-            }))
+            })
 
     async def check_connection(self, event):
         """Check and update the connection status."""
         site_id = event.get('site_id')
         
-        # Update the site's connection status in the database
+        # The presence registry is updated on every message; the flusher
+        # persists it, so there is nothing to save here
         if hasattr(self, 'site') and self.site and str(self.site.id) == str(site_id):
-            # Update the connection status
-            self.site.ws_connected = self._is_connected()
-            self.site.last_connected = datetime.now() if self._is_connected() else self.site.last_connected
-            await database_sync_to_async(self.site.save)()
+            connected, last_connected = presence.status(self.site)
             
             # Notify any frontend consumers about the updated status
             site_group = f"frontend_{site_id}"
@@ -703,14 +694,17 @@ class OppEnergyConsumer(AsyncWebsocketConsumer):
                 site_group,
                 {
                     'type': 'connection_status',
-                    'connected': self.site.ws_connected,
-                    'last_connected': self.site.last_connected.isoformat() if self.site.last_connected else None
+                    'connected': connected,
+                    'last_connected': last_connected.isoformat() if last_connected else None
                 }
             )
 
-class SiteFrontendConsumer(AsyncWebsocketConsumer):
+class SiteFrontendConsumer(RelayRequestMixin, IdleTimeoutMixin, OutboundQueueMixin, WireProtocolMixin,
+                           AsyncWebsocketConsumer):
     """Consumer for frontend clients connecting to control Home Assistant"""
     
+    idle_timeout = FRONTEND_IDLE_TIMEOUT
+    
     @property
     def Site(self):
         return apps.get_model('core', 'Site')
@@ -726,6 +720,13 @@ class SiteFrontendConsumer(AsyncWebsocketConsumer):
             await self.close(code=4003)
             return
         
+        # State updates are coalesced per connection, in the site's window
+        window = self.state_update_window
+        self.state_updates = StateUpdateBuffer(
+            self.send_state_update, window=STATE_COALESCE_WINDOW if window is None else window,
+            queue=lambda: self.outbound
+        )
+        
         # Add to frontend group for this site
         await self.channel_layer.group_add(
             self.frontend_group,
@@ -735,18 +736,16 @@ class SiteFrontendConsumer(AsyncWebsocketConsumer):
         # Accept the connection
         await self.accept()
         
-        # Find the corresponding site group
-        site_group = f"site_{self.site_id}"
-        
-        # Check if there's an active OppEnergyConsumer for this site
-        channels = self.channel_layer.groups.get(site_group, set())
-        site_connected = len(channels) > 0
+        # Check if there's an active OppEnergyConsumer for this site. Only HA
+        # connections join the upstream group, and the membership query works
+        # whichever worker holds the connection.
+        site_connected = await group_has_members(upstream_group(self.site_id), self.channel_layer)
         
         # Send connection status
-        await self.send(text_data=json.dumps({
+        await self.send_message({
             'type': 'auth_ok',
             'ha_connected': site_connected
-        }))
+        })
     
     async def disconnect(self, close_code):
         # Remove from frontend group
@@ -755,59 +754,110 @@ class SiteFrontendConsumer(AsyncWebsocketConsumer):
                 self.frontend_group,
                 self.channel_name
             )
+        # Leave the prices group if subscribe_prices was relayed for us
+        await price_broadcaster.unsubscribe(self.channel_name, self.channel_layer)
+        # Drop requests still waiting for Home Assistant
+        self.discard_requests()
+        if hasattr(self, 'state_updates'):
+            self.state_updates.close()
     
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            # Parse the incoming data
-            data = json.loads(text_data)
+            # Only the type and id are needed to relay a JSON command; the
+            # frame itself is passed on undecoded. Binary frames are cheap to
+            # decode in full.
+            if bytes_data is not None:
+                bytes_data = self.inflate_frame(bytes_data)
+            if bytes_data is not None and self.wire.binary:
+                raw, wire = bytes_data, self.wire
+                data = wire.decode(raw)
+                message_type, message_id = data.get('type'), data.get('id')
+            else:
+                raw, wire = text_data if text_data is not None else bytes_data.decode(), JSON_WIRE
+                message_type, message_id, data = peek_message(raw)
             print(f"\n=== Frontend message received ===")
-            print(f"Message: {data}")
+            print(f"Message: {message_type} (ID: {message_id})")
             
-            # Special handling for common requests
-            message_type = data.get('type')
-            message_id = data.get('id', 'unknown')
+            # Heartbeats are for this connection's idle timeout, not for HA
+            if message_type == 'ping':
+                await self.send_message({'type': 'pong', 'id': message_id})
+                return
+            if message_type == 'pong':
+                return
             
             # Add special handling for registration
             if message_type == 'user_registration':
+                if data is None:
+                    data = codec.loads(raw)
                 print("Handling user registration directly")
                 # Create a new OppEnergyConsumer instance or call its method directly
                 opp_consumer = OppEnergyConsumer()
                 # Initialize it minimally
                 opp_consumer.channel_layer = self.channel_layer
                 opp_consumer.channel_name = self.channel_name
-                # Set the send method
-                opp_consumer.send = self.send
+                # Register only; this browser is not the site's HA connection
+                opp_consumer.is_upstream = False
+                # Write through this connection's queue, in its encoding
+                opp_consumer.write_frame = self.write_frame
+                opp_consumer.wire = self.wire
                 # Call the registration handler with just the data parameter
                 await opp_consumer.handle_user_registration(data)
                 return
                 
-            # Forward other messages to the site group
-            site_group = f"site_{self.site_id}"
+            command_id = message_id if message_id is not None else str(datetime.now().timestamp())
             
-            # Add session info to the message
-            data['frontend_channel'] = self.channel_name
+            # After dropped state frames a delta would miss their entities;
+            # only a full snapshot brings the client back in line
+            if message_type == 'get_states' and self.state_updates.needs_resync:
+                data = dict(data if data is not None else wire.decode(raw))
+                data.pop('since_version', None)
+                raw = None
+                self.state_updates.needs_resync = False
             
-            # Forward the command to any OppEnergyConsumer in the site group
-            await self.channel_layer.group_send(
-                site_group,
-                {
-                    'type': 'ha_command',
-                    'command': data,
-                    'relay_channel': self.channel_name,
-                    'command_id': data.get('id', str(datetime.now().timestamp()))
-                }
+            # The site's state cache is in this process when its HA
+            # connection is, so get_states needs no round trip
+            if message_type == 'get_states' and site_states.has(self.site_id):
+                if data is None:
+                    data = wire.decode(raw)
+                await self.send_message(site_states.result_message(self.site_id, command_id, data))
+                return
+            
+            # Forward the command straight to the site's HA connection. It is
+            # tracked so duplicate or late responses are dropped and the
+            # browser gets an error if Home Assistant doesn't answer. The
+            # relay_channel in the envelope identifies this frontend session.
+            forwarded = await self.forward_command(
+                self.site_id,
+                command_id,
+                command_event(command_id, self.channel_name, data=data, raw=raw, wire=wire)
             )
-            print(f"Forwarded {message_type} command to site group (ID: {message_id})")
+            if not forwarded:
+                await self.send_error_result(command_id, 'not_connected', 'Home Assistant is not connected')
+                return
+            print(f"Forwarded {message_type} command to site {self.site_id} (ID: {message_id})")
             
-        except json.JSONDecodeError:
+        except TooManyPendingRequests:
+            await self.send_message({
+                'type': 'error',
+                'message': 'Too many pending requests'
+            })
+        except Throttled as e:
+            # Registration relayed for a browser; it keeps its connection
+            await self.send_message({
+                'type': 'error',
+                'code': 'rate_limited',
+                'message': str(e),
+                'retry_after': e.retry_after
+            })
+        except codec.DecodeError:
             print(f"Invalid JSON received from frontend client")
         except Exception as e:
             print(f"Error in SiteFrontendConsumer.receive: {str(e)}")
-            await self.send(text_data=json.dumps({
+            await self.send_message({
                 'type': 'error',
                 'message': f'Failed to communicate with Home Assistant: {str(e)}'
-            }))
+            })
 
     async def ha_command(self, event):
         """Handle Home Assistant command forwarded from another consumer."""
@@ -819,7 +869,11 @@ class SiteFrontendConsumer(AsyncWebsocketConsumer):
         
         # But for some message types, we might want to add special handling
         # For example, for subscribe_prices:
-        command = event.get('command', {})
+        try:
+            command = event_command(event)
+        except codec.DecodeError as e:
+            print(f"Invalid relayed command {event.get('command_id')}: {e}")
+            return
         command_type = command.get('type')
         
         if command_type == 'subscribe_prices':
@@ -828,7 +882,9 @@ class SiteFrontendConsumer(AsyncWebsocketConsumer):
             # Initialize it minimally
             opp_consumer.channel_layer = self.channel_layer
             opp_consumer.channel_name = self.channel_name
-            opp_consumer.send = self.send
+            opp_consumer.is_upstream = False
+            opp_consumer.write_frame = self.write_frame
+            opp_consumer.wire = self.wire
             opp_consumer.authenticated = True  # Assume authenticated since we're in SiteFrontendConsumer
             
             # Call the price subscription handler
@@ -839,28 +895,54 @@ class SiteFrontendConsumer(AsyncWebsocketConsumer):
 
     async def ha_response(self, event):
         """Handle responses from Home Assistant"""
-        await self.send(text_data=json.dumps(event['response']))
+        # Only the first response to a tracked command is passed on, as
+        # the frame it arrived in
+        frame = self.accept_response(event)
+        if frame is not None:
+            await self.send_frame(frame)
+    
+    async def price_broadcast(self, event):
+        """Send pre-serialized price messages from the prices group"""
+        if event.get('changed'):
+            price_resolver.invalidate()
+        for frame in event['frames']:
+            await self.send_json_frame(frame)
     
     async def ha_state_update(self, event):
         """Handle state updates from Home Assistant"""
-        await self.send(text_data=json.dumps({
-            'type': 'result',
-            'result': {
-                'type': 'state_update',
-                'states': event['states']
-            }
-        }))
+        # Bursts are merged per entity and queued once per window
+        await self.state_updates.add(event)
+
+    async def send_state_update(self, message, key):
+        """Queue a coalesced state update without waiting for the socket."""
+        # Under load state frames are dropped before command responses are
+        # delayed; the buffer then asks the client to resync
+        return await self.send_message(message, low_priority=True, key=key)
+
+    async def connection_status(self, event):
+        """Handle site connection status changes"""
+        await self.send_message({
+            'type': 'connection_status',
+            'connected': event['connected'],
+            'last_connected': event['last_connected']
+        })
     
-    @database_sync_to_async
-    def check_user_permission(self):
+    async def check_user_permission(self):
         try:
-            # Check if user is the site owner
-            site_owner = self.Site.objects.filter(
+            # Check if user is the site owner, fetching the site's state
+            # update window with the same query, from the read replica
+            owned = self.Site.objects.filter(
                 id=self.site_id,
                 user=self.user
-            ).exists()
+            ).values('state_update_window')
+            with replica_reads(self.scope.get('session')):
+                site = await owned.afirst()
+            if site is None and replica_configured():
+                # A site registered moments ago may not be replicated yet
+                site = await owned.afirst()
             
-            return site_owner
+            self.state_update_window = site['state_update_window'] if site else None
+            return site is not None
         except Exception as e:
             print(f"Error checking user permission: {str(e)}")
             return False
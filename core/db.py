@@ -0,0 +1,33 @@
+"""Database access from async consumers.
+
+Consumers use Django's async ORM methods (``aget``, ``aget_or_create``,
+``afirst``, ``asave`` ...) where they exist. Those still run the query in a
+thread, but need no hand written sync wrapper. Sync work that has no async
+counterpart is wrapped with ``run_sync`` instead of
+``database_sync_to_async``: it runs on a dedicated pool of OPP_DB_THREADS
+threads rather than on the single thread that ``database_sync_to_async``
+and the async ORM share, so it can't queue behind unrelated queries.
+Each thread keeps its own database connection, so the pool size adds to
+the connections a process may open.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+
+_LOGGER = logging.getLogger(__name__)
+
+# Threads running sync consumer work; each may hold a database connection
+DB_THREADS = getattr(settings, 'OPP_DB_THREADS', 4)
+
+db_executor = ThreadPoolExecutor(DB_THREADS, thread_name_prefix='opp-db')
+
+
+def run_sync(func):
+    """Wrap a sync function to run on ``db_executor``; usable as a decorator.
+
+    Like ``database_sync_to_async``, stale connections are closed before
+    and after the call.
+    """
+    return DatabaseSyncToAsync(func, thread_sensitive=False, executor=db_executor)
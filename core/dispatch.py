@@ -0,0 +1,95 @@
+"""Table driven dispatch of incoming websocket messages by their ``type``.
+
+Consumer methods are registered with the ``handles`` decorator:
+
+    @handles('get_prices')
+    async def handle_get_prices(self, data): ...
+
+    @handles('subscribe_prices', requires_auth=True)
+    async def handle_price_subscription(self, data): ...
+
+The table is built once per class when it is defined, so dispatching a
+message is a dict lookup however many types are registered. Every
+dispatched message is counted and timed per type in ``core.metrics``.
+"""
+from functools import lru_cache
+from typing import NamedTuple
+import time
+
+from .metrics import metrics
+
+# Metric label for messages without a registered handler, so arbitrary
+# client supplied types don't create new metrics
+UNHANDLED = 'unhandled'
+
+
+class Handler(NamedTuple):
+    method: str
+    requires_auth: bool
+
+
+@lru_cache(maxsize=None)
+def _type_metrics(label):
+    """Return the (messages, errors, latency) metrics of a message type."""
+    return (
+        metrics.counter('ws_messages', type=label),
+        metrics.counter('ws_message_errors', type=label),
+        metrics.histogram('ws_message_seconds', type=label),
+    )
+
+
+def handles(*message_types, requires_auth=False):
+    """Register the decorated consumer method for ``message_types``."""
+    def decorator(method):
+        method.handles = (message_types, requires_auth)
+        return method
+    return decorator
+
+
+class MessageDispatchMixin:
+    """Dispatch decoded messages to the methods registered with ``handles``.
+
+    Subclasses inherit the handlers of their bases and may override them.
+    """
+
+    handlers = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        handlers = dict(cls.handlers)
+        for name, attr in vars(cls).items():
+            message_types, requires_auth = getattr(attr, 'handles', ((), False))
+            for message_type in message_types:
+                handlers[message_type] = Handler(name, requires_auth)
+        cls.handlers = handlers
+
+    async def dispatch_message(self, data):
+        """Run the handler registered for ``data['type']``.
+
+        Messages without a handler go to ``handle_unhandled``. A handler that
+        requires authentication is answered with ``handle_unauthenticated``
+        until the connection has authenticated.
+        """
+        message_type = data.get('type')
+        handler = self.handlers.get(message_type)
+        messages, errors, latency = _type_metrics(message_type if handler else UNHANDLED)
+        start = time.perf_counter()
+        try:
+            if handler is None:
+                await self.handle_unhandled(data)
+            elif handler.requires_auth and not getattr(self, 'authenticated', False):
+                await self.handle_unauthenticated(data)
+            else:
+                await getattr(self, handler.method)(data)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            messages.inc()
+            latency.observe(time.perf_counter() - start)
+
+    async def handle_unhandled(self, data):
+        raise NotImplementedError
+
+    async def handle_unauthenticated(self, data):
+        raise NotImplementedError
@@ -0,0 +1,101 @@
+"""Password hashing in a bounded process pool.
+
+PBKDF2 takes tens of milliseconds of CPU per password. Run through
+database_sync_to_async it occupies the single thread that every other
+database call of the process is serialised on, so a burst of
+registrations stalls unrelated connections. ``hashing_pool`` runs it in
+OPP_HASHING_WORKERS separate processes instead (spawned on first use, each
+with Django set up). At most OPP_HASHING_MAX_QUEUE hashes may be queued or
+running; past that callers get ``Throttled``, which consumers answer like
+any other admission rejection. ``check_password`` goes through the same
+pool.
+
+With OPP_HASHING_WORKERS = 0 passwords are hashed on the sync thread as
+before, e.g. for comparison in ``manage.py load_registration``. The same
+happens when the pool can't run, e.g. a host without process semaphores
+or a worker that died; a broken pool is replaced on the next call.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, make_password
+
+from .admission import Throttled, with_jitter
+from .metrics import metrics
+
+_LOGGER = logging.getLogger(__name__)
+
+# Processes hashing passwords; 0 hashes on the shared sync thread
+HASHING_WORKERS = getattr(settings, 'OPP_HASHING_WORKERS', min(2, os.cpu_count() or 1))
+# Hashes allowed to be queued or running at once
+HASHING_MAX_QUEUE = getattr(settings, 'OPP_HASHING_MAX_QUEUE', 32)
+
+
+def _init_worker():
+    import django
+    django.setup()
+
+
+class PasswordHashingPool:
+    """Hash passwords in worker processes, with a bounded backlog."""
+
+    def __init__(self, workers=HASHING_WORKERS, max_queue=HASHING_MAX_QUEUE):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.pending = 0
+        self._executor = None
+        self._depth = metrics.gauge('hashing_queue_depth')
+        self._seconds = metrics.histogram('hashing_seconds')
+
+    def executor(self):
+        if self._executor is None:
+            # Spawned rather than forked: the server process runs threads
+            self._executor = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker
+            )
+        return self._executor
+
+    async def make_password(self, raw_password):
+        """Return the encoded hash of ``raw_password``, as Django's make_password."""
+        return await self._run(make_password, raw_password)
+
+    async def check_password(self, raw_password, encoded):
+        """Return whether ``raw_password`` matches ``encoded``, as Django's check_password."""
+        return await self._run(check_password, raw_password, encoded)
+
+    async def _run(self, func, *args):
+        if self.pending >= self.max_queue:
+            metrics.counter('hashing_rejected').inc()
+            mean = self._seconds.sum / self._seconds.count if self._seconds.count else 0
+            raise Throttled('hashing', with_jitter(mean * self.pending / max(self.workers, 1)))
+        self.pending += 1
+        self._depth.set(self.pending)
+        start = time.perf_counter()
+        try:
+            if self.workers:
+                try:
+                    return await asyncio.get_running_loop().run_in_executor(self.executor(), func, *args)
+                except (BrokenProcessPool, OSError, NotImplementedError) as e:
+                    _LOGGER.warning(f"Password hashing pool unavailable, hashing on the sync thread: {e}")
+                    metrics.counter('hashing_pool_errors').inc()
+                    self.shutdown()
+            return await sync_to_async(func)(*args)
+        finally:
+            self.pending -= 1
+            self._depth.set(self.pending)
+            self._seconds.observe(time.perf_counter() - start)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+hashing_pool = PasswordHashingPool()
@@ -0,0 +1,341 @@
+"""EnergyPrice history queries with database side downsampling.
+
+Aggregated buckets (min/max/avg per bucket) are computed by the database
+with ``Trunc`` + ``GROUP BY``. Rows are read as plain tuples/dicts with
+``iterator()``, never as model instances. Pages are bounded by ``limit``
+and use keyset cursors: the key of the last returned row or bucket is
+handed back as ``next_cursor`` and the next page filters past it, which
+stays index friendly however deep the client pages. The same cursor splits
+a page into queries of HISTORY_CHUNK_SIZE rows, which
+``stream_history_json`` runs on the database threads and writes out one at
+a time, so neither the event loop nor memory holds the whole page. Under
+WSGI ``iter_history_json`` does the same in the request thread.
+
+Bucketed ranges are widened to whole buckets: ``start`` to the start of
+its bucket and ``end`` to the end of its bucket, so the first and last
+buckets are complete whichever tier serves them.
+
+Raw rows older than the retention age are rolled up into hourly and daily
+tables by ``core.retention``. Hour and coarser buckets before the rollup
+watermark are read from those tables and joined with buckets computed from
+the remaining raw rows, so callers don't need to know which tier holds a
+range. Raw and minute queries only cover the retained raw rows.
+"""
+from datetime import timedelta
+from itertools import chain
+
+from django.db.models import Count, Max, Min, Q, Sum
+from django.db.models.functions import TruncDay, TruncHour, TruncMinute, TruncMonth, TruncWeek
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import codec
+from .db import run_sync
+from .models import EnergyPrice, EnergyPriceDaily, EnergyPriceHourly
+from .retention import merge_rollup, rollup_watermark
+
+BUCKETS = {
+    'minute': TruncMinute,
+    'hour': TruncHour,
+    'day': TruncDay,
+    'week': TruncWeek,
+    'month': TruncMonth,
+}
+RAW = 'raw'
+# Rollup table that can serve each bucket size
+ROLLUP_TIERS = {
+    'hour': EnergyPriceHourly,
+    'day': EnergyPriceDaily,
+    'week': EnergyPriceDaily,
+    'month': EnergyPriceDaily,
+}
+HISTORY_DEFAULT_LIMIT = 1000
+HISTORY_MAX_LIMIT = 10000
+# Rows fetched per round trip when iterating a page
+HISTORY_CHUNK_SIZE = 2000
+
+
+class HistoryQueryError(ValueError):
+    """Raised for invalid history query parameters."""
+
+
+def _parse_time(value, name):
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise HistoryQueryError(f"{name} is not a valid datetime")
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def _parse_cursor(cursor, bucket):
+    """Decode a next_cursor value handed out by a previous page."""
+    try:
+        if bucket == RAW:
+            timestamp, _, pk = cursor.rpartition('|')
+            return _parse_time(timestamp, 'cursor'), int(pk)
+        return _parse_time(cursor, 'cursor')
+    except (HistoryQueryError, ValueError):
+        raise HistoryQueryError("Invalid cursor")
+
+
+def parse_history_params(params):
+    """Validate query parameters and return (start, end, bucket, limit, after).
+
+    ``after`` is the decoded cursor: a bucket start, or a (timestamp, id)
+    pair for raw rows.
+    """
+    bucket = params.get('bucket', 'hour')
+    if bucket != RAW and bucket not in BUCKETS:
+        raise HistoryQueryError(f"bucket must be one of: {', '.join([RAW, *BUCKETS])}")
+    start = _parse_time(params['start'], 'start') if params.get('start') else None
+    end = _parse_time(params['end'], 'end') if params.get('end') else None
+    if start and end and end <= start:
+        raise HistoryQueryError("end must be after start")
+    try:
+        limit = int(params.get('limit', HISTORY_DEFAULT_LIMIT))
+    except ValueError:
+        raise HistoryQueryError("limit must be an integer")
+    if not 0 < limit <= HISTORY_MAX_LIMIT:
+        raise HistoryQueryError(f"limit must be between 1 and {HISTORY_MAX_LIMIT}")
+    after = _parse_cursor(params['cursor'], bucket) if params.get('cursor') else None
+    return start, end, bucket, limit, after
+
+
+def _range_filter(queryset, start, end):
+    if start:
+        queryset = queryset.filter(timestamp__gte=start)
+    if end:
+        queryset = queryset.filter(timestamp__lt=end)
+    return queryset
+
+
+def raw_history(start, end, limit, after=None):
+    """Yield (cursor, row) for individual price rows, oldest first."""
+    queryset = _range_filter(EnergyPrice.objects.all(), start, end)
+    if after:
+        timestamp, pk = after
+        queryset = queryset.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk))
+    rows = (
+        queryset
+        .order_by('timestamp', 'id')
+        .values_list('id', 'timestamp', 'valid_until', 'buy_price', 'sell_price')[:limit + 1]
+    )
+    for pk, timestamp, valid_until, buy_price, sell_price in rows.iterator(chunk_size=HISTORY_CHUNK_SIZE):
+        yield f"{timestamp.isoformat()}|{pk}", {
+            'timestamp': timestamp.isoformat(),
+            'valid_until': valid_until.isoformat(),
+            'buy_price': float(buy_price),
+            'sell_price': float(sell_price),
+        }
+
+
+class _Bucket:
+    """Aggregates of one bucket, mergeable with merge_rollup."""
+
+    __slots__ = ('bucket', 'samples', 'buy_min', 'buy_max', 'buy_sum', 'sell_min', 'sell_max', 'sell_sum')
+
+    def __init__(self, values):
+        for name in self.__slots__:
+            setattr(self, name, values[name])
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def as_row(self):
+        key = self.bucket.isoformat()
+        return key, {
+            'bucket': key,
+            'samples': self.samples,
+            'buy_price': {
+                'min': float(self.buy_min),
+                'max': float(self.buy_max),
+                'avg': float(self.buy_sum) / self.samples,
+            },
+            'sell_price': {
+                'min': float(self.sell_min),
+                'max': float(self.sell_max),
+                'avg': float(self.sell_sum) / self.samples,
+            },
+        }
+
+
+def _aggregate(queryset, field, bucket, limit, after, **aggregates):
+    if after:
+        # Rows before the last returned bucket can't be in a later one
+        queryset = queryset.filter(**{f'{field}__gte': after})
+    # 'period' rather than 'bucket', which is a field on the rollup tables
+    queryset = queryset.annotate(period=BUCKETS[bucket](field))
+    if after:
+        queryset = queryset.filter(period__gt=after)
+    rows = queryset.values('period').annotate(**aggregates).order_by('period')[:limit + 1]
+    for values in rows.iterator(chunk_size=HISTORY_CHUNK_SIZE):
+        values['bucket'] = values.pop('period')
+        yield _Bucket(values)
+
+
+def _raw_buckets(start, end, bucket, limit, after):
+    queryset = _range_filter(EnergyPrice.objects.all(), start, end)
+    return _aggregate(
+        queryset, 'timestamp', bucket, limit, after,
+        samples=Count('id'),
+        buy_min=Min('buy_price'),
+        buy_max=Max('buy_price'),
+        buy_sum=Sum('buy_price'),
+        sell_min=Min('sell_price'),
+        sell_max=Max('sell_price'),
+        sell_sum=Sum('sell_price'),
+    )
+
+
+def _rollup_buckets(model, start, end, bucket, limit, after):
+    queryset = model.objects.all()
+    if start:
+        queryset = queryset.filter(bucket__gte=start)
+    if end:
+        queryset = queryset.filter(bucket__lt=end)
+    return _aggregate(
+        queryset, 'bucket', bucket, limit, after,
+        samples=Sum('samples'),
+        buy_min=Min('buy_min'),
+        buy_max=Max('buy_max'),
+        buy_sum=Sum('buy_sum'),
+        sell_min=Min('sell_min'),
+        sell_max=Max('sell_max'),
+        sell_sum=Sum('sell_sum'),
+    )
+
+
+def _merge_adjacent(buckets):
+    """Merge consecutive buckets with the same start (at the tier boundary)."""
+    previous = None
+    for current in buckets:
+        if previous is not None and previous.bucket == current.bucket:
+            merge_rollup(previous, current)
+            continue
+        if previous is not None:
+            yield previous
+        previous = current
+    if previous is not None:
+        yield previous
+
+
+def bucket_start(moment, bucket):
+    """The start of the bucket containing ``moment``, in the current time zone like Trunc."""
+    moment = timezone.localtime(moment).replace(second=0, microsecond=0)
+    if bucket == 'minute':
+        return moment
+    moment = moment.replace(minute=0)
+    if bucket == 'hour':
+        return moment
+    moment = moment.replace(hour=0)
+    if bucket == 'week':
+        return moment - timedelta(days=moment.weekday())
+    if bucket == 'month':
+        return moment.replace(day=1)
+    return moment
+
+
+def bucket_end(moment, bucket):
+    """The end of the bucket containing ``moment``, or ``moment`` at a bucket start."""
+    start = bucket_start(moment, bucket)
+    if start == moment:
+        return moment
+    if bucket == 'month':
+        return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    return start + {
+        'minute': timedelta(minutes=1), 'hour': timedelta(hours=1),
+        'day': timedelta(days=1), 'week': timedelta(weeks=1),
+    }[bucket]
+
+
+def bucketed_history(start, end, bucket, limit, after=None):
+    """Yield (cursor, row) per bucket with min/max/avg prices, oldest first."""
+    # Whole buckets only; the rollup tiers can't split one
+    start = bucket_start(start, bucket) if start else None
+    end = bucket_end(end, bucket) if end else None
+    model = ROLLUP_TIERS.get(bucket)
+    watermark = rollup_watermark() if model else None
+    if watermark is None or (start and start >= watermark):
+        buckets = _raw_buckets(start, end, bucket, limit, after)
+    else:
+        rolled_end = min(end, watermark) if end else watermark
+        raw_start = max(start, watermark) if start else watermark
+        buckets = _rollup_buckets(model, start, rolled_end, bucket, limit, after)
+        if not end or end > watermark:
+            buckets = _merge_adjacent(chain(buckets, _raw_buckets(raw_start, end, bucket, limit, after)))
+    for values in buckets:
+        yield values.as_row()
+
+
+def price_history(start, end, bucket, limit, after=None):
+    """Return the (cursor, row) iterator for a history query."""
+    if bucket == RAW:
+        return raw_history(start, end, limit, after)
+    return bucketed_history(start, end, bucket, limit, after)
+
+
+def _history_chunk(start, end, bucket, limit, after):
+    return list(price_history(start, end, bucket, limit, after))
+
+
+_async_history_chunk = run_sync(_history_chunk)
+
+
+def _history_document(start, end, bucket, limit, after):
+    """Generate the pieces of a history page's JSON document.
+
+    Yields text, or the (after, size) arguments of the next chunk query,
+    whose rows must be sent back in, so one loop serves both streams.
+    """
+    yield f'{{"bucket":{codec.dumps(bucket)},"results":['
+    last_key = None
+    count = 0
+    more = False
+    while count < limit:
+        size = min(HISTORY_CHUNK_SIZE, limit - count)
+        # One row more than needed tells whether there is a next chunk
+        rows = yield after, size
+        more = len(rows) > size
+        rows = rows[:size]
+        if rows:
+            yield (',' if count else '') + ','.join(codec.dumps(row) for _, row in rows)
+            last_key = rows[-1][0]
+            count += len(rows)
+        if not more:
+            break
+        after = _parse_cursor(last_key, bucket)
+    yield f'],"count":{count},"next_cursor":{codec.dumps(last_key if more else None)}}}'
+
+
+def iter_history_json(start, end, bucket, limit, after=None):
+    """Yield the JSON document of a history page, querying in the calling thread.
+
+    For WSGI, where an async iterator would be buffered in full.
+    """
+    document = _history_document(start, end, bucket, limit, after)
+    piece = next(document, None)
+    while piece is not None:
+        if isinstance(piece, str):
+            yield piece
+            piece = next(document, None)
+        else:
+            rows = _history_chunk(start, end, bucket, piece[1], piece[0])
+            piece = document.send(rows)
+
+
+async def stream_history_json(start, end, bucket, limit, after=None):
+    """Yield the JSON document of a history page, one chunk of rows at a time.
+
+    Each chunk of up to HISTORY_CHUNK_SIZE rows is a query of its own on the
+    database threads, continuing after the last row of the previous one.
+    """
+    document = _history_document(start, end, bucket, limit, after)
+    piece = next(document, None)
+    while piece is not None:
+        if isinstance(piece, str):
+            yield piece
+            piece = next(document, None)
+        else:
+            rows = await _async_history_chunk(start, end, bucket, piece[1], piece[0])
+            piece = document.send(rows)
@@ -0,0 +1,177 @@
+"""Process-wide idle timeout for websocket connections.
+
+Every connection is tracked in one ``IdleScheduler``: receiving a frame
+moves its deadline forward, and a connection that stays silent past its
+``idle_timeout`` is closed with code 4408. Touching a connection is a dict
+update; the heap holds at most one live entry per connection and stale
+entries are re-pushed with the current deadline when they reach the top,
+so the cost per connection is O(log n). A single loop timer, armed for the
+earliest deadline, replaces a watchdog task per connection.
+
+Clients that only listen would otherwise be closed, and ASGI servers
+answer protocol-level pings without telling the application. So half way
+to the deadline the server sends a silent connection a ``{"type": "ping"}``
+message (``send_keepalive``); any frame it sends back, normally a pong,
+counts as activity.
+
+Both timeouts are off unless set (OPP_WS_IDLE_TIMEOUT for HA site
+connections, OPP_WS_FRONTEND_IDLE_TIMEOUT for browsers): a client that
+doesn't answer pings and has nothing to say would be closed while healthy.
+Enable them once the clients answer pings. A dead connection is then
+noticed at most ``timeout`` seconds after its last frame, so pick a small
+timeout when that must happen within seconds.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+
+from django.conf import settings
+
+from .metrics import metrics
+
+_LOGGER = logging.getLogger(__name__)
+
+# Seconds without any frame after which an HA site connection is closed;
+# 0 leaves them open
+IDLE_TIMEOUT = getattr(settings, 'OPP_WS_IDLE_TIMEOUT', 0)
+# The same for browser connections; 0 leaves them open
+FRONTEND_IDLE_TIMEOUT = getattr(settings, 'OPP_WS_FRONTEND_IDLE_TIMEOUT', 0)
+
+IDLE_CLOSE_CODE = 4408
+
+
+class _Tracked:
+    __slots__ = ('active', 'timeout', 'consumer', 'pinged', 'scheduled')
+
+    def __init__(self, active, timeout, consumer):
+        self.active = active      # loop time of the last frame received
+        self.timeout = timeout
+        self.consumer = consumer
+        self.pinged = False       # sent a keepalive since the last frame
+        self.scheduled = None     # time of the live heap entry
+
+    @property
+    def due(self):
+        """When to ping the connection, or to close it once it was pinged."""
+        if self.pinged or not getattr(self.consumer, 'keepalive', False):
+            return self.active + self.timeout
+        return self.active + self.timeout / 2
+
+
+class IdleScheduler:
+    """Ping, then close, connections that received nothing for their timeout."""
+
+    def __init__(self):
+        self._heap = []       # (time, seq, key); entries not matching scheduled are dropped
+        self._tracked = {}    # key -> _Tracked
+        self._seq = itertools.count()
+        self._timer = None
+        self._tracked_gauge = metrics.gauge('ws_idle_tracked')
+
+    def __len__(self):
+        return len(self._tracked)
+
+    def track(self, consumer, timeout):
+        """Start the idle timer of a connection."""
+        loop = asyncio.get_running_loop()
+        if consumer.channel_name not in self._tracked:
+            self._tracked_gauge.inc()
+        entry = self._tracked[consumer.channel_name] = _Tracked(loop.time(), timeout, consumer)
+        self._push(entry, consumer.channel_name)
+        self._arm(loop)
+
+    def touch(self, consumer):
+        """Record activity on a connection."""
+        entry = self._tracked.get(consumer.channel_name)
+        if entry is None:
+            return
+        loop = asyncio.get_running_loop()
+        entry.active = loop.time()
+        if entry.pinged:
+            # The pending close is further out than the next ping
+            entry.pinged = False
+            self._push(entry, consumer.channel_name)
+            self._arm(loop)
+
+    def untrack(self, consumer):
+        """Stop watching a connection; its heap entry is skipped when it surfaces."""
+        if self._tracked.pop(consumer.channel_name, None) is not None:
+            self._tracked_gauge.dec()
+
+    def _push(self, entry, key):
+        entry.scheduled = entry.due
+        heapq.heappush(self._heap, (entry.scheduled, next(self._seq), key))
+
+    def _arm(self, loop):
+        if not self._heap:
+            return
+        when = self._heap[0][0]
+        if self._timer is not None:
+            if self._timer.when() <= when:
+                return
+            self._timer.cancel()
+        self._timer = loop.call_at(when, self._expire)
+
+    def _expire(self):
+        self._timer = None
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        while self._heap and self._heap[0][0] <= now:
+            scheduled, _, key = heapq.heappop(self._heap)
+            entry = self._tracked.get(key)
+            if entry is None or entry.scheduled != scheduled:
+                continue
+            if entry.due > now:
+                # Active since this entry was pushed
+                self._push(entry, key)
+                continue
+            consumer = entry.consumer
+            if not entry.pinged and getattr(consumer, 'keepalive', False):
+                entry.pinged = True
+                self._push(entry, key)
+                metrics.counter('ws_keepalive_pings', consumer=type(consumer).__name__).inc()
+                asyncio.ensure_future(self._ping(consumer))
+                continue
+            self.untrack(consumer)
+            metrics.counter('ws_idle_disconnects', consumer=type(consumer).__name__).inc()
+            _LOGGER.info(f"Closing {key}: idle for {entry.timeout} seconds")
+            asyncio.ensure_future(consumer.close(code=IDLE_CLOSE_CODE))
+        self._arm(loop)
+
+    async def _ping(self, consumer):
+        try:
+            await consumer.send_keepalive()
+        except Exception as e:
+            _LOGGER.debug(f"Failed to ping {consumer.channel_name}: {e}")
+
+
+idle_connections = IdleScheduler()
+
+
+class IdleTimeoutMixin:
+    """Close the connection when the client sends nothing for ``idle_timeout`` seconds.
+
+    With ``keepalive`` the client is sent a ping half way there. List it
+    before ``WireProtocolMixin``.
+    """
+
+    idle_timeout = IDLE_TIMEOUT
+    keepalive = True
+
+    async def send_keepalive(self):
+        """Ask a silent client for a frame; any answer restarts the timeout."""
+        await self.send_message({'type': 'ping'})
+
+    async def accept(self, subprotocol=None):
+        await super().accept(subprotocol)
+        if self.idle_timeout:
+            idle_connections.track(self, self.idle_timeout)
+
+    async def websocket_receive(self, message):
+        idle_connections.touch(self)
+        await super().websocket_receive(message)
+
+    async def websocket_disconnect(self, message):
+        idle_connections.untrack(self)
+        await super().websocket_disconnect(message)
@@ -0,0 +1,250 @@
+"""Streaming parsers and batched writer for bulk EnergyPrice uploads.
+
+The request body is read in fixed size chunks and parsed incrementally, so
+memory use depends on the batch size rather than on the upload size.
+Supported formats are a JSON array of objects, NDJSON (one object per line)
+and CSV with a header row.
+"""
+import codecs
+import csv
+import json
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import codec
+from .models import EnergyPrice
+
+# Bytes read from the request body at a time
+INGEST_CHUNK_SIZE = 64 * 1024
+# Rows written per bulk_create
+INGEST_BATCH_SIZE = getattr(settings, 'OPP_PRICE_INGEST_BATCH_SIZE', 1000)
+# Per-row errors included in the response; further errors are only counted
+INGEST_MAX_REPORTED_ERRORS = 100
+# Largest single JSON array element accepted, in characters
+INGEST_MAX_ROW_SIZE = 64 * 1024
+
+# Characters that can continue a JSON number
+NUMBER_CHARS = '0123456789+-.eE'
+
+FORMATS = ('json', 'ndjson', 'csv')
+CONTENT_TYPE_FORMATS = {
+    'application/json': 'json',
+    'application/x-ndjson': 'ndjson',
+    'application/ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+    'text/csv': 'csv',
+}
+
+
+class IngestError(ValueError):
+    """Raised when an upload cannot be parsed any further."""
+
+
+def detect_format(request):
+    """Pick the upload format from ?format= or the Content-Type header."""
+    fmt = request.GET.get('format')
+    if fmt:
+        if fmt not in FORMATS:
+            raise IngestError(f"Unsupported format: {fmt}")
+        return fmt
+    content_type = request.content_type or 'application/json'
+    return CONTENT_TYPE_FORMATS.get(content_type, 'json')
+
+
+def iter_text(stream, chunk_size=INGEST_CHUNK_SIZE):
+    """Yield decoded text chunks from a binary stream."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        yield decoder.decode(chunk)
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+def iter_lines(chunks):
+    """Yield complete lines, including their line endings, from text chunks."""
+    buffer = ''
+    for chunk in chunks:
+        lines = (buffer + chunk).splitlines(keepends=True)
+        buffer = lines.pop() if lines and not lines[-1].endswith(('\n', '\r')) else ''
+        yield from lines
+    if buffer:
+        yield buffer
+
+
+def iter_json_array(chunks):
+    """Yield the elements of a top-level JSON array without loading it whole."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    chunks = iter(chunks)
+    exhausted = False
+
+    def fill():
+        nonlocal buffer, pos, exhausted
+        chunk = next(chunks, None)
+        if chunk is None:
+            exhausted = True
+            return False
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        return True
+
+    def skip_whitespace():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer) or not fill():
+                return
+
+    skip_whitespace()
+    if pos >= len(buffer) or buffer[pos] != '[':
+        raise IngestError("Expected a JSON array")
+    pos += 1
+    started = False
+    while True:
+        skip_whitespace()
+        if pos >= len(buffer):
+            raise IngestError("Unterminated JSON array")
+        if buffer[pos] == ']':
+            return
+        if started:
+            if buffer[pos] != ',':
+                raise IngestError("Expected ',' or ']' in JSON array")
+            pos += 1
+            skip_whitespace()
+        while True:
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # The element may continue in the next chunk
+                if len(buffer) - pos > INGEST_MAX_ROW_SIZE or exhausted or not fill():
+                    raise IngestError("Invalid JSON in array element")
+                continue
+            if _may_continue(item, buffer, end) and not exhausted and fill():
+                # A number may be cut at the chunk boundary; decode again
+                continue
+            break
+        pos = end
+        started = True
+        yield item
+
+
+def _may_continue(item, buffer, end):
+    """Whether a decoded number may go on past the buffer, e.g. ``1`` of ``1.5``."""
+    if not isinstance(item, (int, float)) or isinstance(item, bool):
+        return False
+    return not buffer[end:].strip(NUMBER_CHARS)
+
+
+def iter_ndjson(chunks):
+    """Yield one decoded object (or a JSONDecodeError) per non-empty line."""
+    for line in iter_lines(chunks):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield codec.loads(line)
+        except codec.DecodeError as e:
+            yield e
+
+
+def iter_csv(chunks):
+    """Yield one dict per CSV row, keyed by the header row."""
+    yield from csv.DictReader(iter_lines(chunks))
+
+
+def iter_rows(stream, fmt):
+    chunks = iter_text(stream)
+    if fmt == 'ndjson':
+        return iter_ndjson(chunks)
+    if fmt == 'csv':
+        return iter_csv(chunks)
+    return iter_json_array(chunks)
+
+
+def _parse_decimal(value, field):
+    try:
+        return Decimal(str(value))
+    except (InvalidOperation, TypeError, ValueError):
+        raise ValueError(f"{field} is not a number")
+
+
+def _parse_datetime(value, field):
+    parsed = parse_datetime(value) if isinstance(value, str) else None
+    if parsed is None:
+        raise ValueError(f"{field} is not a valid datetime")
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def build_price(row):
+    """Validate one upload row and return an unsaved EnergyPrice."""
+    if isinstance(row, Exception):
+        raise ValueError(f"Invalid JSON: {row}")
+    if not isinstance(row, dict):
+        raise ValueError("Row is not an object")
+    for field in ('buy_price', 'sell_price', 'valid_until'):
+        if row.get(field) in (None, ''):
+            raise ValueError(f"{field} is required")
+    price = EnergyPrice(
+        buy_price=_parse_decimal(row['buy_price'], 'buy_price'),
+        sell_price=_parse_decimal(row['sell_price'], 'sell_price'),
+        valid_until=_parse_datetime(row['valid_until'], 'valid_until'),
+    )
+    if row.get('timestamp') not in (None, ''):
+        price.timestamp = _parse_datetime(row['timestamp'], 'timestamp')
+    if price.valid_until <= price.timestamp:
+        raise ValueError("valid_until must be after timestamp")
+    # Enforces max_digits/decimal_places like a single create would
+    price.full_clean(validate_unique=False, validate_constraints=False)
+    return price
+
+
+def ingest_prices(rows, batch_size=INGEST_BATCH_SIZE):
+    """Validate rows and insert the valid ones with batched bulk_create.
+
+    All batches are written in one transaction. Returns a summary dict with
+    the number of created and rejected rows and the first per-row errors.
+    """
+    from .signals import publish_prices
+
+    created = 0
+    rejected = 0
+    errors = []
+    batch = []
+    with transaction.atomic():
+        for number, row in enumerate(rows, start=1):
+            try:
+                batch.append(build_price(row))
+            except (ValueError, ValidationError) as e:
+                rejected += 1
+                if len(errors) < INGEST_MAX_REPORTED_ERRORS:
+                    message = '; '.join(e.messages) if isinstance(e, ValidationError) else str(e)
+                    errors.append({'row': number, 'error': message})
+                continue
+            if len(batch) >= batch_size:
+                EnergyPrice.objects.bulk_create(batch)
+                created += len(batch)
+                batch = []
+        if batch:
+            EnergyPrice.objects.bulk_create(batch)
+            created += len(batch)
+        if created:
+            # bulk_create sends no post_save signals; push the change once
+            transaction.on_commit(publish_prices)
+    return {
+        'created': created,
+        'rejected': rejected,
+        'errors': errors,
+    }
@@ -0,0 +1,108 @@
+"""Channel layer backends with an explicit group membership API.
+
+Consumers must not poke at layer internals (``channel_layer.groups`` only
+exists on the in-memory layer and only sees the current process).  Instead
+they use :func:`group_channels` / :func:`group_has_members`, which every
+backend in this module implements:
+
+- ``LocalChannelLayer``: in-process layer for development and tests, no
+  Redis needed.
+- ``ShardedChannelLayer``: Redis backed layer sharded over ``hosts`` by
+  consistent hashing, so any number of worker processes share groups.
+"""
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+
+try:
+    from channels_redis.core import RedisChannelLayer
+except ImportError:  # channels_redis is only needed for multi-process deployments
+    RedisChannelLayer = None
+
+
+class GroupMembershipMixin:
+    """Group membership queries shared by the layer backends."""
+
+    async def group_channels(self, group):
+        """Return the set of channel names currently in ``group``."""
+        raise NotImplementedError
+
+    async def group_size(self, group):
+        """Return the number of channels currently in ``group``."""
+        return len(await self.group_channels(group))
+
+    async def group_has_members(self, group):
+        """Return True if at least one channel is in ``group``."""
+        return await self.group_size(group) > 0
+
+
+class LocalChannelLayer(GroupMembershipMixin, InMemoryChannelLayer):
+    """In-memory layer with group membership queries, for a single process."""
+
+    async def group_channels(self, group):
+        self.require_valid_group_name(group)
+        members = self.groups.get(group, {})
+        cutoff = time.time() - self.group_expiry
+        return {
+            channel for channel, joined in members.items()
+            if not joined or joined >= cutoff
+        }
+
+
+if RedisChannelLayer is not None:
+
+    class ShardedChannelLayer(GroupMembershipMixin, RedisChannelLayer):
+        """Redis layer sharded over several hosts, usable from N processes.
+
+        Groups are stored by channels_redis as sorted sets scored by join
+        time on the shard picked by consistent hashing of the group name, so
+        a membership query is a single ZRANGEBYSCORE/ZCOUNT on one shard.
+        """
+
+        async def group_channels(self, group):
+            assert self.require_valid_group_name(group), "Group name not valid"
+            connection = self.connection(self.consistent_hash(group))
+            cutoff = time.time() - self.group_expiry
+            members = await connection.zrangebyscore(
+                self._group_key(group), min=cutoff, max="+inf"
+            )
+            return {
+                member.decode("utf8") if isinstance(member, bytes) else member
+                for member in members
+            }
+
+        async def group_size(self, group):
+            assert self.require_valid_group_name(group), "Group name not valid"
+            connection = self.connection(self.consistent_hash(group))
+            cutoff = time.time() - self.group_expiry
+            return await connection.zcount(self._group_key(group), cutoff, "+inf")
+
+
+async def group_channels(group, channel_layer=None):
+    """Return the channels in ``group`` for any configured channel layer."""
+    channel_layer = channel_layer or get_channel_layer()
+    if channel_layer is None:
+        return set()
+    if isinstance(channel_layer, GroupMembershipMixin):
+        return await channel_layer.group_channels(group)
+    # Plain InMemoryChannelLayer (e.g. an unmodified settings override)
+    groups = getattr(channel_layer, "groups", None)
+    if groups is not None:
+        return set(groups.get(group, {}))
+    raise NotImplementedError(
+        f"{type(channel_layer).__name__} does not support group membership queries"
+    )
+
+
+async def group_has_members(group, channel_layer=None):
+    """Return True if ``group`` has at least one member."""
+    channel_layer = channel_layer or get_channel_layer()
+    if isinstance(channel_layer, GroupMembershipMixin):
+        return await channel_layer.group_has_members(group)
+    return bool(await group_channels(group, channel_layer))
+
+
+def group_has_members_sync(group, channel_layer=None):
+    """Synchronous wrapper of :func:`group_has_members` for views and models."""
+    return async_to_sync(group_has_members)(group, channel_layer)
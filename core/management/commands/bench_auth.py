@@ -0,0 +1,97 @@
+"""Measure the latency of authenticate and of frontend connects.
+
+    python manage.py bench_auth --requests 200 --concurrency 1 20
+
+``authenticate`` opens an HA connection and authenticates an existing
+site (one site lookup, see core.registration). ``connect`` opens a frontend
+connection to the site (ownership check, upstream lookup). Each is run
+with the given numbers of clients at once. Admission limits are lifted
+for the run; the bench user is created with an @example.invalid address
+and deleted afterwards.
+"""
+import asyncio
+import time
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from core import admission as admission_module
+from core import consumers
+from core.admission import AdmissionController, TokenBuckets
+from core.management.commands.load_registration import percentile
+from core.models import Site
+from core.routing import websocket_urlpatterns
+
+BENCH_EMAIL = 'bench-auth@example.invalid'
+BENCH_SITE = 'bench-auth'
+
+
+class Command(BaseCommand):
+    help = "Time authenticate and frontend connect at several concurrencies"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--requests', type=int, default=200,
+            help="Requests per measurement (default: %(default)s)",
+        )
+        parser.add_argument(
+            '--concurrency', type=int, nargs='+', default=[1, 20],
+            help="Clients running at once (default: %(default)s)",
+        )
+
+    def handle(self, *args, **options):
+        self.application = URLRouter(websocket_urlpatterns)
+        user = get_user_model().objects.create(username=BENCH_EMAIL, email=BENCH_EMAIL)
+        self.user = user
+        self.site = Site.objects.create(user=user, name=BENCH_SITE)
+        admission = consumers.admission
+        unlimited = AdmissionController(concurrency=10000, queue_timeout=60)
+        unlimited.sources = unlimited.sites = TokenBuckets(0, 0)
+        consumers.admission = admission_module.admission = unlimited
+        # The consumers log every message to stdout
+        consumers.print = lambda *args, **kwargs: None
+        try:
+            results = asyncio.run(self.run(options['requests'], options['concurrency']))
+        finally:
+            del consumers.print
+            consumers.admission = admission_module.admission = admission
+            user.delete()
+        self.stdout.write(f"{'path':<13} {'clients':>7} {'p50 ms':>8} {'p99 ms':>8} {'req/s':>8}")
+        for path, concurrency, latencies, duration in results:
+            self.stdout.write(
+                f"{path:<13} {concurrency:>7} {percentile(latencies, 0.5) * 1000:>8.2f} "
+                f"{percentile(latencies, 0.99) * 1000:>8.2f} {len(latencies) / duration:>8.0f}"
+            )
+
+    async def run(self, requests, concurrencies):
+        results = []
+        for path, request in (('authenticate', self.authenticate), ('connect', self.connect_frontend)):
+            for concurrency in concurrencies:
+                latencies = []
+
+                async def client(count):
+                    for _ in range(count):
+                        start = time.perf_counter()
+                        await request()
+                        latencies.append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                await asyncio.gather(*(client(requests // concurrency) for _ in range(concurrency)))
+                results.append((path, concurrency, latencies, time.perf_counter() - start))
+        return results
+
+    async def authenticate(self):
+        communicator = WebsocketCommunicator(self.application, '/ws/opp_energy/')
+        await communicator.connect()
+        await communicator.send_json_to({'type': 'authenticate', 'email': BENCH_EMAIL, 'site_name': BENCH_SITE})
+        await communicator.receive_json_from(timeout=30)
+        await communicator.disconnect()
+
+    async def connect_frontend(self):
+        communicator = WebsocketCommunicator(self.application, f'/ws/frontend/{self.site.id}/')
+        communicator.scope['user'] = self.user
+        await communicator.connect()
+        await communicator.receive_json_from(timeout=30)
+        await communicator.disconnect()
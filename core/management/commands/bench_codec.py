@@ -0,0 +1,85 @@
+"""Compare the installed JSON backends on real message shapes.
+
+    python manage.py bench_codec --entities 1000 --number 200
+
+Also checks that every backend produces byte-identical output for these
+messages (see ``core.codec`` for the values where they differ).
+"""
+from datetime import datetime
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core import codec
+from core.prices import price_update_message
+
+
+def get_states_result(entities):
+    """A get_states result with ``entities`` sensor entities."""
+    now = datetime.now().isoformat()
+    return {
+        'id': 42,
+        'type': 'result',
+        'success': True,
+        'result': {
+            f'sensor.bench_{i}': {
+                'entity_id': f'sensor.bench_{i}',
+                'state': f'{i * 0.37:.2f}',
+                'attributes': {
+                    'friendly_name': f'Bench Sensor {i}',
+                    'unit_of_measurement': '°C',
+                    'device_class': 'temperature',
+                },
+                'last_changed': now,
+                'last_updated': now,
+            }
+            for i in range(entities)
+        },
+    }
+
+
+def call_service_message():
+    return {
+        'id': 43,
+        'type': 'call_service',
+        'domain': 'light',
+        'service': 'turn_on',
+        'service_data': {'entity_id': 'light.living_room', 'brightness': 180},
+    }
+
+
+class Command(BaseCommand):
+    help = "Time dumps/loads of each installed JSON backend on websocket message shapes"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--entities', type=int, default=1000,
+            help="Entities in the get_states message (default: %(default)s)",
+        )
+        parser.add_argument(
+            '--number', type=int, default=200,
+            help="Iterations per measurement (default: %(default)s)",
+        )
+
+    def handle(self, *args, **options):
+        messages = {
+            'price_update': price_update_message({'buy_price': 0.28, 'sell_price': 0.03}, 41),
+            f"get_states[{options['entities']}]": get_states_result(options['entities']),
+            'call_service': call_service_message(),
+        }
+        number = options['number']
+        backends = {name: codec.load_backend(name) for name in codec.available_backends()}
+        self.stdout.write(f"Active backend: {codec.backend}")
+        self.stdout.write(f"{'message':<18} {'backend':<8} {'bytes':>8} {'dumps us':>10} {'loads us':>10}")
+        for label, message in messages.items():
+            outputs = set()
+            for name, (dumps, dumpb, loads) in backends.items():
+                encoded = dumps(message)
+                outputs.add(encoded)
+                dump_time = timeit.timeit(lambda: dumps(message), number=number) / number * 1e6
+                load_time = timeit.timeit(lambda: loads(encoded), number=number) / number * 1e6
+                self.stdout.write(
+                    f"{label:<18} {name:<8} {len(encoded.encode()):>8} {dump_time:>10.1f} {load_time:>10.1f}"
+                )
+            if len(outputs) != 1:
+                raise CommandError(f"Backends disagree on the encoding of {label}")
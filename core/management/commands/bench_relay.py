@@ -0,0 +1,85 @@
+"""Compare the cost of relaying a command by group broadcast and by direct send.
+
+Each site group gets one HA connection plus N - 1 other members (frontend
+relays, reconnecting clients). The broadcast path is the old ``group_send``
+to the site group, where every member receives and decodes the command; the
+direct path resolves the upstream channel and sends to it alone.
+
+    python manage.py bench_relay --members 1 10 100 --commands 2000
+"""
+import asyncio
+import time
+
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from core.relay import UpstreamRegistry
+
+BENCH_SITE_ID = 'bench'
+
+
+class Command(BaseCommand):
+    help = "Measure per-command relay cost with 1, 10 and 100 members per site"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--members', type=int, nargs='+', default=[1, 10, 100],
+            help="Site group sizes to measure (default: %(default)s)",
+        )
+        parser.add_argument(
+            '--commands', type=int, default=2000,
+            help="Commands relayed per measurement (default: %(default)s)",
+        )
+
+    def handle(self, *args, **options):
+        results = asyncio.run(self.run(options['members'], options['commands']))
+        self.stdout.write(f"{'members':>8} {'group_send us':>14} {'direct us':>10} {'speedup':>8}")
+        for members, broadcast, direct in results:
+            self.stdout.write(
+                f"{members:>8} {broadcast:>14.1f} {direct:>10.1f} {broadcast / direct:>7.1f}x"
+            )
+
+    async def run(self, member_counts, commands):
+        channel_layer = get_channel_layer()
+        results = []
+        for members in member_counts:
+            group = f"bench_site_{members}"
+            channels = [await channel_layer.new_channel() for _ in range(members)]
+            for channel in channels:
+                await channel_layer.group_add(group, channel)
+            upstreams = UpstreamRegistry()
+            await upstreams.register(BENCH_SITE_ID, channels[0], channel_layer)
+            try:
+                broadcast = await self.time_broadcast(channel_layer, group, channels, commands)
+                direct = await self.time_direct(channel_layer, upstreams, channels[0], commands)
+            finally:
+                await upstreams.unregister(BENCH_SITE_ID, channels[0], channel_layer)
+                for channel in channels:
+                    await channel_layer.group_discard(group, channel)
+            results.append((members, broadcast, direct))
+        return results
+
+    @staticmethod
+    def command(number):
+        return {
+            'type': 'ha_command',
+            'command': {'id': number, 'type': 'get_states'},
+            'relay_channel': 'bench',
+            'command_id': number,
+        }
+
+    async def time_broadcast(self, channel_layer, group, channels, commands):
+        start = time.perf_counter()
+        for number in range(commands):
+            await channel_layer.group_send(group, self.command(number))
+            for channel in channels:
+                await channel_layer.receive(channel)
+        return (time.perf_counter() - start) / commands * 1e6
+
+    async def time_direct(self, channel_layer, upstreams, upstream, commands):
+        start = time.perf_counter()
+        for number in range(commands):
+            channel = await upstreams.resolve(BENCH_SITE_ID, channel_layer)
+            await channel_layer.send(channel, self.command(number))
+            await channel_layer.receive(upstream)
+        return (time.perf_counter() - start) / commands * 1e6
@@ -0,0 +1,42 @@
+"""Compare the websocket wire encodings on large state dumps.
+
+    python manage.py bench_wire --entities 1000 10000 --number 20
+
+Reports bytes on the wire and encode/decode time per frame for every
+encoding that can be negotiated, and checks that a message survives a round
+trip through each of them unchanged.
+"""
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.management.commands.bench_codec import get_states_result
+from core.wire import WIRES
+
+
+class Command(BaseCommand):
+    help = "Measure frame size and encode/decode time of each websocket encoding"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--entities', type=int, nargs='+', default=[1000, 10000],
+            help="Entities in the get_states dumps (default: %(default)s)",
+        )
+        parser.add_argument(
+            '--number', type=int, default=20,
+            help="Iterations per measurement (default: %(default)s)",
+        )
+
+    def handle(self, *args, **options):
+        number = options['number']
+        self.stdout.write(f"{'entities':>8} {'wire':<8} {'bytes':>10} {'encode us':>10} {'decode us':>10}")
+        for entities in options['entities']:
+            message = get_states_result(entities)
+            for name, wire in WIRES.items():
+                frame = wire.encode(message)
+                if wire.decode(frame) != message:
+                    raise CommandError(f"{name} does not round-trip the get_states message")
+                encode = timeit.timeit(lambda: wire.encode(message), number=number) / number * 1e6
+                decode = timeit.timeit(lambda: wire.decode(frame), number=number) / number * 1e6
+                size = len(frame) if wire.binary else len(frame.encode())
+                self.stdout.write(f"{entities:>8} {name:<8} {size:>10} {encode:>10.0f} {decode:>10.0f}")
@@ -0,0 +1,122 @@
+"""Measure authenticate latency of other sites during a registration burst.
+
+    python manage.py load_registration --registrations 40 --probes 40
+
+A probe site authenticates over and over while ``--registrations`` new
+users register at once. Registration hashes a password; authentication
+only runs queries, which share the database thread with the hashing when
+it isn't offloaded. The burst is run with hashing on that thread
+(OPP_HASHING_WORKERS = 0) and in the process pool, and the probe
+latencies are reported for each, next to a baseline without the burst.
+
+Admission limits are lifted for the run. Users are created with
+@example.invalid addresses and deleted afterwards; run it against a
+development database.
+"""
+import asyncio
+import contextlib
+import io
+import time
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from core import admission as admission_module
+from core import consumers
+from core.admission import AdmissionController, TokenBuckets
+from core.hashing import HASHING_WORKERS, PasswordHashingPool
+from core.routing import websocket_urlpatterns
+
+EMAIL_DOMAIN = '@example.invalid'
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Command(BaseCommand):
+    help = "Compare authenticate latency during a registration burst with and without the hashing pool"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--registrations', type=int, default=40,
+            help="Concurrent registrations in the burst (default: %(default)s)",
+        )
+        parser.add_argument(
+            '--probes', type=int, default=40,
+            help="Authentications of the probe site per measurement (default: %(default)s)",
+        )
+        parser.add_argument(
+            '--workers', type=int, default=HASHING_WORKERS or 2,
+            help="Hashing processes for the pooled run (default: %(default)s)",
+        )
+
+    def handle(self, *args, **options):
+        self.application = URLRouter(websocket_urlpatterns)
+        admission = consumers.admission
+        unlimited = AdmissionController(concurrency=10000, queue_timeout=60)
+        unlimited.sources = unlimited.sites = TokenBuckets(0, 0)
+        consumers.admission = admission_module.admission = unlimited
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = asyncio.run(self.run(options['registrations'], options['probes'], options['workers']))
+        finally:
+            consumers.admission = admission_module.admission = admission
+            get_user_model().objects.filter(email__endswith=EMAIL_DOMAIN).delete()
+        self.stdout.write(f"{'hashing':<10} {'burst':<6} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'burst s':>8}")
+        for label, burst, latencies, duration in results:
+            self.stdout.write(
+                f"{label:<10} {'yes' if burst else 'no':<6} {percentile(latencies, 0.5) * 1000:>8.1f} "
+                f"{percentile(latencies, 0.99) * 1000:>8.1f} {max(latencies) * 1000:>8.1f} "
+                f"{duration if burst else 0:>8.2f}"
+            )
+
+    async def run(self, registrations, probes, workers):
+        results = []
+        hashing_pool = consumers.hashing_pool
+        try:
+            for label, pool_workers in (('thread', 0), (f'pool({workers})', workers)):
+                consumers.hashing_pool = PasswordHashingPool(workers=pool_workers, max_queue=registrations + 1)
+                # Register the probe site and warm up the pool's processes
+                await self.register('probe')
+                results.append((label, False, await self.probe(probes), 0))
+                start = time.perf_counter()
+                burst = asyncio.gather(*(self.register(f'{label}-{n}') for n in range(registrations)))
+                latencies = await self.probe(probes)
+                await burst
+                results.append((label, True, latencies, time.perf_counter() - start))
+                consumers.hashing_pool.shutdown()
+        finally:
+            consumers.hashing_pool = hashing_pool
+        return results
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(self.application, '/ws/opp_energy/')
+        await communicator.connect()
+        return communicator
+
+    async def register(self, name):
+        communicator = await self.connect()
+        await communicator.send_json_to({
+            'type': 'user_registration', 'id': 1, 'user_name': name,
+            'email': f'load-{name}{EMAIL_DOMAIN}', 'password': f'load-{name}-password', 'site_name': name,
+        })
+        await communicator.receive_json_from(timeout=60)
+        await communicator.disconnect()
+
+    async def probe(self, probes):
+        """Time connect plus authenticate of the probe site, one after another."""
+        latencies = []
+        for _ in range(probes):
+            start = time.perf_counter()
+            communicator = await self.connect()
+            await communicator.send_json_to({
+                'type': 'authenticate', 'email': f'load-probe{EMAIL_DOMAIN}', 'site_name': 'probe',
+            })
+            await communicator.receive_json_from(timeout=60)
+            latencies.append(time.perf_counter() - start)
+            await communicator.disconnect()
+        return latencies
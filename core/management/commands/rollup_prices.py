@@ -0,0 +1,39 @@
+"""Roll old EnergyPrice rows into hourly/daily aggregates and delete them.
+
+Meant to run periodically, e.g. from cron:
+
+    0 3 * * * python manage.py rollup_prices
+"""
+from django.core.management.base import BaseCommand
+
+from core.retention import PRICE_RETENTION_BATCH_SIZE, PRICE_RETENTION_DAYS, rollup_prices
+
+
+class Command(BaseCommand):
+    help = "Roll up EnergyPrice rows older than the retention age and delete the raw rows"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=PRICE_RETENTION_DAYS,
+            help="Keep raw rows for this many days (default: %(default)s)",
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=PRICE_RETENTION_BATCH_SIZE,
+            help="Raw rows deleted per statement (default: %(default)s)",
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help="Only report how many hours would be rolled up",
+        )
+
+    def handle(self, *args, **options):
+        summary = rollup_prices(
+            days=options['days'],
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run'],
+        )
+        action = "Would roll up" if options['dry_run'] else "Rolled up"
+        self.stdout.write(self.style.SUCCESS(
+            f"{action} {summary['hours']} hours before {summary['cutoff'].isoformat()}, "
+            f"deleted {summary['deleted']} raw rows"
+        ))
@@ -0,0 +1,147 @@
+"""In-process counters, gauges and latency histograms.
+
+Metrics are kept per worker process in a ``MetricsRegistry`` and exposed as
+a JSON snapshot by the ``metrics`` view. Every metric is identified by a
+name plus optional labels, e.g. ``histogram('ws_message_seconds',
+type='get_prices')``. Label values must come from a bounded set (message
+types we handle, not whatever a client sends).
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+
+# Upper bounds, in seconds, of the default latency buckets
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Counter:
+    """Monotonically increasing count."""
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    """Value that can go up and down, e.g. a queue depth."""
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+    """Count of observations per bucket, plus their number and sum.
+
+    ``buckets`` are inclusive upper bounds; larger observations land in a
+    final overflow bucket. Observing is a binary search and an increment, so
+    its cost doesn't depend on how many values were recorded.
+    """
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    @contextmanager
+    def time(self):
+        """Observe the wall time spent in the ``with`` block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def quantile(self, q):
+        """Estimate quantile ``q`` (0-1) as the upper bound of its bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': {
+                **{str(bound): count for bound, count in zip(self.buckets, self.counts)},
+                '+Inf': self.counts[-1],
+            },
+        }
+
+
+class MetricsRegistry:
+    """Metrics of one process, created on first use."""
+
+    def __init__(self):
+        self._metrics = {}  # (kind, name, labels) -> metric
+        self._lock = threading.Lock()
+
+    def _get(self, kind, factory, name, labels):
+        key = (kind, name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(key, factory())
+        return metric
+
+    def counter(self, name, **labels):
+        return self._get('counter', Counter, name, labels)
+
+    def gauge(self, name, **labels):
+        return self._get('gauge', Gauge, name, labels)
+
+    def histogram(self, name, buckets=LATENCY_BUCKETS, **labels):
+        return self._get('histogram', lambda: Histogram(buckets), name, labels)
+
+    def snapshot(self):
+        """Return all metrics as ``{kind: {name: [{labels, value}]}}``."""
+        result = {}
+        for (kind, name, labels), metric in list(self._metrics.items()):
+            result.setdefault(kind, {}).setdefault(name, []).append({
+                'labels': dict(labels),
+                'value': metric.snapshot(),
+            })
+        return result
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-17 17:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_rename_instance_id_site_site_id'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='energyprice',
+            index=models.Index(fields=['valid_until', 'timestamp'], name='core_price_valid_until_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='energyprice',
+            index=models.Index(fields=['timestamp'], name='core_price_timestamp_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 17:35
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_energyprice_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='energyprice',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-17 17:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_energyprice_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EnergyPriceDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField(unique=True)),
+                ('samples', models.PositiveIntegerField()),
+                ('buy_min', models.DecimalField(decimal_places=4, max_digits=10)),
+                ('buy_max', models.DecimalField(decimal_places=4, max_digits=10)),
+                ('buy_sum', models.DecimalField(decimal_places=4, max_digits=20)),
+                ('sell_min', models.DecimalField(decimal_places=4, max_digits=10)),
+                ('sell_max', models.DecimalField(decimal_places=4, max_digits=10)),
+                ('sell_sum', models.DecimalField(decimal_places=4, max_digits=20)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='EnergyPriceHourly',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField(unique=True)),
+                ('samples', models.PositiveIntegerField()),
+                ('buy_min', models.DecimalField(decimal_places=4, max_digits=10)),
+                ('buy_max', models.DecimalField(decimal_places=4, max_digits=10)),
+                ('buy_sum', models.DecimalField(decimal_places=4, max_digits=20)),
+                ('sell_min', models.DecimalField(decimal_places=4, max_digits=10)),
+                ('sell_max', models.DecimalField(decimal_places=4, max_digits=10)),
+                ('sell_sum', models.DecimalField(decimal_places=4, max_digits=20)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
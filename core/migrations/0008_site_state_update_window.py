@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 17:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_energyprice_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='site',
+            name='state_update_window',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -2,6 +2,7 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 from django.conf import settings
+from django.utils import timezone
 
 class CustomUser(AbstractUser):
     """Custom user model extending Django's AbstractUser"""
@@ -15,11 +16,42 @@ class EnergyPrice(models.Model):
     """Class representing Energy Prices"""
     buy_price = models.DecimalField(max_digits=10, decimal_places=4)
     sell_price = models.DecimalField(max_digits=10, decimal_places=4)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Start of the period the price applies to; defaults to the time of insertion
+    timestamp = models.DateTimeField(default=timezone.now)
     valid_until = models.DateTimeField()
 
+    class Meta:
+        indexes = [
+            # Current price / schedule lookups: valid_until > now, ordered by timestamp
+            models.Index(fields=['valid_until', 'timestamp'], name='core_price_valid_until_idx'),
+            models.Index(fields=['timestamp'], name='core_price_timestamp_idx'),
+        ]
+
     def __str__(self) -> str:
         return f"Buy: {self.buy_price}, Sell: {self.sell_price}"
+
+class EnergyPriceRollup(models.Model):
+    """Aggregated EnergyPrice rows for one time bucket"""
+    bucket = models.DateTimeField(unique=True)
+    samples = models.PositiveIntegerField()
+    buy_min = models.DecimalField(max_digits=10, decimal_places=4)
+    buy_max = models.DecimalField(max_digits=10, decimal_places=4)
+    buy_sum = models.DecimalField(max_digits=20, decimal_places=4)
+    sell_min = models.DecimalField(max_digits=10, decimal_places=4)
+    sell_max = models.DecimalField(max_digits=10, decimal_places=4)
+    sell_sum = models.DecimalField(max_digits=20, decimal_places=4)
+
+    class Meta:
+        abstract = True
+
+    def __str__(self) -> str:
+        return f"{self.bucket}: {self.samples} samples"
+
+class EnergyPriceHourly(EnergyPriceRollup):
+    """EnergyPrice rows rolled up per hour by the rollup_prices command"""
+
+class EnergyPriceDaily(EnergyPriceRollup):
+    """EnergyPrice rows rolled up per day by the rollup_prices command"""
     
 class Site(models.Model):
     """Class representing a Home Assistant Energy Management Site"""
@@ -33,32 +65,30 @@ class Site(models.Model):
     site_id = models.CharField(max_length=100, unique=True, null=True, blank=True)
     ws_connected = models.BooleanField(default=False)
     last_connected = models.DateTimeField(null=True, blank=True)
+    # Milliseconds state updates are coalesced for on frontend sockets;
+    # blank uses OPP_STATE_COALESCE_WINDOW
+    state_update_window = models.PositiveIntegerField(null=True, blank=True)
     
     # Reference to the registered websocket connection in memory
     # This is a transient property, not stored in the database
     @property
     def websocket_connection(self):
         """Get the active websocket connection for this site."""
-        from channels.layers import get_channel_layer
-        
+        from core.layers import group_has_members_sync
+        from core.relay import upstream_group
+
         # Generate the expected group name for this site
         group_name = f"site_{self.id}"
-        
-        # Get the channel layer
-        channel_layer = get_channel_layer()
-        if not channel_layer:
-            return None
-        
-        # For InMemoryChannelLayer, check if there are active channels in the group
-        group_channels = channel_layer.groups.get(group_name, set())
-        
-        # If no active channels, return None
-        if not group_channels:
+
+        # Ask the channel layer whether the site's HA connection is in its
+        # upstream group. This goes through the layer's membership API so it
+        # also works across worker processes with the sharded backend.
+        if not group_has_members_sync(upstream_group(self.id)):
             return None
-        
+
         # If there are active channels, return the group name
         # This maintains compatibility with any existing code that expects the group name
         return group_name
-    
+
     def __str__(self) -> str:
         return f"{self.name} ({self.user})"
\ No newline at end of file
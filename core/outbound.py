@@ -0,0 +1,205 @@
+"""Bounded outbound frame queues for websocket consumers.
+
+Handlers don't await the socket directly: frames are appended to a
+per-connection queue and written by one writer task, so a client on a bad
+network backs up its own queue instead of whatever handler is sending to
+it. The queue is bounded:
+
+- Low-priority frames (state traffic) can carry a key; a queued frame with
+  the same key is replaced in place, so only the latest is sent. Once the
+  queue is half way to any of the limits below, new low-priority frames
+  are dropped.
+- Everything else, e.g. command responses, is always queued.
+- A client that falls too far behind (OPP_WS_MAX_QUEUE_BYTES or
+  OPP_WS_MAX_QUEUE_FRAMES queued, or a frame waiting longer than
+  OPP_WS_MAX_QUEUE_DELAY seconds) is disconnected with close code 4008.
+
+Queued frames and bytes per consumer class are exported as gauges in
+``core.metrics``, with counters for dropped, coalesced and disconnected.
+"""
+import asyncio
+from collections import deque
+import logging
+import time
+
+from django.conf import settings
+
+from .metrics import metrics
+
+_LOGGER = logging.getLogger(__name__)
+
+# Per-connection limits after which a client is disconnected as too slow
+MAX_QUEUE_BYTES = getattr(settings, 'OPP_WS_MAX_QUEUE_BYTES', 4 * 1024 * 1024)
+MAX_QUEUE_FRAMES = getattr(settings, 'OPP_WS_MAX_QUEUE_FRAMES', 1000)
+MAX_QUEUE_DELAY = getattr(settings, 'OPP_WS_MAX_QUEUE_DELAY', 30)
+# Share of the limits above which low-priority frames are dropped
+LOW_PRIORITY_SHARE = 0.5
+# Seconds close() waits for queued frames to be written
+CLOSE_DRAIN_TIMEOUT = 2
+
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+
+class QueuedFrame:
+    __slots__ = ('frame', 'size', 'key', 'queued_at', 'written')
+
+    def __init__(self, frame, key):
+        self.frame = frame
+        self.size = len(frame)
+        self.key = key
+        self.queued_at = time.monotonic()
+        self.written = None  # future, created when someone waits for it
+
+
+class OutboundQueue:
+    """Frames waiting to be written to one connection."""
+
+    def __init__(self, write, on_overflow, label,
+                 max_bytes=MAX_QUEUE_BYTES, max_frames=MAX_QUEUE_FRAMES, max_delay=MAX_QUEUE_DELAY):
+        self.write = write
+        self.on_overflow = on_overflow
+        self.max_bytes = max_bytes
+        self.max_frames = max_frames
+        self.max_delay = max_delay
+        self.bytes = 0
+        self.closed = False
+        self._frames = deque()
+        self._keyed = {}  # key -> QueuedFrame still in the queue
+        self._writer = None
+        self._queued_frames = metrics.gauge('ws_outbound_queued_frames', consumer=label)
+        self._queued_bytes = metrics.gauge('ws_outbound_queued_bytes', consumer=label)
+        self._delay = metrics.histogram('ws_outbound_delay_seconds', consumer=label)
+        self._dropped = metrics.counter('ws_outbound_dropped', consumer=label)
+        self._coalesced = metrics.counter('ws_outbound_coalesced', consumer=label)
+        self._disconnects = metrics.counter('ws_slow_consumer_disconnects', consumer=label)
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, frame, low_priority=False, key=None):
+        """Queue a frame; returns its QueuedFrame, or None if it was not queued."""
+        if self.closed:
+            return None
+        if low_priority:
+            queued = self._keyed.get(key) if key is not None else None
+            if queued is not None:
+                self._account(0, len(frame) - queued.size)
+                queued.frame, queued.size = frame, len(frame)
+                self._coalesced.inc()
+                return queued
+            if self._overloaded(len(frame), LOW_PRIORITY_SHARE):
+                self._dropped.inc()
+                return None
+        entry = QueuedFrame(frame, key if low_priority else None)
+        if self._overloaded(entry.size):
+            self._overflow()
+            return None
+        self._frames.append(entry)
+        if entry.key is not None:
+            self._keyed[entry.key] = entry
+        self._account(1, entry.size)
+        if self._writer is None:
+            self._writer = asyncio.ensure_future(self._run())
+        return entry
+
+    def tail_key(self):
+        """Key of the last queued frame; None if it has none or nothing is queued."""
+        return self._frames[-1].key if self._frames else None
+
+    async def wait_written(self, entry):
+        """Wait until ``entry`` has been written (or discarded)."""
+        if entry.written is None:
+            entry.written = asyncio.get_running_loop().create_future()
+        await asyncio.shield(entry.written)
+
+    async def drain(self, timeout=CLOSE_DRAIN_TIMEOUT):
+        """Wait up to ``timeout`` seconds for the queue to empty."""
+        if self._writer is not None:
+            await asyncio.wait([self._writer], timeout=timeout)
+
+    def discard(self):
+        """Drop every queued frame and stop writing, e.g. on disconnect."""
+        self.closed = True
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+        while self._frames:
+            self._done(self._frames.popleft())
+        self._keyed.clear()
+
+    def _overloaded(self, size, share=1):
+        if len(self._frames) >= self.max_frames * share or self.bytes + size > self.max_bytes * share:
+            return True
+        return bool(self._frames) and time.monotonic() - self._frames[0].queued_at > self.max_delay * share
+
+    def _overflow(self):
+        _LOGGER.warning(f"Disconnecting slow consumer with {len(self._frames)} frames ({self.bytes} bytes) queued")
+        self._disconnects.inc()
+        self.discard()
+        asyncio.ensure_future(self.on_overflow())
+
+    def _account(self, frames, size):
+        self.bytes += size
+        self._queued_frames.inc(frames)
+        self._queued_bytes.inc(size)
+
+    def _done(self, entry):
+        self._account(-1, -entry.size)
+        if entry.written is not None and not entry.written.done():
+            entry.written.set_result(None)
+
+    async def _run(self):
+        try:
+            while self._frames:
+                entry = self._frames.popleft()
+                if entry.key is not None:
+                    del self._keyed[entry.key]
+                try:
+                    await self.write(entry.frame)
+                finally:
+                    self._delay.observe(time.monotonic() - entry.queued_at)
+                    self._done(entry)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            _LOGGER.warning(f"Failed to write queued frame: {e}")
+            self.discard()
+        finally:
+            if self._writer is asyncio.current_task():
+                self._writer = None
+
+
+class OutboundQueueMixin:
+    """Queue a consumer's outgoing frames instead of awaiting the socket.
+
+    List it before ``WireProtocolMixin``; ``send_message`` and
+    ``send_frame`` then accept ``low_priority``, ``key`` and ``wait``
+    (return only once the frame was written), and return False if the
+    frame was dropped.
+    """
+
+    outbound = None
+
+    async def write_frame(self, frame, low_priority=False, key=None, wait=False):
+        if self.outbound is None:
+            self.outbound = OutboundQueue(super().write_frame, self.close_slow_consumer, type(self).__name__)
+        entry = self.outbound.put(frame, low_priority, key)
+        if entry is None:
+            return False
+        if wait:
+            await self.outbound.wait_written(entry)
+        return True
+
+    async def close_slow_consumer(self):
+        await super().close(code=SLOW_CONSUMER_CLOSE_CODE)
+
+    async def close(self, code=None, reason=None):
+        """Close after writing what is queued, within CLOSE_DRAIN_TIMEOUT."""
+        if self.outbound is not None:
+            await self.outbound.drain()
+        await super().close(code=code, reason=reason)
+
+    async def websocket_disconnect(self, message):
+        if self.outbound is not None:
+            self.outbound.discard()
+        await super().websocket_disconnect(message)
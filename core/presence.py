@@ -0,0 +1,163 @@
+"""In-memory registry of online sites.
+
+Consumers report connects, heartbeats and disconnects here instead of saving
+the Site row on every event. A background flusher periodically writes the
+coalesced ``ws_connected``/``last_connected`` values with one bulk update, so
+a reconnect storm costs one query per flush interval rather than one per
+event.
+
+A process only answers for the sites it holds a live connection to; for
+every other site the flushed row decides, and a row whose last_connected
+is older than PRESENCE_TTL counts as offline, so a worker that died
+before flushing doesn't leave its sites connected forever.
+"""
+import asyncio
+from datetime import timedelta
+import logging
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+_LOGGER = logging.getLogger(__name__)
+
+# Seconds without a heartbeat after which a site is considered offline
+PRESENCE_TTL = getattr(settings, 'OPP_PRESENCE_TTL', 120)
+# Seconds between bulk writes of presence changes to the Site table
+PRESENCE_FLUSH_INTERVAL = getattr(settings, 'OPP_PRESENCE_FLUSH_INTERVAL', 5)
+PRESENCE_FLUSH_BATCH_SIZE = 500
+
+
+class PresenceRegistry:
+    """Track which sites have a live connection in this process."""
+
+    def __init__(self, ttl=PRESENCE_TTL, flush_interval=PRESENCE_FLUSH_INTERVAL):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._connections = {}  # site pk -> number of open connections
+        self._expires = {}      # site pk -> time.monotonic() deadline
+        self._last_seen = {}    # site pk -> aware datetime of last heartbeat
+        self._dirty = {}        # site pk -> (connected, last_connected) to persist
+        self._flusher = None
+
+    def online(self, site_pk):
+        """Register a new connection for a site."""
+        self._connections[site_pk] = self._connections.get(site_pk, 0) + 1
+        self.heartbeat(site_pk)
+        self.ensure_flusher()
+
+    def heartbeat(self, site_pk):
+        """Refresh the TTL of a connected site."""
+        if site_pk not in self._connections:
+            return
+        now = timezone.now()
+        self._expires[site_pk] = time.monotonic() + self.ttl
+        self._last_seen[site_pk] = now
+        self._dirty[site_pk] = (True, now)
+
+    def offline(self, site_pk):
+        """Drop a connection for a site; the site goes offline with its last one."""
+        remaining = self._connections.get(site_pk, 0) - 1
+        if remaining > 0:
+            self._connections[site_pk] = remaining
+            return
+        self._connections.pop(site_pk, None)
+        self._expires.pop(site_pk, None)
+        self._dirty[site_pk] = (False, self._last_seen.get(site_pk) or timezone.now())
+
+    def is_online(self, site_pk):
+        """Return True if this process holds a live connection of the site, otherwise None.
+
+        Without one the site may well be connected to another worker, so
+        the caller has to ask the database.
+        """
+        deadline = self._expires.get(site_pk)
+        if deadline is not None and deadline > time.monotonic():
+            return True
+        return None
+
+    def last_seen(self, site_pk):
+        return self._last_seen.get(site_pk)
+
+    def status(self, site):
+        """Return ``(connected, last_connected)`` for a Site instance.
+
+        Sites without a live connection in this process (e.g. when the view
+        is served by a different worker) fall back to the values last
+        flushed to the DB, which only count while they are fresher than
+        the TTL.
+        """
+        if self.is_online(site.pk):
+            return True, self._last_seen.get(site.pk) or site.last_connected
+        last_connected = site.last_connected
+        fresh = last_connected is not None and timezone.now() - last_connected < timedelta(seconds=self.ttl)
+        return bool(site.ws_connected and fresh), last_connected
+
+    def _expire(self):
+        """Mark sites whose heartbeat TTL elapsed as offline and forget offline sites."""
+        now = time.monotonic()
+        for site_pk, deadline in list(self._expires.items()):
+            if deadline <= now:
+                del self._expires[site_pk]
+                self._dirty[site_pk] = (False, self._last_seen.get(site_pk))
+        # Their last heartbeat is in _dirty now; the DB has it after this flush
+        for site_pk in [site_pk for site_pk in self._last_seen if site_pk not in self._expires]:
+            del self._last_seen[site_pk]
+
+    def ensure_flusher(self):
+        """Start the background flusher on the running event loop if needed."""
+        if self._flusher is not None and not self._flusher.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._flusher = loop.create_task(self._run_flusher())
+
+    async def _run_flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                _LOGGER.error(f"Error flushing site presence: {e}")
+
+    async def flush(self):
+        """Write pending presence changes to the Site table."""
+        self._expire()
+        if not self._dirty:
+            return 0
+        dirty, self._dirty = self._dirty, {}
+        try:
+            return await self._write(dirty)
+        except Exception:
+            # Keep the newer values if a heartbeat arrived during the write
+            for site_pk, value in dirty.items():
+                self._dirty.setdefault(site_pk, value)
+            raise
+
+    @database_sync_to_async
+    def _write(self, dirty):
+        from core.models import Site
+
+        sites = [
+            Site(pk=site_pk, ws_connected=connected, last_connected=last_connected)
+            for site_pk, (connected, last_connected) in dirty.items()
+        ]
+        # Sites without a known last_connected keep their stored value
+        with_time = [site for site in sites if site.last_connected is not None]
+        without_time = [site for site in sites if site.last_connected is None]
+        if with_time:
+            Site.objects.bulk_update(
+                with_time, ['ws_connected', 'last_connected'],
+                batch_size=PRESENCE_FLUSH_BATCH_SIZE,
+            )
+        if without_time:
+            Site.objects.bulk_update(
+                without_time, ['ws_connected'], batch_size=PRESENCE_FLUSH_BATCH_SIZE,
+            )
+        return len(sites)
+
+
+presence = PresenceRegistry()
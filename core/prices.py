@@ -0,0 +1,271 @@
+"""Energy price lookup and the process-wide price broadcaster.
+
+Price subscribers join the ``prices`` group and a group of their worker
+process. A single ticker per process fetches the current prices, serializes
+the ``price_update`` message once and sends it to the process's group, so
+the cost of a tick does not grow with the number of subscribed connections,
+and a subscriber gets one update per interval however many workers tick.
+
+Changes to EnergyPrice are pushed to the group as soon as they are committed
+(see ``core.signals``), together with a ``price_schedule`` message listing
+the upcoming tariff rows, so clients do not have to poll for them.
+
+The price in effect is resolved with an indexed query and kept in an
+in-process cache until the next ``valid_until``/start boundary, so the hot
+paths (get_prices, subscribe_prices, the ticker and the HTTP API) normally
+do not touch the database.
+"""
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils import timezone
+
+from . import codec
+
+_LOGGER = logging.getLogger(__name__)
+
+PRICES_GROUP = 'prices'
+# Seconds between price broadcasts to subscribers
+PRICE_UPDATE_INTERVAL = getattr(settings, 'OPP_PRICE_UPDATE_INTERVAL', 30)
+# Seconds to wait before retrying after a failed broadcast
+PRICE_RETRY_INTERVAL = 5
+# Maximum number of upcoming EnergyPrice rows sent in a price_schedule message
+PRICE_SCHEDULE_LIMIT = getattr(settings, 'OPP_PRICE_SCHEDULE_LIMIT', 288)
+# Upper bound in seconds on how long a resolved current price is cached. Writes
+# in this process invalidate immediately; this bounds staleness for writes
+# made by other processes.
+PRICE_CACHE_MAX_AGE = getattr(settings, 'OPP_PRICE_CACHE_MAX_AGE', 60)
+
+# Prices reported when no EnergyPrice row is in effect
+DEFAULT_PRICES = {
+    "buy_price": 0.28,
+    "sell_price": 0.03
+}
+
+
+def _price_row(price):
+    return {
+        "buy_price": float(price.buy_price),
+        "sell_price": float(price.sell_price),
+        "valid_from": price.timestamp.isoformat(),
+        "valid_until": price.valid_until.isoformat(),
+    }
+
+
+class CurrentPriceResolver:
+    """Resolve the price in effect now, cached until the next price boundary."""
+
+    def __init__(self, max_age=PRICE_CACHE_MAX_AGE):
+        self.max_age = max_age
+        self._prices = None
+        self._expires = None  # aware datetime after which _prices is stale
+
+    def cached(self):
+        """Return the cached prices, or None if they must be resolved again."""
+        prices, expires = self._prices, self._expires
+        if prices is None or expires is None or timezone.now() >= expires:
+            return None
+        return prices
+
+    def invalidate(self):
+        self._prices = None
+        self._expires = None
+
+    def resolve(self):
+        """Return the prices in effect now, querying the DB on a cache miss."""
+        prices = self.cached()
+        if prices is not None:
+            return prices
+        prices, expires = self._query(timezone.now())
+        self._prices, self._expires = prices, expires
+        return prices
+
+    def _query(self, now):
+        from core.models import EnergyPrice
+
+        # Served by the (valid_until, timestamp) index
+        price = (
+            EnergyPrice.objects
+            .filter(valid_until__gt=now, timestamp__lte=now)
+            .order_by('-timestamp')
+            .only('buy_price', 'sell_price', 'valid_until')
+            .first()
+        )
+        # The next row to start may take over before the current one ends
+        next_start = (
+            EnergyPrice.objects
+            .filter(timestamp__gt=now)
+            .order_by('timestamp')
+            .values_list('timestamp', flat=True)
+            .first()
+        )
+        expires = now + timedelta(seconds=self.max_age)
+        if price is None:
+            prices = dict(DEFAULT_PRICES)
+        else:
+            prices = {
+                "buy_price": float(price.buy_price),
+                "sell_price": float(price.sell_price)
+            }
+            expires = min(expires, price.valid_until)
+        if next_start is not None:
+            expires = min(expires, next_start)
+        return prices, expires
+
+
+price_resolver = CurrentPriceResolver()
+
+
+def current_prices():
+    """Return the prices in effect now, falling back to DEFAULT_PRICES."""
+    return dict(price_resolver.resolve())
+
+
+def price_schedule():
+    """Return the rows that are in effect now or later, oldest first."""
+    from core.models import EnergyPrice
+
+    prices = (
+        EnergyPrice.objects
+        .filter(valid_until__gt=timezone.now())
+        .order_by('timestamp')[:PRICE_SCHEDULE_LIMIT]
+    )
+    return [_price_row(price) for price in prices]
+
+
+async def get_current_prices():
+    """Async current_prices that skips the thread hop on a cache hit."""
+    prices = price_resolver.cached()
+    if prices is not None:
+        return dict(prices)
+    return await database_sync_to_async(current_prices)()
+
+
+get_price_schedule = database_sync_to_async(price_schedule)
+
+
+def price_update_message(prices, message_id=None):
+    """Build a price_update message in the format the coordinator expects."""
+    message = {
+        "type": "price_update",
+        "data": {  # Wrap in a data field to match what coordinator expects
+            "buy_price": prices["buy_price"],
+            "sell_price": prices["sell_price"],
+            "timestamp": datetime.now().isoformat()
+        }
+    }
+    if message_id is not None:
+        message["id"] = message_id
+    return message
+
+
+def price_schedule_message(prices, schedule):
+    """Build a price_schedule message with the current prices and upcoming rows."""
+    return {
+        "type": "price_schedule",
+        "data": {
+            "current": prices,
+            "schedule": schedule,
+            "timestamp": datetime.now().isoformat()
+        }
+    }
+
+
+async def price_frames():
+    """Return the serialized price_update and price_schedule messages."""
+    prices = await get_current_prices()
+    schedule = await get_price_schedule()
+    return [
+        codec.dumps(price_update_message(prices)),
+        codec.dumps(price_schedule_message(prices, schedule)),
+    ]
+
+
+class PriceBroadcaster:
+    """Send price updates to this process's subscribers from one ticker per process.
+
+    Changes are published to the cluster-wide ``prices`` group; periodic
+    updates go to a group of this process only, which every worker's ticker
+    would otherwise send to each subscriber again.
+    """
+
+    def __init__(self, interval=PRICE_UPDATE_INTERVAL):
+        self.interval = interval
+        self._subscribers = set()  # channel names subscribed from this process
+        self._ticker = None
+        self._local_group = None
+        self._pid = None
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    @property
+    def local_group(self):
+        """The group of this process's subscribers, named anew in a forked child."""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._local_group = f"{PRICES_GROUP}.{uuid.uuid4().hex}"
+        return self._local_group
+
+    async def subscribe(self, channel_name, channel_layer=None):
+        """Add a channel to the prices groups and make sure the ticker runs."""
+        channel_layer = channel_layer or get_channel_layer()
+        await channel_layer.group_add(PRICES_GROUP, channel_name)
+        await channel_layer.group_add(self.local_group, channel_name)
+        self._subscribers.add(channel_name)
+        if self._ticker is None or self._ticker.done():
+            self._ticker = asyncio.get_running_loop().create_task(self._run())
+
+    async def unsubscribe(self, channel_name, channel_layer=None):
+        """Remove a channel from the prices groups; stop ticking when idle."""
+        if channel_name not in self._subscribers:
+            return
+        channel_layer = channel_layer or get_channel_layer()
+        self._subscribers.discard(channel_name)
+        await channel_layer.group_discard(PRICES_GROUP, channel_name)
+        await channel_layer.group_discard(self.local_group, channel_name)
+        if not self._subscribers and self._ticker is not None:
+            self._ticker.cancel()
+            self._ticker = None
+
+    async def broadcast(self):
+        """Serialize the current prices once and send them to this process's subscribers."""
+        prices = await get_current_prices()
+        await self._send_frames(self.local_group, [codec.dumps(price_update_message(prices))])
+
+    async def publish(self):
+        """Push the current prices and the upcoming schedule to all subscribers after a change."""
+        price_resolver.invalidate()
+        await self._send_frames(PRICES_GROUP, await price_frames(), changed=True)
+
+    async def _send_frames(self, group, frames, changed=False):
+        await get_channel_layer().group_send(
+            group,
+            {
+                'type': 'price.broadcast',
+                'frames': frames,
+                # Tells receivers in other processes to drop their cached price
+                'changed': changed,
+            }
+        )
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.sleep(self.interval)
+                await self.broadcast()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                _LOGGER.error(f"Error broadcasting price updates: {e}")
+                await asyncio.sleep(PRICE_RETRY_INTERVAL)
+
+
+price_broadcaster = PriceBroadcaster()
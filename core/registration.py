@@ -0,0 +1,91 @@
+"""Registration and authentication of HA sites as single units of work.
+
+Each function runs in one transaction with as few queries as the case
+allows, so a failure leaves nothing half written and a reconnect storm
+costs as little database time as possible:
+
+- ``register_site_owner``: 3 queries for a new user, 2 for an existing
+  user re-registering a known site, 4 when an existing user adds a site.
+- ``authenticate_site``: 1 query for a known site (2 the first time, to
+  assign its site_id), 3 when the site is new.
+
+Both are synchronous; consumers call them through ``core.db.run_sync``.
+Passwords must already be hashed (see ``core.hashing``).
+"""
+import logging
+
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def split_display_name(display_name):
+    """Split a display name into (first_name, last_name)."""
+    if not display_name:
+        return "", ""
+    first_name, _, last_name = display_name.partition(" ")
+    return first_name, last_name
+
+
+def site_identifier(email, site_name):
+    """The site_id a site gets when it first authenticates."""
+    return f"opp_energy_{email}_{site_name}"
+
+
+def register_site_owner(email, display_name, password_hash, site_name):
+    """Create or update the user ``email`` and return (user, site).
+
+    The user's name, email and password (when given) are overwritten, as
+    registration always did; the site is created if the user doesn't have
+    one by that name.
+    """
+    try:
+        return _register_site_owner(email, display_name, password_hash, site_name)
+    except IntegrityError:
+        # Lost a race with a concurrent registration of the same user
+        return _register_site_owner(email, display_name, password_hash, site_name)
+
+
+@transaction.atomic
+def _register_site_owner(email, display_name, password_hash, site_name):
+    from core.models import Site
+
+    User = get_user_model()
+    first_name, last_name = split_display_name(display_name)
+    fields = {'email': email, 'first_name': first_name, 'last_name': last_name}
+    if password_hash:
+        fields['password'] = password_hash
+    # Email is the username
+    if not User.objects.filter(username=email).update(**fields):
+        user = User.objects.create(username=email, **fields)
+        return user, Site.objects.create(user=user, name=site_name)
+    site = Site.objects.select_related('user').filter(user__username=email, name=site_name).first()
+    if site is not None:
+        return site.user, site
+    user = User.objects.get(username=email)
+    return user, Site.objects.create(user=user, name=site_name)
+
+
+@transaction.atomic
+def authenticate_site(email, site_name):
+    """Return (user, site) for the site ``site_name`` of the user ``email``.
+
+    The site is created if needed and given its site_id. Returns None if
+    there is no user with that email.
+    """
+    from core.models import Site
+
+    User = get_user_model()
+    site = Site.objects.select_related('user').filter(user__email=email, name=site_name).first()
+    if site is not None:
+        if not site.site_id:
+            site.site_id = site_identifier(email, site_name)
+            Site.objects.filter(pk=site.pk).update(site_id=site.site_id)
+        return site.user, site
+    try:
+        user = User.objects.get(email=email)
+    except (User.DoesNotExist, User.MultipleObjectsReturned):
+        _LOGGER.info(f"No single user found with email {email}")
+        return None
+    return user, Site.objects.create(user=user, name=site_name, site_id=site_identifier(email, site_name))
@@ -0,0 +1,347 @@
+"""Bookkeeping for commands relayed between frontends and HA connections.
+
+Commands are forwarded over the channel layer and answered asynchronously
+with an ``ha_response`` message. ``PendingRequests`` correlates the two by
+command id: every forwarded command gets a future with its own deadline, the
+first response resolves it, and late or duplicate responses (e.g. when more
+than one consumer in the site group answers) are recognised and dropped.
+Entries are removed on response, on timeout and when the requesting
+connection goes away, so abandoned requests don't accumulate.
+
+``UpstreamRegistry`` maps a site to the channel of its HA connection, so a
+command is delivered with one ``channel_layer.send`` instead of a
+``group_send`` to every member of the site group.
+
+With OPP_RELAY_RAW_FRAMES (the default) pass-through traffic is relayed as
+the original text frame in a small routing envelope (``raw``) instead of a
+decoded ``command``/``response`` dict. The relaying side only reads the
+message id and type, with ``peek_message``; the frame is decoded where a
+field is really needed and never re-encoded on the way through. Binary
+frames carry the name of their wire encoding, so a response is only
+transcoded when the two ends negotiated different encodings.
+"""
+import asyncio
+import logging
+import re
+import time
+
+from django.conf import settings
+
+from . import codec
+from .layers import group_channels
+from .wire import JSON_WIRE, WIRES
+
+_LOGGER = logging.getLogger(__name__)
+
+# Seconds to wait for a response to a relayed command
+RELAY_TIMEOUT = getattr(settings, 'OPP_RELAY_TIMEOUT', 30)
+# Outstanding relayed commands allowed per connection
+RELAY_MAX_PENDING = getattr(settings, 'OPP_RELAY_MAX_PENDING', 100)
+# Seconds an upstream channel looked up from the channel layer is reused
+UPSTREAM_CACHE_TTL = getattr(settings, 'OPP_UPSTREAM_CACHE_TTL', 5)
+# Relay frames undecoded in a routing envelope instead of as dicts
+RELAY_RAW_FRAMES = getattr(settings, 'OPP_RELAY_RAW_FRAMES', True)
+
+# "id" and "type" as the first two members of a JSON object, in either
+# order. Leading members are top-level, so matching them is safe without
+# parsing the rest of the frame.
+_SCALAR = r'(-?\d+|"[\w.:\-]*")'
+_MESSAGE_HEAD = re.compile(
+    r'\s*\{\s*"(id|type)"\s*:\s*' + _SCALAR + r'\s*,\s*"(id|type)"\s*:\s*' + _SCALAR + r'\s*[,}]'
+)
+
+
+def _scalar(text):
+    return text[1:-1] if text[0] == '"' else int(text)
+
+
+def peek_message(text):
+    """Return (type, id, data) of a text frame, decoding it only if needed.
+
+    ``data`` is the decoded message, or None when type and id could be read
+    from the head of the frame. Raises codec.DecodeError for invalid JSON
+    in that case only.
+    """
+    match = _MESSAGE_HEAD.match(text)
+    if match:
+        first, first_value, second, second_value = match.groups()
+        if first == 'id':
+            first, first_value, second, second_value = second, second_value, first, first_value
+        # Anything else (a repeated key, a numeric type) takes the slow path
+        if first == 'type' and second == 'id' and first_value[0] == '"':
+            return first_value[1:-1], _scalar(second_value), None
+    data = codec.loads(text)
+    if not isinstance(data, dict):
+        raise codec.DecodeError("Expected a JSON object", text if isinstance(text, str) else '', 0)
+    return data.get('type'), data.get('id'), data
+
+
+def _raw_envelope(event, raw, wire):
+    event['raw'] = raw
+    if wire is not JSON_WIRE:
+        event['wire'] = wire.name
+    return event
+
+
+def _decode_raw(event):
+    return WIRES[event.get('wire', JSON_WIRE.name)].decode(event['raw'])
+
+
+def command_event(command_id, relay_channel, data=None, raw=None, wire=JSON_WIRE, **extra):
+    """Build the ha_command envelope for a command.
+
+    Pass the frame as received in ``raw``, encoded with ``wire``, to relay
+    it undecoded; ``data`` is used when raw frames are off or there is no
+    original frame.
+    """
+    event = {
+        'type': 'ha_command',
+        'relay_channel': relay_channel,
+        'command_id': command_id,
+        **extra,
+    }
+    if raw is not None and RELAY_RAW_FRAMES:
+        return _raw_envelope(event, raw, wire)
+    event['command'] = data if data is not None else wire.decode(raw)
+    return event
+
+
+def event_command(event):
+    """Return the command of an ha_command event as a dict."""
+    command = event.get('command')
+    if command is None:
+        command = _decode_raw(event)
+    return command
+
+
+def response_event(response):
+    """Build the ha_response envelope for a response dict."""
+    if RELAY_RAW_FRAMES:
+        return {'type': 'ha_response', 'response_id': response.get('id'), 'raw': codec.dumps(response)}
+    return {'type': 'ha_response', 'response': response}
+
+
+def response_frame(event, wire=JSON_WIRE):
+    """Return (id, frame) of an ha_response event, encoded for ``wire``."""
+    if 'raw' in event:
+        if event.get('wire', JSON_WIRE.name) == wire.name:
+            return event.get('response_id'), event['raw']
+        return event.get('response_id'), wire.encode(_decode_raw(event))
+    response = event['response']
+    return response.get('id'), wire.encode(response)
+
+
+class TooManyPendingRequests(Exception):
+    """Raised when a connection already has RELAY_MAX_PENDING open requests."""
+
+
+class PendingRequests:
+    """Futures for relayed commands, keyed by (owner channel, command id)."""
+
+    def __init__(self, timeout=RELAY_TIMEOUT, max_pending=RELAY_MAX_PENDING):
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self._pending = {}   # (owner, command id) -> (future, timer handle)
+        self._by_owner = {}  # owner -> set of command ids
+
+    def __len__(self):
+        return len(self._pending)
+
+    def pending_for(self, owner):
+        return len(self._by_owner.get(owner, ()))
+
+    def register(self, owner, command_id, timeout=None):
+        """Start tracking a command and return the future for its response.
+
+        The future fails with ``asyncio.TimeoutError`` once the deadline
+        passes. Registering an id that is still pending replaces the old
+        request, which is cancelled.
+        """
+        command_id = str(command_id)
+        key = (owner, command_id)
+        if key in self._pending:
+            self._finish(key).cancel()
+        elif self.pending_for(owner) >= self.max_pending:
+            raise TooManyPendingRequests(f"{owner} has {self.max_pending} pending requests")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        timer = loop.call_later(timeout or self.timeout, self._expire, key)
+        self._pending[key] = (future, timer)
+        self._by_owner.setdefault(owner, set()).add(command_id)
+        return future
+
+    def is_pending(self, owner, command_id):
+        return (owner, str(command_id)) in self._pending
+
+    def resolve(self, owner, command_id, response):
+        """Resolve a pending command. Returns False for unknown or late responses."""
+        key = (owner, str(command_id))
+        if key not in self._pending:
+            return False
+        future = self._finish(key)
+        if not future.done():
+            future.set_result(response)
+        return True
+
+    def discard_owner(self, owner):
+        """Cancel every request of a connection, e.g. on disconnect."""
+        for command_id in list(self._by_owner.get(owner, ())):
+            self._finish((owner, command_id)).cancel()
+
+    async def request(self, owner, command_id, send, timeout=None):
+        """Register a command, run ``send()`` and await the response.
+
+        Raises ``asyncio.TimeoutError`` if no response arrives in time. The
+        response must be delivered to ``owner`` by something other than the
+        awaiting coroutine, so consumers, whose handlers run one at a time,
+        use ``register`` with a callback instead.
+        """
+        future = self.register(owner, command_id, timeout)
+        try:
+            await send()
+        except BaseException:
+            if self.is_pending(owner, command_id):
+                self._finish((owner, str(command_id))).cancel()
+            raise
+        return await future
+
+    def _finish(self, key):
+        future, timer = self._pending.pop(key)
+        timer.cancel()
+        owner, command_id = key
+        ids = self._by_owner.get(owner)
+        if ids is not None:
+            ids.discard(command_id)
+            if not ids:
+                del self._by_owner[owner]
+        return future
+
+    def _expire(self, key):
+        if key not in self._pending:
+            return
+        future = self._finish(key)
+        if not future.done():
+            future.set_exception(asyncio.TimeoutError())
+
+
+pending_requests = PendingRequests()
+
+
+def upstream_group(site_id):
+    """Group holding only the HA connection(s) of a site."""
+    return f"upstream_{site_id}"
+
+
+class UpstreamRegistry:
+    """Map site ids to the channel name of their HA connection.
+
+    Connections in this process are recorded directly when they
+    authenticate. Every HA connection also joins the site's upstream group,
+    so other processes can resolve it through the channel layer; those
+    lookups are cached for UPSTREAM_CACHE_TTL seconds.
+    """
+
+    def __init__(self, cache_ttl=UPSTREAM_CACHE_TTL):
+        self.cache_ttl = cache_ttl
+        self._local = {}   # site id -> channel name of a connection in this process
+        self._remote = {}  # site id -> (channel name, monotonic expiry)
+
+    async def register(self, site_id, channel_name, channel_layer):
+        """Record ``channel_name`` as the upstream of a site."""
+        site_id = str(site_id)
+        await channel_layer.group_add(upstream_group(site_id), channel_name)
+        self._local[site_id] = channel_name
+        self._remote.pop(site_id, None)
+
+    async def unregister(self, site_id, channel_name, channel_layer):
+        """Forget ``channel_name`` as the upstream of a site."""
+        site_id = str(site_id)
+        await channel_layer.group_discard(upstream_group(site_id), channel_name)
+        if self._local.get(site_id) == channel_name:
+            del self._local[site_id]
+        cached = self._remote.get(site_id)
+        if cached and cached[0] == channel_name:
+            del self._remote[site_id]
+
+    def is_local(self, site_id):
+        """Return True if the site's HA connection is in this process."""
+        return str(site_id) in self._local
+
+    async def resolve(self, site_id, channel_layer):
+        """Return the upstream channel of a site, or None if it isn't connected."""
+        site_id = str(site_id)
+        channel_name = self._local.get(site_id)
+        if channel_name:
+            return channel_name
+        cached = self._remote.get(site_id)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        channels = await group_channels(upstream_group(site_id), channel_layer)
+        if not channels:
+            self._remote.pop(site_id, None)
+            return None
+        # More than one member only while an HA client reconnects; any will do
+        channel_name = min(channels)
+        self._remote[site_id] = (channel_name, time.monotonic() + self.cache_ttl)
+        return channel_name
+
+
+upstreams = UpstreamRegistry()
+
+
+class RelayRequestMixin:
+    """Consumer helpers to track relayed commands and filter their responses.
+
+    Meant to be combined with ``WireProtocolMixin``.
+    """
+
+    def track_request(self, command_id):
+        """Track a forwarded command; the client gets an error if it times out."""
+        future = pending_requests.register(self.channel_name, command_id)
+        future.add_done_callback(lambda f: self._request_done(command_id, f))
+
+    def _request_done(self, command_id, future):
+        if future.cancelled() or future.exception() is None:
+            return
+        _LOGGER.warning(f"Relayed command {command_id} timed out")
+        asyncio.ensure_future(
+            self.send_error_result(command_id, 'timeout', 'Home Assistant did not respond in time')
+        )
+
+    async def send_error_result(self, command_id, code, message):
+        await self.send_message({
+            'id': command_id,
+            'type': 'result',
+            'success': False,
+            'error': {
+                'code': code,
+                'message': message
+            }
+        })
+
+    def accept_response(self, event):
+        """Return the frame of an ha_response event to send to the client.
+
+        Returns None, and the response is dropped, unless it answers a
+        pending command of this connection.
+        """
+        response_id, frame = response_frame(event, self.wire)
+        if pending_requests.resolve(self.channel_name, response_id, event):
+            return frame
+        _LOGGER.debug(f"Dropping late or duplicate response {response_id}")
+        return None
+
+    def discard_requests(self):
+        pending_requests.discard_owner(self.channel_name)
+
+    async def forward_command(self, site_id, command_id, event):
+        """Track ``command_id`` and send ``event`` to the HA connection of a site.
+
+        Returns False, and tracks nothing, if the site has no HA connection.
+        """
+        channel_name = await upstreams.resolve(site_id, self.channel_layer)
+        if channel_name is None:
+            return False
+        self.track_request(command_id)
+        await self.channel_layer.send(channel_name, event)
+        return True
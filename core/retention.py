@@ -0,0 +1,136 @@
+"""Roll old EnergyPrice rows up into hourly and daily aggregate tables.
+
+Raw rows older than the retention age are processed one hour at a time, in
+batches of up to OPP_PRICE_RETENTION_BATCH_SIZE rows. Each batch is
+aggregated and merged into its EnergyPriceHourly and EnergyPriceDaily
+buckets, and its raw rows are deleted, in one transaction of its own: an
+interrupted run never counts a row twice, and no transaction holds locks on
+more than one batch. While an hour is in progress, reads of it from the
+rollup tables miss the rows of its remaining batches.
+
+Rows are deleted with ``_raw_delete``, one DELETE per batch and no
+post_delete signal. ``.delete()`` would load every row to send the signal,
+whose handler queues a price publish per row, and nothing needs publishing:
+rolled up rows are long past, so neither the current price nor the schedule
+changes.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Min, Sum
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+from .models import EnergyPrice, EnergyPriceDaily, EnergyPriceHourly
+
+_LOGGER = logging.getLogger(__name__)
+
+# Raw rows older than this many days are rolled up and deleted
+PRICE_RETENTION_DAYS = getattr(settings, 'OPP_PRICE_RETENTION_DAYS', 90)
+# Raw rows deleted per DELETE statement
+PRICE_RETENTION_BATCH_SIZE = getattr(settings, 'OPP_PRICE_RETENTION_BATCH_SIZE', 1000)
+
+AGGREGATES = {
+    'samples': Count('id'),
+    'buy_min': Min('buy_price'),
+    'buy_max': Max('buy_price'),
+    'buy_sum': Sum('buy_price'),
+    'sell_min': Min('sell_price'),
+    'sell_max': Max('sell_price'),
+    'sell_sum': Sum('sell_price'),
+}
+
+
+def retention_cutoff(days=PRICE_RETENTION_DAYS, now=None):
+    """Return the day-aligned time before which raw rows are rolled up."""
+    cutoff = (now or timezone.now()) - timedelta(days=days)
+    return cutoff.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def rollup_watermark():
+    """Return the end of the newest rolled up hour, or None if nothing is rolled up.
+
+    Raw rows before the watermark have been rolled up and deleted, so queries
+    read older ranges from the aggregate tables.
+    """
+    latest = EnergyPriceHourly.objects.order_by('-bucket').values_list('bucket', flat=True).first()
+    return latest + timedelta(hours=1) if latest else None
+
+
+def merge_rollup(rollup, values):
+    """Merge aggregate ``values`` into an existing rollup instance."""
+    rollup.samples += values['samples']
+    rollup.buy_min = min(rollup.buy_min, values['buy_min'])
+    rollup.buy_max = max(rollup.buy_max, values['buy_max'])
+    rollup.buy_sum += values['buy_sum']
+    rollup.sell_min = min(rollup.sell_min, values['sell_min'])
+    rollup.sell_max = max(rollup.sell_max, values['sell_max'])
+    rollup.sell_sum += values['sell_sum']
+    return rollup
+
+
+def _add_to_tier(model, bucket, values):
+    rollup = model.objects.select_for_update().filter(bucket=bucket).first()
+    if rollup is None:
+        model.objects.create(bucket=bucket, **values)
+    else:
+        merge_rollup(rollup, values).save()
+
+
+def rollup_batch(hour, batch_size=PRICE_RETENTION_BATCH_SIZE):
+    """Roll up and delete up to ``batch_size`` raw rows of one hour. Returns rows deleted."""
+    with transaction.atomic():
+        pks = list(
+            EnergyPrice.objects.select_for_update()
+            .filter(timestamp__gte=hour, timestamp__lt=hour + timedelta(hours=1))
+            .order_by('pk').values_list('pk', flat=True)[:batch_size]
+        )
+        if not pks:
+            return 0
+        rows = EnergyPrice.objects.filter(pk__in=pks)
+        values = rows.aggregate(**AGGREGATES)
+        _add_to_tier(EnergyPriceHourly, hour, values)
+        _add_to_tier(EnergyPriceDaily, hour.replace(hour=0), values)
+        # One DELETE without post_delete; see the module docstring
+        return rows._raw_delete(rows.db)
+
+
+def rollup_hour(hour, batch_size=PRICE_RETENTION_BATCH_SIZE):
+    """Roll up and delete the raw rows of one hour, batch by batch. Returns rows deleted."""
+    deleted = 0
+    while True:
+        batch = rollup_batch(hour, batch_size)
+        if not batch:
+            return deleted
+        deleted += batch
+
+
+def rollup_prices(days=PRICE_RETENTION_DAYS, batch_size=PRICE_RETENTION_BATCH_SIZE, dry_run=False):
+    """Roll up all raw rows older than ``days`` days.
+
+    Returns a summary dict with the cutoff, hours processed and rows deleted.
+    """
+    cutoff = retention_cutoff(days)
+    summary = {'cutoff': cutoff, 'hours': 0, 'deleted': 0}
+    hours = (
+        EnergyPrice.objects
+        .filter(timestamp__lt=cutoff)
+        .annotate(hour=TruncHour('timestamp'))
+        .values_list('hour', flat=True)
+        .distinct()
+        .order_by('hour')
+    )
+    # The list of hours is small; materialize it before deleting rows
+    for hour in list(hours):
+        summary['hours'] += 1
+        if dry_run:
+            continue
+        summary['deleted'] += rollup_hour(hour, batch_size)
+    _LOGGER.info(
+        f"Rolled up {summary['hours']} hours of prices before {cutoff.isoformat()}, "
+        f"deleted {summary['deleted']} raw rows"
+    )
+    return summary
+
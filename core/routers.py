@@ -0,0 +1,89 @@
+"""Send read-only dashboard and status reads to a read replica.
+
+Reads go to the OPP_DB_REPLICA database only inside ``replica_reads()`` (or
+a view wrapped in ``reads_from_replica``); everything else, including all
+writes, stays on ``default``. The scope is a context variable, so it
+follows async code into the ORM's sync threads.
+
+A session that wrote something itself (``mark_written``) reads from the
+primary for the next OPP_DB_REPLICA_STICKY seconds, so it sees its own
+change before the replica has caught up. Without OPP_DB_REPLICA in
+DATABASES the router sends nothing anywhere and all reads use ``default``.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import time
+
+from django.conf import settings
+
+# Alias of the replica in DATABASES
+DB_REPLICA = getattr(settings, 'OPP_DB_REPLICA', 'replica')
+# Seconds a session keeps reading from the primary after its own writes
+DB_REPLICA_STICKY = getattr(settings, 'OPP_DB_REPLICA_STICKY', 10)
+
+SESSION_KEY = '_opp_db_written'
+
+# Session of the current replica_reads() block; None outside of one
+_replica_session = ContextVar('opp_replica_session', default=None)
+
+
+def replica_configured():
+    return DB_REPLICA in settings.DATABASES
+
+
+def mark_written(session):
+    """Keep the reads of ``session`` on the primary for a while after a write."""
+    session[SESSION_KEY] = time.time()
+
+
+def recently_written(session):
+    return time.time() - session.get(SESSION_KEY, 0) < DB_REPLICA_STICKY
+
+
+@contextmanager
+def replica_reads(session=None):
+    """Read from the replica in this block, unless ``session`` wrote recently."""
+    token = _replica_session.set({} if session is None else session)
+    try:
+        yield
+    finally:
+        _replica_session.reset(token)
+
+
+def reads_from_replica(view):
+    """Decorator running a view's reads on the replica, see ``replica_reads``."""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        with replica_reads(request.session):
+            return view(request, *args, **kwargs)
+    return wrapper
+
+
+class ReadReplicaRouter:
+    """Route reads in ``replica_reads()`` blocks to OPP_DB_REPLICA."""
+
+    def db_for_read(self, model, **hints):
+        session = _replica_session.get()
+        # Sessions are written on every request; loading one is also what
+        # the stickiness check below may do
+        if session is None or model._meta.app_label == 'sessions' or not replica_configured():
+            return None
+        if recently_written(session):
+            return None
+        return DB_REPLICA
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows as the primary
+        if {obj1._state.db, obj2._state.db} <= {'default', DB_REPLICA}:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replica gets its schema through replication
+        if db == DB_REPLICA:
+            return False
+        return None
@@ -0,0 +1,27 @@
+"""Signal handlers for the core app."""
+import logging
+
+from asgiref.sync import async_to_sync
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import EnergyPrice
+from .prices import price_broadcaster
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def publish_prices():
+    """Push the current prices and schedule to all price subscribers."""
+    try:
+        async_to_sync(price_broadcaster.publish)()
+    except Exception as e:
+        _LOGGER.error(f"Error publishing price change: {e}")
+
+
+@receiver(post_save, sender=EnergyPrice)
+@receiver(post_delete, sender=EnergyPrice)
+def energy_price_changed(sender, **kwargs):
+    """Publish price changes once the writing transaction has committed."""
+    transaction.on_commit(publish_prices)
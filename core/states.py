@@ -0,0 +1,305 @@
+"""Per-site cache of Home Assistant entity states with versioned deltas.
+
+The HA connection of a site sends ``state_changed`` events; each one is
+applied to the site's ``SiteStates`` and bumps its version. Frontend
+``get_states`` requests are answered from the cache instead of going to
+the HA client, so upstream load scales with changes rather than viewers.
+A client that sends ``since_version`` gets only the entities changed (and
+the ids removed) after that version.
+
+The HA connection seeds the cache with a ``state_snapshot`` of all its
+entities (after connecting, or whenever it resyncs); until then get_states
+is still answered the old way.
+
+The cache lives in the process that holds the site's HA connection, which
+is where relayed commands are routed. Versions restart when that process
+does, so every answer carries the cache ``epoch``; a request with a
+different epoch gets a full snapshot.
+
+On the way to a frontend, updates pass through a ``StateUpdateBuffer``
+that keeps only the latest state of each entity for a short window and
+sends them as one frame. If a frame is dropped because the client is too
+far behind, later frames carry ``resync`` and the client's next get_states
+is answered with a full snapshot, since a delta would miss what was lost.
+"""
+import asyncio
+import itertools
+import logging
+import uuid
+
+from django.conf import settings
+
+from .metrics import metrics
+
+_LOGGER = logging.getLogger(__name__)
+
+# Default coalescing window for state updates sent to frontends, in ms
+STATE_COALESCE_WINDOW = getattr(settings, 'OPP_STATE_COALESCE_WINDOW', 100)
+# Longest window a slow frontend is backed off to, in ms
+STATE_COALESCE_MAX_WINDOW = getattr(settings, 'OPP_STATE_COALESCE_MAX_WINDOW', 2000)
+
+# Removed entity ids remembered per site for deltas; older removals force
+# a full snapshot
+MAX_TOMBSTONES = 1000
+
+
+class SiteStates:
+    """Entity states of one site."""
+
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:12]
+        self.version = 0
+        self.entities = {}   # entity_id -> state dict
+        self.changed = {}    # entity_id -> version of its last change
+        self.removed = {}    # entity_id -> version it was removed at
+        # Deltas from versions before this are incomplete
+        self.horizon = 0
+        # True once a full snapshot was received
+        self.seeded = False
+
+    def replace(self, states):
+        """Replace all entities with ``states``; only real changes get a version."""
+        for entity_id in [entity_id for entity_id in self.entities if entity_id not in states]:
+            self.apply(entity_id, None)
+        for entity_id, state in states.items():
+            self.apply(entity_id, state)
+        self.seeded = True
+        return self.version
+
+    def apply(self, entity_id, new_state):
+        """Store the new state of an entity (None removes it). Returns the version."""
+        if new_state is None:
+            if entity_id not in self.entities:
+                return self.version
+            self.version += 1
+            del self.entities[entity_id]
+            del self.changed[entity_id]
+            self.removed[entity_id] = self.version
+            if len(self.removed) > MAX_TOMBSTONES:
+                oldest = min(self.removed, key=self.removed.get)
+                self.horizon = self.removed.pop(oldest)
+            return self.version
+        if self.entities.get(entity_id) == new_state:
+            return self.version
+        self.version += 1
+        self.entities[entity_id] = new_state
+        self.changed[entity_id] = self.version
+        self.removed.pop(entity_id, None)
+        return self.version
+
+    def snapshot(self, since_version=None, epoch=None):
+        """Return the states as a get_states result.
+
+        With ``since_version`` from the same epoch only the entities changed
+        after it are included (``delta`` is True) along with the ids removed
+        since.
+        """
+        result = {'version': self.version, 'epoch': self.epoch}
+        delta = (
+            since_version is not None
+            and epoch in (None, self.epoch)
+            and self.horizon <= since_version <= self.version
+        )
+        if not delta:
+            return {**result, 'delta': False, 'states': dict(self.entities), 'removed': []}
+        return {
+            **result,
+            'delta': True,
+            'states': {
+                entity_id: self.entities[entity_id]
+                for entity_id, version in self.changed.items() if version > since_version
+            },
+            'removed': [entity_id for entity_id, version in self.removed.items() if version > since_version],
+        }
+
+
+class StateCache:
+    """SiteStates of every site whose HA connection is in this process."""
+
+    def __init__(self):
+        self._sites = {}
+
+    def has(self, site_id):
+        """Return True once the site has sent a full snapshot."""
+        site = self._sites.get(str(site_id))
+        return site is not None and site.seeded
+
+    def site(self, site_id):
+        return self._sites.setdefault(str(site_id), SiteStates())
+
+    def apply_event(self, site_id, event):
+        """Apply a state_changed event payload; returns (version, entity_id, new_state).
+
+        Accepts the ``data`` of a Home Assistant state_changed event:
+        ``{"entity_id": ..., "new_state": {...} or None, ...}``.
+        """
+        entity_id = event.get('entity_id')
+        if not entity_id:
+            raise ValueError("state_changed event without entity_id")
+        new_state = event.get('new_state')
+        return self.site(site_id).apply(entity_id, new_state), entity_id, new_state
+
+    def replace(self, site_id, states):
+        return self.site(site_id).replace(states)
+
+    def snapshot(self, site_id, since_version=None, epoch=None):
+        return self.site(site_id).snapshot(since_version, epoch)
+
+    def result_message(self, site_id, command_id, command):
+        """Answer a get_states command from the cache.
+
+        ``result`` holds the entities as in Home Assistant's own answer; the
+        version fields sit next to it so clients that ignore them still work.
+        """
+        snapshot = self.snapshot(site_id, command.get('since_version'), command.get('epoch'))
+        return {
+            'id': command_id,
+            'type': 'result',
+            'success': True,
+            'result': snapshot['states'],
+            'removed': snapshot['removed'],
+            'delta': snapshot['delta'],
+            'version': snapshot['version'],
+            'epoch': snapshot['epoch'],
+        }
+
+    def discard(self, site_id):
+        """Forget a site, e.g. when its HA connection leaves this process."""
+        self._sites.pop(str(site_id), None)
+
+
+site_states = StateCache()
+
+
+def _merge(states, removed, new_states, new_removed):
+    """Apply newer ``new_states``/``new_removed`` to ``states``/``removed`` in place."""
+    for entity_id, state in new_states.items():
+        states[entity_id] = state
+        removed.discard(entity_id)
+    for entity_id in new_removed:
+        states.pop(entity_id, None)
+        removed.add(entity_id)
+
+
+class StateUpdateBuffer:
+    """Coalesce the ha_state_update events of one frontend connection.
+
+    Updates arriving within ``window`` ms are merged, keeping the latest
+    state of each entity, and handed to ``send(message, key)`` as one
+    low-priority state_update frame per window. ``send`` only queues the
+    frame, so neither adding nor flushing waits for the socket.
+
+    While the last frame queued for the connection (``queue()``) is still
+    this buffer's previous state frame, the new updates are merged into it
+    and it is replaced in place, so a lagging client gets one frame holding
+    everything and versions never go backwards in queue order. If ``send``
+    reports the frame dropped, the client has missed updates: every later
+    frame carries ``resync`` until ``needs_resync`` is cleared by a full
+    snapshot.
+
+    The window adapts to how fast the client drains: when frames are still
+    queued at a flush, the window doubles (up to ``max_window``); otherwise
+    it shrinks back towards its configured size. A window of 0 sends every
+    update immediately.
+    """
+
+    def __init__(self, send, window=STATE_COALESCE_WINDOW, max_window=STATE_COALESCE_MAX_WINDOW, queue=None):
+        self.send = send
+        self.queue = queue or (lambda: None)
+        self.base_window = window / 1000
+        self.max_window = max(max_window, window) / 1000
+        self.window = self.base_window
+        self.needs_resync = False
+        self._states = {}
+        self._removed = set()
+        self._version = None
+        self._epoch = None
+        self._updates = 0
+        self._timer = None
+        self._flush_task = None
+        # Key and content of the last frame queued, for merging into it
+        self._frames = itertools.count()
+        self._key = None
+        self._queued_states = {}
+        self._queued_removed = set()
+
+    def __len__(self):
+        return len(self._states) + len(self._removed)
+
+    async def add(self, event):
+        """Merge an ha_state_update event, sending it if there is no window."""
+        _merge(self._states, self._removed, event['states'], event.get('removed', ()))
+        self._version = event.get('version')
+        self._epoch = event.get('epoch')
+        self._updates += 1
+        if not self.base_window:
+            await self.flush()
+        elif self._timer is None and self._flush_task is None:
+            self._schedule()
+
+    async def flush(self):
+        """Queue everything buffered as one message."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._states and not self._removed:
+            return
+        queue = self.queue()
+        self._adapt(len(queue) if queue is not None else 0)
+        if self._key is None or queue is None or queue.tail_key() != self._key:
+            # The previous frame was written, or other frames follow it
+            self._key = ('state_update', next(self._frames))
+            self._queued_states, self._queued_removed = {}, set()
+        _merge(self._queued_states, self._queued_removed, self._states, self._removed)
+        metrics.counter('state_updates_coalesced').inc(self._updates - 1)
+        metrics.counter('state_update_frames').inc()
+        self._states, self._removed, self._updates = {}, set(), 0
+        result = {
+            'type': 'state_update',
+            'states': dict(self._queued_states),
+            'removed': list(self._queued_removed),
+            'version': self._version,
+            'epoch': self._epoch,
+        }
+        if self.needs_resync:
+            result['resync'] = True
+        if await self.send({'type': 'result', 'result': result}, self._key) is False:
+            metrics.counter('state_update_resyncs').inc()
+            self.needs_resync = True
+            self._key = None
+
+    def close(self):
+        """Drop buffered updates and stop the timer, e.g. on disconnect."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        self._states, self._removed, self._updates = {}, set(), 0
+
+    def _adapt(self, backlog):
+        if not self.base_window:
+            return
+        if backlog:
+            self.window = min(self.window * 2, self.max_window)
+        else:
+            self.window = max(self.window * 0.75, self.base_window)
+
+    def _schedule(self):
+        self._timer = asyncio.get_running_loop().call_later(self.window, self._start_flush)
+
+    def _start_flush(self):
+        self._timer = None
+        self._flush_task = asyncio.ensure_future(self._run_flush())
+
+    async def _run_flush(self):
+        try:
+            await self.flush()
+        except Exception as e:
+            _LOGGER.warning(f"Failed to send state update: {e}")
+        finally:
+            self._flush_task = None
+        # Updates that arrived meanwhile wait for the next window
+        if self._states or self._removed:
+            self._schedule()
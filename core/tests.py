@@ -1,3 +1,1380 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock, skipIf
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import check_password, make_password
+from django.contrib.sessions.models import Session
+from django.db import DatabaseError, connection, transaction
+from django.db.models.signals import post_delete
+from django.db.backends.sqlite3 import base as sqlite3_base
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from core import consumers
+from core import codec, dispatch, history, ingest, layers, prices, retention, routers, views, wire
+from core.admission import THROTTLED_CLOSE_CODE, AdmissionController, Throttled, TokenBuckets, with_jitter
+from core.backends.pool import ConnectionPool, PooledDatabaseWrapperMixin, PoolTimeout
+from core.db import run_sync
+from core.dispatch import MessageDispatchMixin, handles
+from core.hashing import PasswordHashingPool
+from core.idle import IDLE_CLOSE_CODE, IdleScheduler
+from core.layers import LocalChannelLayer, group_channels, group_has_members
+from core.metrics import MetricsRegistry
+from core.models import EnergyPrice, EnergyPriceDaily, EnergyPriceHourly, Site
+from core.outbound import OutboundQueue
+from core.presence import PresenceRegistry, presence
+from core.registration import authenticate_site, register_site_owner
+from core.relay import PendingRequests, TooManyPendingRequests, pending_requests, response_event, upstreams
+from core.routers import ReadReplicaRouter, mark_written, reads_from_replica, replica_reads
+from core.routing import websocket_urlpatterns
+from core.states import SiteStates, StateUpdateBuffer
+
+User = get_user_model()
+
+
+# Logged by some backends only, and as savepoints inside a test's transaction
+TRANSACTION_CONTROL = ('BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+
+class RegistrationQueryTests(TestCase):
+    """Registration and authentication are atomic and use few queries."""
+
+    @contextmanager
+    def assertNumDataQueries(self, num):
+        """Like TestCase.assertNumQueries, not counting transaction control."""
+        with CaptureQueriesContext(connection) as context:
+            yield
+        queries = [q['sql'] for q in context.captured_queries if not q['sql'].startswith(TRANSACTION_CONTROL)]
+        self.assertEqual(len(queries), num, "\n".join(queries))
+
+    def test_register_new_user(self):
+        with self.assertNumDataQueries(3):
+            user, site = register_site_owner("a@example.com", "Ada Lovelace", "hash", "home")
+        user.refresh_from_db()
+        self.assertEqual((user.username, user.first_name, user.last_name), ("a@example.com", "Ada", "Lovelace"))
+        self.assertEqual(user.password, "hash")
+        self.assertEqual(site.user, user)
+
+    def test_register_known_site(self):
+        register_site_owner("a@example.com", "Ada", "hash", "home")
+        with self.assertNumDataQueries(2):
+            user, site = register_site_owner("a@example.com", "Ada King", None, "home")
+        user.refresh_from_db()
+        self.assertEqual((user.last_name, user.password), ("King", "hash"))
+        self.assertEqual(Site.objects.count(), 1)
+
+    def test_register_new_site_of_existing_user(self):
+        register_site_owner("a@example.com", "Ada", "hash", "home")
+        with self.assertNumDataQueries(4):
+            user, site = register_site_owner("a@example.com", "Ada", None, "cabin")
+        self.assertEqual(Site.objects.filter(user=user).count(), 2)
+
+    def test_registration_is_atomic(self):
+        with mock.patch.object(Site.objects, 'create', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                register_site_owner("a@example.com", "Ada", "hash", "home")
+        self.assertFalse(User.objects.exists())
+
+    def test_authenticate_known_site(self):
+        register_site_owner("a@example.com", "Ada", "hash", "home")
+        # The first authentication assigns the site_id
+        with self.assertNumDataQueries(2):
+            user, site = authenticate_site("a@example.com", "home")
+        self.assertEqual(Site.objects.get().site_id, "opp_energy_a@example.com_home")
+        with self.assertNumDataQueries(1):
+            user, site = authenticate_site("a@example.com", "home")
+        self.assertEqual(user.username, "a@example.com")
+
+    def test_authenticate_new_site(self):
+        register_site_owner("a@example.com", "Ada", "hash", "home")
+        with self.assertNumDataQueries(3):
+            user, site = authenticate_site("a@example.com", "cabin")
+        self.assertEqual(site.site_id, "opp_energy_a@example.com_cabin")
+
+    def test_authenticate_unknown_user(self):
+        with self.assertNumDataQueries(2):
+            self.assertIsNone(authenticate_site("nobody@example.com", "home"))
+        self.assertFalse(Site.objects.exists())
+
+
+class CodecTests(SimpleTestCase):
+    """Every installed JSON backend encodes our payloads the same way."""
+
+    def payloads(self):
+        from core.management.commands.bench_codec import call_service_message, get_states_result
+        now = timezone.now()
+        price = EnergyPrice(
+            timestamp=now, valid_until=now + timedelta(hours=1),
+            buy_price=Decimal('0.2137'), sell_price=Decimal('0.0412'),
+        )
+        state = {
+            'entity_id': 'climate.wohnzimmer',
+            'state': 'heat',
+            'attributes': {
+                'current_temperature': 21.5, 'temperature': 22, 'hvac_modes': ['off', 'heat'],
+                'friendly_name': 'Wohnzimmer – Heizung', 'preset_mode': None, 'is_on': True,
+            },
+            'context': {'id': '01HV8X7N9Y', 'parent_id': None, 'user_id': None},
+        }
+        return {
+            'price_update': prices.price_update_message({'buy_price': 0.2137, 'sell_price': 0.0412}, 41),
+            'price_schedule': prices.price_schedule_message(prices.DEFAULT_PRICES, [prices._price_row(price)]),
+            'price_row': {'buy_price': Decimal('0.2137'), 'timestamp': price.timestamp},
+            'state_changed': {'type': 'event', 'event': {'event_type': 'state_changed', 'data': {
+                'entity_id': state['entity_id'], 'new_state': state, 'old_state': None,
+            }}},
+            'get_states': get_states_result(20),
+            'call_service': call_service_message(),
+        }
+
+    def test_backends_agree_on_real_payloads(self):
+        backends = {name: codec.load_backend(name) for name in codec.available_backends()}
+        expected_dumps = backends['json'][0]
+        for label, payload in self.payloads().items():
+            expected = expected_dumps(payload)
+            for name, (dumps, dumpb, loads) in backends.items():
+                with self.subTest(payload=label, backend=name):
+                    self.assertEqual(dumps(payload), expected)
+                    self.assertEqual(dumpb(payload), expected.encode())
+                    self.assertEqual(loads(expected), json.loads(expected))
+
+    def test_documented_differences_decode_to_the_same_value(self):
+        for name in codec.available_backends():
+            dumps, _, loads = codec.load_backend(name)
+            with self.subTest(backend=name):
+                for value in (1e-05, 1e16, 0.1):
+                    self.assertEqual(loads(dumps(value)), value)
+
+
+def chunked(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class IngestParserTests(SimpleTestCase):
+    """The streaming parsers give the same rows however the body is chunked."""
+
+    ARRAY = [
+        {'buy_price': 0.12345, 'sell_price': '1e-2', 'valid_until': '2025-01-01T01:00:00+00:00'},
+        {'note': 'say "hi", [not] {an} array\\\\', 'escaped': '\\"]', 'unicode': 'kéWh €'},
+        [], {}, 123456789.5, True, None,
+    ]
+
+    def test_json_array_split_at_every_position(self):
+        text = ' [ ' + ' , '.join(json.dumps(item) for item in self.ARRAY) + ' ] '
+        for size in (1, 2, 3, 5, 8, len(text)):
+            with self.subTest(size=size):
+                self.assertEqual(list(ingest.iter_json_array(chunked(text, size))), self.ARRAY)
+
+    def test_multibyte_characters_split_across_reads(self):
+        body = json.dumps([{'unit': '€/kWh'}], ensure_ascii=False).encode()
+        rows = list(ingest.iter_rows(io.BytesIO(body), 'json'))
+        self.assertEqual(rows, [{'unit': '€/kWh'}])
+        self.assertEqual(''.join(ingest.iter_text(io.BytesIO(body), chunk_size=1)), body.decode())
+
+    def test_invalid_json_arrays(self):
+        for text in ('{"a": 1}', '[{"a": 1}', '[{"a": 1} {"b": 2}]', '[{"a": "unterminated}]', ''):
+            with self.subTest(text=text), self.assertRaises(ingest.IngestError):
+                list(ingest.iter_json_array(chunked(text, 3)))
+
+    def test_ndjson_lines_split_across_chunks(self):
+        text = '{"a": "x\\"y"}\r\n\r\nnot json\n{"b": [1, 2]}'
+        for size in (1, 4, len(text)):
+            with self.subTest(size=size):
+                rows = list(ingest.iter_ndjson(chunked(text, size)))
+                self.assertEqual(rows[0], {'a': 'x"y'})
+                self.assertIsInstance(rows[1], codec.DecodeError)
+                self.assertEqual(rows[2], {'b': [1, 2]})
+                self.assertEqual(len(rows), 3)
+
+    def test_csv_quoted_fields_split_across_chunks(self):
+        text = 'buy_price,sell_price,note\r\n0.1,0.05,"a, ""quoted""\r\nnote"\r\n0.2,0.06,plain\r\n'
+        for size in (1, 7, len(text)):
+            with self.subTest(size=size):
+                self.assertEqual(list(ingest.iter_csv(chunked(text, size))), [
+                    {'buy_price': '0.1', 'sell_price': '0.05', 'note': 'a, "quoted"\r\nnote'},
+                    {'buy_price': '0.2', 'sell_price': '0.06', 'note': 'plain'},
+                ])
+
+
+class IngestPricesTests(TestCase):
+    """Uploaded rows are validated one by one and written in one transaction."""
+
+    def row(self, hour, **fields):
+        start = timezone.now().replace(minute=0, second=0, microsecond=0) + timedelta(hours=hour)
+        return {'buy_price': '0.2', 'sell_price': '0.1', 'timestamp': start.isoformat(),
+                'valid_until': (start + timedelta(hours=1)).isoformat(), **fields}
+
+    def test_invalid_rows_are_reported_and_skipped(self):
+        rows = [
+            self.row(0),
+            self.row(1, buy_price='cheap'),
+            self.row(2, valid_until=''),
+            self.row(3, valid_until='tomorrow'),
+            self.row(4, valid_until=self.row(3)['timestamp']),
+            self.row(5, sell_price='123456789.5'),
+            ['not', 'an', 'object'],
+            codec.DecodeError('Expecting value', 'x', 0),
+            self.row(6),
+        ]
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            result = ingest.ingest_prices(rows, batch_size=1)
+        self.assertEqual((result['created'], result['rejected']), (2, 7))
+        self.assertEqual([error['row'] for error in result['errors']], [2, 3, 4, 5, 6, 7, 8])
+        self.assertEqual(result['errors'][0]['error'], 'buy_price is not a number')
+        self.assertEqual(result['errors'][1]['error'], 'valid_until is required')
+        self.assertEqual(EnergyPrice.objects.count(), 2)
+        self.assertEqual(len(callbacks), 1)
+
+    def test_failed_batch_rolls_back_the_upload(self):
+        bulk_create = EnergyPrice.objects.bulk_create
+        calls = []
+
+        def fail_second_batch(batch):
+            calls.append(len(batch))
+            if len(calls) == 2:
+                raise DatabaseError("disk full")
+            return bulk_create(batch)
+
+        with mock.patch.object(EnergyPrice.objects, 'bulk_create', fail_second_batch), \
+                self.captureOnCommitCallbacks() as callbacks, self.assertRaises(DatabaseError):
+            ingest.ingest_prices([self.row(hour) for hour in range(5)], batch_size=2)
+        self.assertEqual(calls, [2, 2])
+        self.assertEqual(EnergyPrice.objects.count(), 0)
+        self.assertEqual(callbacks, [])
+
+
+class Dispatcher(MessageDispatchMixin):
+    """A consumer stand-in recording what dispatch calls."""
+
+    authenticated = False
+
+    def __init__(self):
+        self.calls = []
+
+    @handles('get_prices', 'prices')
+    async def handle_get_prices(self, data):
+        self.calls.append(('get_prices', data['type']))
+
+    @handles('call_service', requires_auth=True)
+    async def handle_call_service(self, data):
+        self.calls.append(('call_service', data['type']))
+
+    @handles('get_states')
+    async def handle_get_states(self, data):
+        raise ValueError("broken handler")
+
+    async def handle_unhandled(self, data):
+        self.calls.append(('unhandled', data.get('type')))
+
+    async def handle_unauthenticated(self, data):
+        self.calls.append(('unauthenticated', data['type']))
+
+
+class DispatchTests(SimpleTestCase):
+    """Messages are dispatched by type and counted per handled type."""
+
+    def setUp(self):
+        patcher = mock.patch.object(dispatch, 'metrics', MetricsRegistry())
+        self.metrics = patcher.start()
+        self.addCleanup(patcher.stop)
+        dispatch._type_metrics.cache_clear()
+        self.addCleanup(dispatch._type_metrics.cache_clear)
+
+    def counts(self, name):
+        return {
+            entry['labels']['type']: entry['value']
+            for entry in self.metrics.snapshot().get('counter', {}).get(name, [])
+        }
+
+    async def test_dispatch_by_type(self):
+        consumer = Dispatcher()
+        for message_type in ('get_prices', 'prices', 'call_service', 'no_such_type', None):
+            await consumer.dispatch_message({'type': message_type})
+        consumer.authenticated = True
+        await consumer.dispatch_message({'type': 'call_service'})
+        self.assertEqual(consumer.calls, [
+            ('get_prices', 'get_prices'), ('get_prices', 'prices'), ('unauthenticated', 'call_service'),
+            ('unhandled', 'no_such_type'), ('unhandled', None), ('call_service', 'call_service'),
+        ])
+        # Unknown types share one label instead of creating metrics
+        self.assertEqual(self.counts('ws_messages'), {
+            'get_prices': 1, 'prices': 1, 'call_service': 2, dispatch.UNHANDLED: 2,
+        })
+        self.assertEqual(self.counts('ws_message_errors'), {
+            'get_prices': 0, 'prices': 0, 'call_service': 0, dispatch.UNHANDLED: 0,
+        })
+        self.assertEqual(self.metrics.histogram('ws_message_seconds', type='call_service').count, 2)
+
+    async def test_handler_exception_is_counted_and_raised(self):
+        consumer = Dispatcher()
+        with self.assertRaisesMessage(ValueError, "broken handler"):
+            await consumer.dispatch_message({'type': 'get_states'})
+        self.assertEqual(self.counts('ws_messages'), {'get_states': 1})
+        self.assertEqual(self.counts('ws_message_errors'), {'get_states': 1})
+        self.assertEqual(self.metrics.histogram('ws_message_seconds', type='get_states').count, 1)
+
+    def test_subclasses_inherit_and_override_handlers(self):
+        class Overriding(Dispatcher):
+            @handles('get_states')
+            async def handle_states(self, data):
+                pass
+        self.assertEqual(Overriding.handlers['get_states'].method, 'handle_states')
+        self.assertEqual(Overriding.handlers['get_prices'].method, 'handle_get_prices')
+        self.assertEqual(Dispatcher.handlers['get_states'].method, 'handle_get_states')
+        self.assertTrue(Dispatcher.handlers['call_service'].requires_auth)
+
+
+class PendingRequestsTests(SimpleTestCase):
+    """Relayed commands are answered once, or time out."""
+
+    async def test_unanswered_request_times_out(self):
+        pending = PendingRequests(timeout=0.05)
+        future = pending.register('browser', 1)
+        with self.assertRaises(asyncio.TimeoutError):
+            await future
+        self.assertEqual(len(pending), 0)
+        self.assertFalse(pending.resolve('browser', 1, {'id': 1}))
+
+    async def test_request_is_resolved_once(self):
+        pending = PendingRequests(timeout=1)
+        loop = asyncio.get_running_loop()
+
+        async def send():
+            loop.call_soon(pending.resolve, 'browser', '7', 'answer')
+        self.assertEqual(await pending.request('browser', 7, send), 'answer')
+        self.assertFalse(pending.resolve('browser', 7, 'duplicate'))
+
+    async def test_pending_requests_are_bounded_per_connection(self):
+        pending = PendingRequests(timeout=1, max_pending=2)
+        futures = [pending.register('a', 1), pending.register('a', 2)]
+        with self.assertRaises(TooManyPendingRequests):
+            pending.register('a', 3)
+        other = pending.register('b', 1)
+        pending.discard_owner('a')
+        self.assertTrue(all(future.cancelled() for future in futures))
+        self.assertEqual(len(pending), 1)
+        pending.discard_owner('b')
+        self.assertTrue(other.cancelled())
+
+
+class AdmissionTests(SimpleTestCase):
+    """Connections and authentications are rate limited and queued."""
+
+    def test_token_bucket_refills(self):
+        buckets = TokenBuckets(rate=2, burst=3)
+        with mock.patch('core.admission.time.monotonic', return_value=100.0) as monotonic:
+            self.assertEqual([buckets.take('a') for _ in range(3)], [0, 0, 0])
+            self.assertAlmostEqual(buckets.take('a'), 0.5)
+            # Other keys have their own bucket
+            self.assertEqual(buckets.take('b'), 0)
+            monotonic.return_value = 100.5
+            self.assertEqual(buckets.take('a'), 0)
+            self.assertGreater(buckets.take('a'), 0)
+        self.assertEqual(TokenBuckets(rate=0, burst=0).take('a'), 0)
+
+    def test_retry_after_is_jittered(self):
+        delays = {with_jitter(0.2) for _ in range(50)}
+        self.assertTrue(all(1 <= delay <= 2 for delay in delays))
+        self.assertGreater(len(delays), 1)
+
+    async def test_authentications_wait_for_a_slot(self):
+        controller = AdmissionController(concurrency=1, queue_timeout=0.05)
+        controller.sites = TokenBuckets(0, 0)
+        async with controller.authentication('a'):
+            with self.assertRaises(Throttled) as raised:
+                async with controller.authentication('b'):
+                    pass
+            self.assertEqual(raised.exception.reason, 'busy')
+        async with controller.authentication('b'):
+            self.assertEqual(controller.in_flight, 1)
+        self.assertEqual((controller.in_flight, controller.waiting), (0, 0))
+
+    async def test_site_authentications_are_rate_limited(self):
+        controller = AdmissionController()
+        controller.sites = TokenBuckets(rate=0.1, burst=1)
+        async with controller.authentication(('a@example.com', 'home')):
+            pass
+        with self.assertRaises(Throttled) as raised:
+            async with controller.authentication(('a@example.com', 'home')):
+                pass
+        self.assertEqual(raised.exception.reason, 'site')
+        self.assertGreaterEqual(raised.exception.retry_after, 9)
+
+
+class FakeRedisShard:
+    """The sorted set commands channels_redis uses for groups."""
+
+    def __init__(self):
+        self.sets = {}
+
+    async def zadd(self, key, mapping):
+        self.sets.setdefault(key, {}).update(mapping)
+
+    async def expire(self, key, seconds):
+        pass
+
+    async def zrem(self, key, member):
+        self.sets.get(key, {}).pop(member, None)
+
+    async def zrangebyscore(self, key, min, max):
+        return [member.encode() for member, score in self.sets.get(key, {}).items() if score >= min]
+
+    async def zcount(self, key, min, max):
+        return len(await self.zrangebyscore(key, min, max))
+
+
+class ChannelLayerTests(SimpleTestCase):
+    """Group membership is answered by the layer, for one process or sharded over Redis."""
+
+    async def assert_membership(self, layer):
+        self.assertFalse(await group_has_members('site_1', layer))
+        await layer.group_add('site_1', 'specific.a')
+        await layer.group_add('site_1', 'specific.b')
+        await layer.group_add('site_2', 'specific.a')
+        self.assertEqual(await group_channels('site_1', layer), {'specific.a', 'specific.b'})
+        self.assertEqual(await layer.group_size('site_1'), 2)
+        await layer.group_discard('site_1', 'specific.a')
+        await layer.group_discard('site_1', 'specific.unknown')
+        self.assertEqual(await group_channels('site_1', layer), {'specific.b'})
+        self.assertTrue(await group_has_members('site_2', layer))
+        await layer.group_discard('site_1', 'specific.b')
+        self.assertFalse(await group_has_members('site_1', layer))
+        self.assertEqual(await layer.group_size('site_1'), 0)
+
+    async def test_local_layer(self):
+        layer = LocalChannelLayer(group_expiry=60)
+        await self.assert_membership(layer)
+        # Members past the group expiry are not counted
+        await layer.group_add('site_3', 'specific.c')
+        with mock.patch('core.layers.time.time', return_value=time.time() + 61):
+            self.assertFalse(await group_has_members('site_3', layer))
+
+    @skipIf(layers.RedisChannelLayer is None, "channels_redis is not installed")
+    async def test_sharded_layer_routes_groups_to_their_shard(self):
+        layer = layers.ShardedChannelLayer(hosts=[f'redis://shard{n}' for n in range(4)], group_expiry=60)
+        shards = [FakeRedisShard() for _ in range(4)]
+        with mock.patch.object(layer, 'connection', side_effect=shards.__getitem__):
+            await self.assert_membership(layer)
+            groups = [f'site_{n}' for n in range(20)]
+            for group in groups:
+                await layer.group_add(group, 'specific.a')
+            for group in groups:
+                shard = shards[layer.consistent_hash(group)]
+                self.assertIn(layer._group_key(group), shard.sets)
+                self.assertEqual(sum(layer._group_key(group) in other.sets for other in shards), 1)
+            self.assertGreater(sum(bool(shard.sets) for shard in shards), 1)
+            with mock.patch('core.layers.time.time', return_value=time.time() + 61):
+                self.assertFalse(await group_has_members('site_0', layer))
+
+
+class HashingTests(SimpleTestCase):
+    """Passwords hashed and checked in worker processes agree with Django's hashers."""
+
+    async def test_pool_matches_sync_hashers(self):
+        pool = PasswordHashingPool(workers=1)
+        self.addCleanup(pool.shutdown)
+        encoded = await pool.make_password('secret')
+        self.assertEqual(encoded.split('$')[0], make_password('secret').split('$')[0])
+        self.assertTrue(check_password('secret', encoded))
+        self.assertTrue(await pool.check_password('secret', make_password('secret')))
+        self.assertFalse(await pool.check_password('wrong', encoded))
+        self.assertEqual(pool.pending, 0)
+
+    async def test_unavailable_pool_hashes_on_the_sync_thread(self):
+        pool = PasswordHashingPool(workers=1)
+        with mock.patch.object(pool, 'executor', side_effect=OSError("sem_open is not implemented")), \
+                self.assertLogs('core.hashing', 'WARNING'):
+            encoded = await pool.make_password('secret')
+            self.assertTrue(await pool.check_password('secret', encoded))
+        self.assertTrue(check_password('secret', encoded))
+        self.assertEqual(pool.pending, 0)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class PooledSQLiteWrapper(PooledDatabaseWrapperMixin, sqlite3_base.DatabaseWrapper):
+    pass
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    """Connections are reused across threads, bounded, aged out and checked."""
+
+    def test_connections_are_reused(self):
+        pool = ConnectionPool('test', max_size=2)
+        connection, new = pool.checkout(FakeConnection, lambda c: True)
+        self.assertTrue(new)
+        pool.checkin(connection)
+        self.assertEqual(pool.checkout(FakeConnection, lambda c: True), (connection, False))
+        pool.checkin(connection, reusable=False)
+        self.assertTrue(connection.closed)
+        self.assertIsNot(pool.checkout(FakeConnection, lambda c: True)[0], connection)
+
+    def test_checkout_waits_for_a_free_connection(self):
+        pool = ConnectionPool('test', max_size=1, timeout=0.05)
+        connection, _ = pool.checkout(FakeConnection, lambda c: True)
+        with self.assertRaises(PoolTimeout):
+            pool.checkout(FakeConnection, lambda c: True)
+        pool.timeout = 5
+        threading.Timer(0.05, pool.checkin, [connection]).start()
+        self.assertEqual(pool.checkout(FakeConnection, lambda c: True), (connection, False))
+
+    def test_old_and_broken_connections_are_replaced(self):
+        pool = ConnectionPool('test', max_size=1, max_age=0)
+        old, _ = pool.checkout(FakeConnection, lambda c: True)
+        pool.checkin(old)
+        self.assertTrue(old.closed)
+        pool = ConnectionPool('test', max_size=1, check_idle=0)
+        broken, _ = pool.checkout(FakeConnection, lambda c: True)
+        pool.checkin(broken)
+        connection, new = pool.checkout(FakeConnection, lambda c: False)
+        self.assertTrue(broken.closed)
+        self.assertTrue(new)
+        self.assertIsNot(connection, broken)
+
+    def test_connections_of_a_parent_process_are_left_alone(self):
+        pool = ConnectionPool('test', max_size=1)
+        inherited, _ = pool.checkout(FakeConnection, lambda c: True)
+        with mock.patch('core.backends.pool.os.getpid', return_value=-1):
+            # The child gets its own connections and keeps its hands off the parent's
+            connection, new = pool.checkout(FakeConnection, lambda c: True)
+            self.assertTrue(new)
+            pool.checkin(connection)
+            pool.checkin(inherited)
+        self.assertFalse(inherited.closed)
+
+    def test_backend_takes_connections_from_the_pool(self):
+        with tempfile.TemporaryDirectory() as directory:
+            settings_dict = {
+                **connection.settings_dict,
+                'NAME': f'{directory}/pooled.sqlite3',
+                'OPTIONS': {'pool': {'max_size': 1, 'timeout': 0.1}},
+            }
+            wrapper = PooledSQLiteWrapper(settings_dict, alias='pooled')
+            wrapper.ensure_connection()
+            first = wrapper.connection
+            wrapper.close()
+            wrapper.ensure_connection()
+            self.assertIs(wrapper.connection, first)
+            # Not handed back as it came out: closed instead of reused
+            wrapper.set_autocommit(False)
+            wrapper.close()
+            wrapper.ensure_connection()
+            self.assertIsNot(wrapper.connection, first)
+            with wrapper.cursor() as cursor:
+                cursor.execute('SELECT 1')
+                self.assertEqual(cursor.fetchone(), (1,))
+            pool = wrapper.get_pool()
+            wrapper.close()
+            self.assertEqual((pool._size, len(pool._idle)), (1, 1))
+            pool.checkout(lambda: None, lambda c: True)[0].close()
+
+
+@mock.patch('core.routers.replica_configured', return_value=True)
+class ReadReplicaRouterTests(SimpleTestCase):
+    """Dashboard reads go to the replica, except right after the session wrote."""
+
+    router = ReadReplicaRouter()
+
+    def test_reads_use_the_replica_only_when_asked(self, configured):
+        self.assertIsNone(self.router.db_for_read(Site))
+        with replica_reads():
+            self.assertEqual(self.router.db_for_read(Site), routers.DB_REPLICA)
+            # Sessions are written on every request
+            self.assertIsNone(self.router.db_for_read(Session))
+        self.assertEqual(self.router.db_for_write(Site), 'default')
+        self.assertFalse(self.router.allow_migrate(routers.DB_REPLICA, 'core'))
+        configured.return_value = False
+        with replica_reads():
+            self.assertIsNone(self.router.db_for_read(Site))
+
+    def test_session_reads_its_own_writes(self, configured):
+        session = {}
+        view = reads_from_replica(lambda request: self.router.db_for_read(Site))
+        request = RequestFactory().get('/')
+        request.session = session
+        self.assertEqual(view(request), routers.DB_REPLICA)
+        with mock.patch('core.routers.time.time', return_value=1000.0) as now:
+            mark_written(session)
+            self.assertIsNone(view(request))
+            now.return_value += routers.DB_REPLICA_STICKY
+            self.assertEqual(view(request), routers.DB_REPLICA)
+        # Other sessions were never sticky
+        with replica_reads({}):
+            self.assertEqual(self.router.db_for_read(Site), routers.DB_REPLICA)
+
+    async def test_scope_follows_into_database_threads(self, configured):
+        with replica_reads():
+            self.assertEqual(await run_sync(self.router.db_for_read)(Site), routers.DB_REPLICA)
+        self.assertIsNone(await run_sync(self.router.db_for_read)(Site))
+
+
+class PresenceTests(TransactionTestCase):
+    """Sites are online while this worker hears from them, otherwise as last flushed."""
+
+    def setUp(self):
+        user = User.objects.create(username="a@example.com", email="a@example.com")
+        self.site = Site.objects.create(user=user, name="home")
+
+    def test_expired_site_is_flushed_offline_and_forgotten(self):
+        registry = PresenceRegistry(ttl=0.05)
+        registry.online(self.site.pk)
+        self.assertTrue(registry.is_online(self.site.pk))
+        async_to_sync(registry.flush)()
+        self.site.refresh_from_db()
+        self.assertTrue(self.site.ws_connected)
+        time.sleep(0.1)
+        # The site may have moved to another worker: the database decides
+        self.assertIsNone(registry.is_online(self.site.pk))
+        self.assertEqual(async_to_sync(registry.flush)(), 1)
+        self.site.refresh_from_db()
+        self.assertFalse(self.site.ws_connected)
+        self.assertEqual(registry._last_seen, {})
+
+    def test_other_workers_sites_come_from_the_database(self):
+        registry = PresenceRegistry(ttl=60)
+        now = timezone.now()
+        Site.objects.filter(pk=self.site.pk).update(ws_connected=True, last_connected=now)
+        self.site.refresh_from_db()
+        self.assertEqual(registry.status(self.site), (True, now))
+        # A stale entry of this worker doesn't hide a reconnect elsewhere
+        registry.online(self.site.pk)
+        registry._expires[self.site.pk] = 0
+        self.assertEqual(registry.status(self.site)[0], True)
+        # Flushed by a worker that died long ago
+        self.site.last_connected = now - timedelta(minutes=5)
+        self.assertEqual(registry.status(self.site)[0], False)
+        self.site.ws_connected, self.site.last_connected = False, now
+        self.assertEqual(registry.status(self.site)[0], False)
+
+    def test_flusher_writes_coalesced_changes(self):
+        registry = PresenceRegistry(ttl=60, flush_interval=0.05)
+        other = Site.objects.create(user=self.site.user, name="cabin")
+
+        async def connect_and_wait():
+            registry.online(self.site.pk)
+            registry.online(other.pk)
+            for _ in range(10):
+                registry.heartbeat(self.site.pk)
+            registry.offline(other.pk)
+            await asyncio.sleep(0.2)
+            registry._flusher.cancel()
+        with CaptureQueriesContext(connection) as queries:
+            async_to_sync(connect_and_wait)()
+        self.assertEqual(len([q for q in queries.captured_queries if q['sql'].startswith('UPDATE')]), 1)
+        self.site.refresh_from_db()
+        other.refresh_from_db()
+        self.assertTrue(self.site.ws_connected)
+        self.assertEqual(self.site.last_connected, registry.last_seen(self.site.pk))
+        self.assertFalse(other.ws_connected)
+        self.assertIsNotNone(other.last_connected)
+
+
+class ConsumerTestCase(TransactionTestCase):
+    """Base for tests talking to the websocket consumers.
+
+    Transactional, as the consumers query the database from other threads.
+    Admission limits are lifted and consumer logging is silenced.
+    """
+
+    def setUp(self):
+        unlimited = AdmissionController(concurrency=100, queue_timeout=5)
+        unlimited.sources = unlimited.sites = TokenBuckets(0, 0)
+        for patcher in (
+            mock.patch.object(consumers, 'admission', unlimited),
+            mock.patch.object(consumers, 'print', lambda *args, **kwargs: None, create=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.application = URLRouter(websocket_urlpatterns)
+
+    async def connect(self, path, user=None):
+        communicator = WebsocketCommunicator(self.application, path)
+        if user is not None:
+            communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def connect_site(self):
+        """Register a site and return it with an authenticated HA and a browser connection."""
+        user, site = await consumers.register_site_owner("a@example.com", "Ada", None, "home")
+        ha = await self.connect('/ws/opp_energy/')
+        await ha.send_json_to({'type': 'authenticate', 'email': "a@example.com", 'site_name': "home"})
+        self.assertEqual((await ha.receive_json_from())['type'], 'auth_success')
+        browser = await self.connect(f'/ws/frontend/{site.id}/', user)
+        self.assertTrue((await browser.receive_json_from())['ha_connected'])
+        return site, ha, browser
+
+
+class AdmissionConsumerTests(ConsumerTestCase):
+    """Throttled HA connections are told when to retry and closed."""
+
+    async def test_reconnect_storm_is_throttled(self):
+        limited = AdmissionController()
+        limited.sources = TokenBuckets(rate=0.5, burst=1)
+        with mock.patch.object(consumers, 'admission', limited):
+            first = await self.connect('/ws/opp_energy/')
+            second = await self.connect('/ws/opp_energy/')
+            error = await second.receive_json_from()
+            self.assertEqual(error['code'], 'rate_limited')
+            self.assertGreaterEqual(error['retry_after'], 2)
+            closed = await second.receive_output()
+            self.assertEqual(closed, {'type': 'websocket.close', 'code': THROTTLED_CLOSE_CODE,
+                                      'reason': f"retry_after={error['retry_after']}"})
+            await first.send_json_to({'type': 'ping'})
+            self.assertEqual((await first.receive_json_from())['type'], 'pong')
+            await first.disconnect()
+
+
+class RelayTests(ConsumerTestCase):
+    """Commands relayed from a browser to the site's HA connection."""
+
+    async def test_malformed_frame_keeps_ha_connection(self):
+        site, ha, browser = await self.connect_site()
+        # The head peeks fine, the rest doesn't decode
+        await browser.send_to(text_data='{"type":"call_service","id":1, oops')
+        response = await browser.receive_json_from()
+        self.assertEqual((response['id'], response['success']), (1, False))
+        self.assertEqual(response['error']['code'], 'invalid_format')
+        await ha.send_json_to({'type': 'ping'})
+        self.assertEqual((await ha.receive_json_from())['type'], 'pong')
+        await browser.disconnect()
+        await ha.disconnect()
+
+    async def test_heartbeats_stay_off_the_ha_connection(self):
+        site, ha, browser = await self.connect_site()
+        await browser.send_json_to({'type': 'ping', 'id': 7})
+        self.assertEqual(await browser.receive_json_from(), {'type': 'pong', 'id': 7})
+        await browser.send_json_to({'type': 'pong'})
+        await ha.send_json_to({'type': 'pong'})
+        self.assertTrue(await browser.receive_nothing())
+        self.assertTrue(await ha.receive_nothing())
+        await browser.disconnect()
+        await ha.disconnect()
+
+    async def test_unanswered_command_times_out(self):
+        relayed = []
+
+        async def ignore(consumer, event):
+            relayed.append(event)
+        with mock.patch.object(consumers.OppEnergyConsumer, 'ha_command', ignore), \
+                mock.patch.object(pending_requests, 'timeout', 0.1):
+            site, ha, browser = await self.connect_site()
+            await browser.send_json_to({'type': 'call_service', 'id': 5})
+            response = await browser.receive_json_from(timeout=1)
+        self.assertEqual((response['id'], response['success']), (5, False))
+        self.assertEqual(response['error']['code'], 'timeout')
+        # An answer after the timeout is dropped
+        await get_channel_layer().send(relayed[0]['relay_channel'], response_event({'id': 5, 'success': True}))
+        self.assertTrue(await browser.receive_nothing())
+        await browser.disconnect()
+        await ha.disconnect()
+
+
+class RelayedRegistrationTests(ConsumerTestCase):
+    """A browser relaying user_registration doesn't replace the site's HA connection."""
+
+    async def test_relayed_registration_keeps_upstream(self):
+        site, ha, browser = await self.connect_site()
+        upstream = upstreams._local[str(site.id)]
+        await browser.send_json_to({
+            'type': 'user_registration', 'id': 1, 'user_name': "Ada", 'email': "a@example.com", 'site_name': "home",
+        })
+        self.assertEqual((await browser.receive_json_from())['type'], 'registration_success')
+        self.assertEqual(upstreams._local[str(site.id)], upstream)
+
+        await browser.disconnect()
+        self.assertEqual(upstreams._local[str(site.id)], upstream)
+        self.assertEqual(presence._connections.get(site.id), 1)
+        await ha.disconnect()
+        self.assertNotIn(str(site.id), upstreams._local)
+        self.assertNotIn(site.id, presence._connections)
+
+
+@skipIf('msgpack' not in wire.WIRES, "msgpack is not installed")
+class CompressedWireTests(ConsumerTestCase):
+    """Large frames are deflated on connections that negotiated +deflate."""
+
+    async def test_msgpack_deflate_round_trip(self):
+        import msgpack
+
+        user, site = await consumers.register_site_owner("a@example.com", "Ada", None, "home")
+        ha = await self.connect('/ws/opp_energy/')
+        await ha.send_json_to({'type': 'authenticate', 'email': "a@example.com", 'site_name': "home"})
+        self.assertEqual((await ha.receive_json_from())['type'], 'auth_success')
+        states = [
+            {'entity_id': f'sensor.power_{n}', 'state': str(n), 'attributes': {'friendly_name': f'Power {n}'}}
+            for n in range(500)
+        ]
+        await ha.send_json_to({'type': 'state_snapshot', 'states': states})
+        await ha.send_json_to({'type': 'ping'})
+        self.assertEqual((await ha.receive_json_from())['type'], 'pong')
+
+        browser = WebsocketCommunicator(
+            self.application, f'/ws/frontend/{site.id}/', subprotocols=['opp.msgpack+deflate', 'opp.json'],
+        )
+        browser.scope['user'] = user
+        self.assertEqual(await browser.connect(), (True, 'opp.msgpack+deflate'))
+        # Client frames may be compressed too
+        await browser.send_to(bytes_data=wire.deflate(msgpack.packb({'type': 'get_states', 'id': 1})))
+        while True:
+            frame = await browser.receive_from()
+            self.assertIsInstance(frame, bytes)
+            if frame[0] == wire.ZLIB_HEADER:
+                break
+            # Small frames, like the connection status, are sent as they are
+            self.assertNotEqual(msgpack.unpackb(frame).get('id'), 1)
+        self.assertLess(len(frame), wire.COMPRESSION_THRESHOLD)
+        result = msgpack.unpackb(wire.inflate(frame))
+        self.assertEqual((result['id'], result['success']), (1, True))
+        self.assertEqual(len(result['result']), 500)
+        self.assertEqual(result['result']['sensor.power_7']['attributes'], {'friendly_name': 'Power 7'})
+        await browser.disconnect()
+        await ha.disconnect()
+
+
+class IdleSchedulerTests(SimpleTestCase):
+    """Silent connections are pinged half way to their timeout, then closed."""
+
+    def consumer(self, name, keepalive=True):
+        return mock.Mock(channel_name=name, keepalive=keepalive,
+                         send_keepalive=mock.AsyncMock(), close=mock.AsyncMock())
+
+    async def test_silent_connection_is_pinged_then_closed(self):
+        scheduler, consumer = IdleScheduler(), self.consumer('silent')
+        scheduler.track(consumer, 0.2)
+        await asyncio.sleep(0.15)
+        consumer.send_keepalive.assert_awaited_once()
+        consumer.close.assert_not_called()
+        await asyncio.sleep(0.1)
+        consumer.close.assert_awaited_once_with(code=IDLE_CLOSE_CODE)
+        self.assertEqual(len(scheduler), 0)
+
+    async def test_answered_ping_keeps_connection(self):
+        scheduler, consumer = IdleScheduler(), self.consumer('answering')
+        consumer.send_keepalive.side_effect = lambda: scheduler.touch(consumer)
+        scheduler.track(consumer, 0.2)
+        await asyncio.sleep(0.5)
+        consumer.close.assert_not_called()
+        self.assertGreaterEqual(consumer.send_keepalive.await_count, 3)
+        scheduler.untrack(consumer)
+
+    async def test_without_keepalive_silent_connection_is_closed(self):
+        scheduler, consumer = IdleScheduler(), self.consumer('plain', keepalive=False)
+        scheduler.track(consumer, 0.1)
+        await asyncio.sleep(0.15)
+        consumer.send_keepalive.assert_not_called()
+        consumer.close.assert_awaited_once_with(code=IDLE_CLOSE_CODE)
+
+
+class StateCacheTests(ConsumerTestCase):
+    """get_states is answered from the site's state cache once HA sent a snapshot."""
+
+    async def receive_result(self, communicator, command_id):
+        """Skip state_update frames until the answer to ``command_id``."""
+        while True:
+            message = await communicator.receive_json_from()
+            if message.get('id') == command_id:
+                return message
+
+    async def handled(self, ha):
+        """Wait until the HA connection handled what it was sent; it does so in order."""
+        await ha.send_json_to({'type': 'ping'})
+        self.assertEqual((await ha.receive_json_from())['type'], 'pong')
+
+    async def test_get_states_delta(self):
+        site, ha, browser = await self.connect_site()
+        await ha.send_json_to({'type': 'state_snapshot', 'states': [
+            {'entity_id': 'light.a', 'state': 'on'}, {'entity_id': 'light.b', 'state': 'off'},
+        ]})
+        await self.handled(ha)
+        await browser.send_json_to({'type': 'get_states', 'id': 1})
+        full = await self.receive_result(browser, 1)
+        self.assertEqual((full['delta'], full['version'], sorted(full['result'])), (False, 2, ['light.a', 'light.b']))
+
+        await ha.send_json_to({'type': 'state_changed', 'entity_id': 'light.b', 'new_state': None})
+        await ha.send_json_to({'type': 'event', 'event': {'event_type': 'state_changed', 'data': {
+            'entity_id': 'light.a', 'new_state': {'entity_id': 'light.a', 'state': 'off'},
+        }}})
+        await self.handled(ha)
+        await browser.send_json_to({'type': 'get_states', 'id': 2, 'since_version': 2, 'epoch': full['epoch']})
+        delta = await self.receive_result(browser, 2)
+        self.assertEqual((delta['delta'], delta['version'], delta['removed']), (True, 4, ['light.b']))
+        self.assertEqual(delta['result'], {'light.a': {'entity_id': 'light.a', 'state': 'off'}})
+        await browser.disconnect()
+        await ha.disconnect()
+
+    async def test_dropped_state_frame_forces_a_full_snapshot(self):
+        site, ha, browser = await self.connect_site()
+        await ha.send_json_to({'type': 'state_snapshot', 'states': [
+            {'entity_id': 'light.a', 'state': 'on'}, {'entity_id': 'light.b', 'state': 'off'},
+        ]})
+        await self.handled(ha)
+        await browser.send_json_to({'type': 'get_states', 'id': 1})
+        full = await self.receive_result(browser, 1)
+        # Skip the state_update frame of the snapshot
+        while not await browser.receive_nothing(0.3):
+            await browser.receive_json_from()
+        put = OutboundQueue.put
+
+        def shedding(queue, frame, low_priority=False, key=None):
+            return None if low_priority else put(queue, frame, low_priority, key)
+        with mock.patch.object(OutboundQueue, 'put', shedding):
+            await ha.send_json_to({'type': 'state_changed', 'entity_id': 'light.b', 'new_state': None})
+            await self.handled(ha)
+            await asyncio.sleep(0.3)
+        await ha.send_json_to({'type': 'state_changed', 'entity_id': 'light.a',
+                               'new_state': {'entity_id': 'light.a', 'state': 'off'}})
+        update = await browser.receive_json_from()
+        self.assertEqual(update['result']['states'], {'light.a': {'entity_id': 'light.a', 'state': 'off'}})
+        self.assertIs(update['result']['resync'], True)
+        # The delta since the last full snapshot would miss light.b
+        await browser.send_json_to({'type': 'get_states', 'id': 2, 'since_version': full['version'],
+                                    'epoch': full['epoch']})
+        snapshot = await self.receive_result(browser, 2)
+        self.assertEqual((snapshot['delta'], list(snapshot['result'])), (False, ['light.a']))
+        await browser.send_json_to({'type': 'get_states', 'id': 3, 'since_version': snapshot['version'],
+                                    'epoch': full['epoch']})
+        self.assertIs((await self.receive_result(browser, 3))['delta'], True)
+        await browser.disconnect()
+        await ha.disconnect()
+
+
+class RollupTests(TestCase):
+    """Old raw prices are rolled up batch by batch and deleted."""
+
+    def setUp(self):
+        self.hour = retention.retention_cutoff(90) - timedelta(days=1)
+        # 30 rows in one hour and 5 in the next; bulk_create sends no signals
+        EnergyPrice.objects.bulk_create([
+            EnergyPrice(
+                buy_price=Decimal(n), sell_price=Decimal(n) / 2,
+                timestamp=self.hour + timedelta(minutes=2 * n), valid_until=self.hour + timedelta(hours=2),
+            )
+            for n in range(35)
+        ])
+
+    def test_rollup(self):
+        deleted = mock.Mock()
+        post_delete.connect(deleted, sender=EnergyPrice)
+        self.addCleanup(post_delete.disconnect, deleted, sender=EnergyPrice)
+        with self.captureOnCommitCallbacks() as callbacks:
+            summary = retention.rollup_prices(days=90, batch_size=7)
+        self.assertEqual((summary['hours'], summary['deleted']), (2, 35))
+        self.assertFalse(EnergyPrice.objects.exists())
+        first = EnergyPriceHourly.objects.get(bucket=self.hour)
+        self.assertEqual((first.samples, first.buy_min, first.buy_max, first.buy_sum), (30, 0, 29, 435))
+        self.assertEqual(EnergyPriceHourly.objects.get(bucket=self.hour + timedelta(hours=1)).samples, 5)
+        self.assertEqual(EnergyPriceDaily.objects.get().samples, 35)
+        # No post_delete per row, so no price publish queued for past rows
+        deleted.assert_not_called()
+        self.assertEqual(callbacks, [])
+
+    def test_interrupted_rollup_counts_rows_once(self):
+        queryset_class = type(EnergyPrice.objects.all())
+        original = queryset_class._raw_delete
+        calls = []
+
+        def interrupted(queryset, using):
+            calls.append(using)
+            if len(calls) == 2:
+                raise DatabaseError("interrupted")
+            return original(queryset, using)
+
+        with mock.patch.object(queryset_class, '_raw_delete', interrupted):
+            with self.assertRaises(DatabaseError):
+                retention.rollup_prices(days=90, batch_size=7)
+        # The first batch was committed, the second rolled back
+        self.assertEqual(EnergyPriceHourly.objects.get().samples, 7)
+        self.assertEqual(EnergyPrice.objects.count(), 28)
+        retention.rollup_prices(days=90, batch_size=7)
+        self.assertEqual(EnergyPriceDaily.objects.get().samples, 35)
+        self.assertFalse(EnergyPrice.objects.exists())
+
+
+class CurrentPriceResolverTests(TestCase):
+    """The current price is cached until it may have changed."""
+
+    def setUp(self):
+        self.now = timezone.now()
+        EnergyPrice.objects.bulk_create([EnergyPrice(
+            buy_price=Decimal('0.25'), sell_price=Decimal('0.05'),
+            timestamp=self.now - timedelta(minutes=5), valid_until=self.now + timedelta(hours=1),
+        )])
+        prices.price_resolver.invalidate()
+        self.addCleanup(prices.price_resolver.invalidate)
+
+    def add_price(self, buy_price, start):
+        # bulk_create sends no post_save, so nothing invalidates the cache
+        EnergyPrice.objects.bulk_create([EnergyPrice(
+            buy_price=Decimal(buy_price), sell_price=Decimal('0.05'),
+            timestamp=start, valid_until=start + timedelta(hours=1),
+        )])
+
+    def test_cached_within_the_ttl(self):
+        resolver = prices.CurrentPriceResolver(max_age=60)
+        with mock.patch('django.utils.timezone.now', return_value=self.now):
+            self.assertEqual(resolver.resolve()['buy_price'], 0.25)
+        self.add_price('0.30', self.now - timedelta(minutes=1))
+        with mock.patch('django.utils.timezone.now', return_value=self.now + timedelta(seconds=59)):
+            with self.assertNumQueries(0):
+                self.assertEqual(resolver.resolve()['buy_price'], 0.25)
+        # Refreshed once the cache expires
+        with mock.patch('django.utils.timezone.now', return_value=self.now + timedelta(seconds=60)):
+            self.assertEqual(resolver.resolve()['buy_price'], 0.30)
+
+    def test_expires_at_the_next_price_boundary(self):
+        resolver = prices.CurrentPriceResolver(max_age=3600)
+        self.add_price('0.40', self.now + timedelta(minutes=10))
+        self.assertEqual(resolver.resolve()['buy_price'], 0.25)
+        with mock.patch('django.utils.timezone.now', return_value=self.now + timedelta(minutes=9)):
+            self.assertEqual(resolver.cached()['buy_price'], 0.25)
+        with mock.patch('django.utils.timezone.now', return_value=self.now + timedelta(minutes=10)):
+            self.assertIsNone(resolver.cached())
+            self.assertEqual(resolver.resolve()['buy_price'], 0.40)
+
+    def test_refreshed_after_a_save(self):
+        self.assertEqual(prices.current_prices()['buy_price'], 0.25)
+        with self.captureOnCommitCallbacks(execute=True):
+            EnergyPrice.objects.create(
+                buy_price=Decimal('0.35'), sell_price=Decimal('0.05'),
+                timestamp=self.now - timedelta(minutes=1), valid_until=self.now + timedelta(hours=1),
+            )
+        # Invalidated by the publish after commit, which resolved it again
+        self.assertEqual(prices.price_resolver.cached()['buy_price'], 0.35)
+        self.assertEqual(prices.current_prices()['buy_price'], 0.35)
+
+
+class PricePublishTests(TestCase):
+    """Price changes reach subscribers once the transaction commits, and only then."""
+
+    def setUp(self):
+        self.layer = LocalChannelLayer()
+        patcher = mock.patch.object(prices, 'get_channel_layer', return_value=self.layer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(prices.price_resolver.invalidate)
+        self.channel = async_to_sync(self.layer.new_channel)()
+        async_to_sync(self.layer.group_add)(prices.PRICES_GROUP, self.channel)
+
+    def received(self):
+        async def drain():
+            events = []
+            while True:
+                try:
+                    events.append(await asyncio.wait_for(self.layer.receive(self.channel), 0.05))
+                except asyncio.TimeoutError:
+                    return events
+        return async_to_sync(drain)()
+
+    def create_price(self):
+        now = timezone.now()
+        return EnergyPrice.objects.create(
+            buy_price=Decimal('0.42'), sell_price=Decimal('0.07'),
+            timestamp=now - timedelta(minutes=1), valid_until=now + timedelta(hours=1),
+        )
+
+    def test_save_pushes_one_update_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.create_price()
+            # Nothing is sent before the commit
+            self.assertEqual(self.received(), [])
+        self.assertEqual(len(callbacks), 1)
+        [event] = self.received()
+        self.assertEqual((event['type'], event['changed']), ('price.broadcast', True))
+        update, schedule = [codec.loads(frame) for frame in event['frames']]
+        self.assertEqual(update['data']['buy_price'], 0.42)
+        self.assertEqual(schedule['data']['schedule'][0]['buy_price'], 0.42)
+
+    def test_rollback_pushes_nothing(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(DatabaseError):
+                with transaction.atomic():
+                    self.create_price()
+                    raise DatabaseError("rolled back")
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.received(), [])
+        self.assertFalse(EnergyPrice.objects.exists())
+
+
+class PriceBroadcasterTests(SimpleTestCase):
+    """Each subscriber gets one periodic price update, whatever the number of workers."""
+
+    async def test_tick_reaches_local_subscribers_only(self):
+        layer = LocalChannelLayer()
+        # Two worker processes sharing the channel layer, one subscriber each
+        workers = [prices.PriceBroadcaster(interval=3600), prices.PriceBroadcaster(interval=3600)]
+        channels = [await layer.new_channel() for _ in workers]
+        with mock.patch.object(prices, 'get_channel_layer', return_value=layer), \
+                mock.patch.object(prices, 'get_current_prices', mock.AsyncMock(return_value=prices.DEFAULT_PRICES)), \
+                mock.patch.object(prices, 'price_frames', mock.AsyncMock(return_value=['{}', '{}'])):
+            for worker, channel in zip(workers, channels):
+                await worker.subscribe(channel, layer)
+            for worker in workers:
+                await worker.broadcast()
+            for channel in channels:
+                self.assertFalse((await layer.receive(channel))['changed'])
+                with self.assertRaises(asyncio.TimeoutError):
+                    await asyncio.wait_for(layer.receive(channel), 0.05)
+            # A change is published once, to every subscriber
+            await workers[0].publish()
+            for channel in channels:
+                self.assertTrue((await layer.receive(channel))['changed'])
+            for worker, channel in zip(workers, channels):
+                await worker.unsubscribe(channel, layer)
+
+
+class SiteStatesTests(SimpleTestCase):
+    """Entity states are versioned so clients can ask for what changed."""
+
+    def test_delta_since_version(self):
+        states = SiteStates()
+        states.replace({'light.a': {'state': 'on'}, 'light.b': {'state': 'off'}})
+        self.assertEqual(states.version, 2)
+        # Unchanged states get no version
+        self.assertEqual(states.apply('light.a', {'state': 'on'}), 2)
+        states.apply('light.a', {'state': 'off'})
+        states.apply('light.b', None)
+        delta = states.snapshot(since_version=2, epoch=states.epoch)
+        self.assertEqual((delta['delta'], delta['version']), (True, 4))
+        self.assertEqual((delta['states'], delta['removed']), ({'light.a': {'state': 'off'}}, ['light.b']))
+        self.assertEqual(states.snapshot(since_version=4)['states'], {})
+
+    def test_full_snapshot_for_other_epoch_or_lost_tombstones(self):
+        states = SiteStates()
+        states.replace({f'sensor.{n}': {'state': n} for n in range(4)})
+        other_epoch = states.snapshot(since_version=4, epoch='restarted')
+        self.assertEqual((other_epoch['delta'], len(other_epoch['states'])), (False, 4))
+        with mock.patch('core.states.MAX_TOMBSTONES', 2):
+            for n in range(3):
+                states.apply(f'sensor.{n}', None)
+        self.assertFalse(states.snapshot(since_version=4)['delta'])
+        self.assertEqual(states.snapshot(since_version=5)['removed'], ['sensor.1', 'sensor.2'])
+
+
+class OutboundQueueTests(SimpleTestCase):
+    """Outbound queues shed state traffic first and drop clients that fall behind."""
+
+    def queue(self, **limits):
+        release = asyncio.Event()
+        written = []
+
+        async def write(frame):
+            await release.wait()
+            written.append(frame)
+        queue = OutboundQueue(write, mock.AsyncMock(), 'test', **limits)
+        return queue, written, release
+
+    async def test_low_priority_frames_are_dropped_first(self):
+        queue, written, release = self.queue(max_frames=6)
+        for n in range(4):
+            queue.put(f'response {n}')
+        # Half the limit is queued: state frames go, responses still queue
+        self.assertIsNone(queue.put('state', low_priority=True, key='light.a'))
+        self.assertIsNotNone(queue.put('response 4'))
+        release.set()
+        await queue.drain()
+        self.assertEqual(written, [f'response {n}' for n in range(5)])
+        queue.on_overflow.assert_not_called()
+
+    async def test_slow_client_is_disconnected(self):
+        queue, written, release = self.queue(max_frames=3)
+        queue.put('response 0')
+        # Taken by the writer, which then hangs
+        await asyncio.sleep(0)
+        for n in range(1, 4):
+            queue.put(f'response {n}')
+        self.assertEqual(len(queue), 3)
+        self.assertIsNone(queue.put('response 4'))
+        await asyncio.sleep(0)
+        self.assertTrue(queue.closed)
+        self.assertEqual((len(queue), queue.bytes), (0, 0))
+        queue.on_overflow.assert_awaited_once()
+        self.assertIsNone(queue.put('response 5'))
+
+    async def test_frame_waiting_too_long_disconnects(self):
+        queue, written, release = self.queue(max_delay=0.05)
+        queue.put('first')
+        queue.put('second')
+        await asyncio.sleep(0.1)
+        queue.put('third')
+        await asyncio.sleep(0)
+        self.assertTrue(queue.closed)
+        queue.on_overflow.assert_awaited_once()
+
+
+class StateUpdateBufferTests(SimpleTestCase):
+    """State updates go out as one frame per window, without waiting for the socket."""
+
+    def outbound(self, **limits):
+        written, release = [], asyncio.Event()
+
+        async def write(frame):
+            await release.wait()
+            written.append(json.loads(frame))
+        return OutboundQueue(write, mock.AsyncMock(), 'test', **limits), written, release
+
+    def buffer(self, queue, window=0):
+        async def send(message, key):
+            return queue.put(json.dumps(message), low_priority=True, key=key) is not None
+        return StateUpdateBuffer(send, window=window, queue=lambda: queue)
+
+    async def test_updates_merge_into_the_queued_frame(self):
+        queue, written, release = self.outbound()
+        buffer = self.buffer(queue)
+        await buffer.add({'states': {'light.a': {'state': 'on'}}, 'version': 1})
+        # Taken by the writer, which then hangs
+        await asyncio.sleep(0)
+        # Returns although nothing can be written
+        await asyncio.wait_for(buffer.add({'states': {'light.b': {'state': 'on'}}, 'version': 2}), 1)
+        await buffer.add({'states': {'light.a': {'state': 'off'}}, 'version': 3})
+        queue.put(json.dumps({'id': 1, 'type': 'result'}))
+        # Not merged past the response, which would send light.b back in time
+        await buffer.add({'states': {}, 'removed': ['light.b'], 'version': 4})
+        release.set()
+        await queue.drain()
+        self.assertEqual([message.get('result', message) for message in written], [
+            {'type': 'state_update', 'states': {'light.a': {'state': 'on'}}, 'removed': [], 'version': 1, 'epoch': None},
+            {'type': 'state_update', 'states': {'light.b': {'state': 'on'}, 'light.a': {'state': 'off'}},
+             'removed': [], 'version': 3, 'epoch': None},
+            {'id': 1, 'type': 'result'},
+            {'type': 'state_update', 'states': {}, 'removed': ['light.b'], 'version': 4, 'epoch': None},
+        ])
+
+    async def test_dropped_frame_asks_for_resync(self):
+        queue, written, release = self.outbound(max_frames=2)
+        queue.put(json.dumps({'id': 1}))
+        await asyncio.sleep(0)
+        queue.put(json.dumps({'id': 2}))
+        # Half the queue is full: the state frame is dropped
+        buffer = self.buffer(queue)
+        await buffer.add({'states': {'light.a': {'state': 'on'}}, 'version': 1})
+        self.assertTrue(buffer.needs_resync)
+        release.set()
+        await queue.drain()
+        await buffer.add({'states': {'light.b': {'state': 'on'}}, 'version': 2})
+        await queue.drain()
+        self.assertEqual(written[-1]['result']['states'], {'light.b': {'state': 'on'}})
+        self.assertIs(written[-1]['result']['resync'], True)
+
+    async def test_burst_is_merged_within_the_window(self):
+        send = mock.AsyncMock()
+        buffer = StateUpdateBuffer(send, window=50)
+        for n in range(10):
+            await buffer.add({'states': {'light.a': {'state': n}, 'light.b': {'state': n}}, 'version': n, 'epoch': 'e'})
+        await buffer.add({'states': {}, 'removed': ['light.b'], 'version': 10, 'epoch': 'e'})
+        send.assert_not_called()
+        await asyncio.sleep(0.1)
+        send.assert_awaited_once_with({'type': 'result', 'result': {
+            'type': 'state_update', 'states': {'light.a': {'state': 9}}, 'removed': ['light.b'],
+            'version': 10, 'epoch': 'e',
+        }}, mock.ANY)
+        # Buffered updates are dropped on close
+        await buffer.add({'states': {'light.c': {'state': 'on'}}, 'version': 11})
+        buffer.close()
+        await asyncio.sleep(0.1)
+        self.assertEqual(send.await_count, 1)
+
+    async def test_window_backs_off_while_frames_are_queued(self):
+        class Backlog(list):
+            def tail_key(self):
+                return None
+        backlog = Backlog(['frame'] * 3)
+        buffer = StateUpdateBuffer(mock.AsyncMock(), window=100, max_window=300, queue=lambda: backlog)
+        for _ in range(3):
+            buffer._states['light.a'] = {'state': 'on'}
+            await buffer.flush()
+        self.assertEqual(buffer.window, 0.3)
+        backlog.clear()
+        for _ in range(10):
+            buffer._states['light.a'] = {'state': 'on'}
+            await buffer.flush()
+        self.assertEqual(buffer.window, 0.1)
+
+
+class HistoryTests(TransactionTestCase):
+    """History pages are streamed in chunks and made of whole buckets."""
+
+    def setUp(self):
+        # One row per hour for two days, old enough to be rolled up
+        self.day = retention.retention_cutoff(90) - timedelta(days=3)
+        EnergyPrice.objects.bulk_create([
+            EnergyPrice(
+                buy_price=Decimal(n), sell_price=Decimal(1),
+                timestamp=self.day + timedelta(hours=n), valid_until=self.day + timedelta(days=3),
+            )
+            for n in range(48)
+        ])
+
+    def page(self, bucket, limit, start=None, end=None, after=None):
+        async def read():
+            return ''.join([piece async for piece in history.stream_history_json(start, end, bucket, limit, after)])
+        return codec.loads(async_to_sync(read)())
+
+    def test_chunked_pages(self):
+        with mock.patch.object(history, 'HISTORY_CHUNK_SIZE', 5):
+            first = self.page('raw', 12)
+            self.assertEqual(first['count'], 12)
+            self.assertEqual([row['buy_price'] for row in first['results']], list(range(12)))
+            second = self.page('raw', 40, after=history._parse_cursor(first['next_cursor'], 'raw'))
+        self.assertEqual([row['buy_price'] for row in second['results']], list(range(12, 48)))
+        self.assertIsNone(second['next_cursor'])
+
+    def test_wsgi_view_streams_synchronously(self):
+        request = RequestFactory().get('/', {'bucket': 'raw', 'limit': 12})
+        request.user = User.objects.create_user('history', 'history@example.com', 'pw')
+        with mock.patch.object(history, 'HISTORY_CHUNK_SIZE', 5):
+            response = views.price_history_view(request)
+            self.assertFalse(response.is_async)
+            body = b''.join(response.streaming_content)
+            self.assertEqual(codec.loads(body), self.page('raw', 12))
+
+    def test_first_and_last_buckets_are_whole_in_both_tiers(self):
+        start = self.day + timedelta(hours=10, minutes=30)
+        end = self.day + timedelta(days=1, hours=5)
+        raw_tier = self.page('day', 10, start, end)
+        retention.rollup_prices(days=90)
+        rollup_tier = self.page('day', 10, start, end)
+        self.assertEqual(raw_tier, rollup_tier)
+        self.assertEqual([row['samples'] for row in raw_tier['results']], [24, 24])
+        self.assertEqual(raw_tier['results'][0]['bucket'], self.day.isoformat())
+
+    def test_reads_join_rollups_with_raw_rows(self):
+        # Two more days up to and past the retention cutoff, kept raw
+        cutoff = retention.retention_cutoff(90)
+        EnergyPrice.objects.bulk_create([
+            EnergyPrice(
+                buy_price=Decimal(n % 7), sell_price=Decimal(2),
+                timestamp=cutoff + timedelta(hours=n - 24, minutes=20), valid_until=cutoff + timedelta(days=2),
+            )
+            for n in range(48)
+        ])
+        start, end = self.day, cutoff + timedelta(days=1)
+        before = {bucket: self.page(bucket, 200, start, end) for bucket in ('hour', 'day', 'week')}
+        retention.rollup_prices(days=90)
+        self.assertEqual(EnergyPrice.objects.filter(timestamp__lt=cutoff).count(), 0)
+        self.assertEqual(retention.rollup_watermark(), cutoff)
+        for bucket, page in before.items():
+            with self.subTest(bucket=bucket):
+                self.assertEqual(self.page(bucket, 200, start, end), page)
+        self.assertEqual(len(before['hour']['results']), 96)
+        self.assertEqual(sum(row['samples'] for row in before['day']['results']), 96)
@@ -5,4 +5,8 @@ urlpatterns = [
     path('wstest/', views.wstest, name='wstest'),
     path('register_site/', views.register_site, name='register_site'),
     path('update_price/', views.update_price, name='update_price'),
+    path('update_prices/bulk/', views.bulk_update_prices, name='bulk_update_prices'),
+    path('current_price/', views.current_price, name='current_price'),
+    path('prices/history/', views.price_history_view, name='price_history'),
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
\ No newline at end of file
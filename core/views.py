@@ -1,8 +1,17 @@
-from django.http import JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.decorators import login_required
-import json
+from django.contrib.admin.views.decorators import staff_member_required
 from .models import Site, EnergyPrice  # Updated import
+from . import codec
+from .codec import JsonResponse
+from .history import HistoryQueryError, iter_history_json, parse_history_params, stream_history_json
+from .ingest import IngestError, detect_format, ingest_prices, iter_rows
+from .metrics import metrics
+from .presence import presence
+from .prices import current_prices
+from .routers import mark_written
 from django.shortcuts import render, get_object_or_404
 from datetime import datetime
 
@@ -17,7 +26,7 @@ def wstest(request):
 @login_required
 def register_site(request):
     if request.method == 'POST':
-        data = json.loads(request.body)
+        data = codec.loads(request.body)
         
         # Check if a site with this name already exists for the user
         site, created = Site.objects.get_or_create(
@@ -34,6 +43,7 @@ def register_site(request):
         if not created and data.get('site_id') and site.site_id != data.get('site_id'):
             site.site_id = data.get('site_id')
             site.save()
+        mark_written(request.session)
             
         return JsonResponse({'status': 'success', 'site_id': site.id, 'site_id': site.site_id})
     return JsonResponse({'status': 'error'}, status=405)
@@ -42,7 +52,7 @@ def register_site(request):
 @login_required
 def update_price(request):
     if request.method == 'POST':
-        data = json.loads(request.body)
+        data = codec.loads(request.body)
         try:
             # Create energy price record - no relation to site
             price = EnergyPrice.objects.create(
@@ -59,15 +69,76 @@ def update_price(request):
             }, status=500)
     return JsonResponse({'status': 'error'}, status=405)
 
+@csrf_exempt
+@login_required
+def bulk_update_prices(request):
+    if request.method == 'POST':
+        # Parse the body incrementally from the request stream instead of
+        # json.loads(request.body), so large uploads don't sit in memory
+        try:
+            fmt = detect_format(request)
+            result = ingest_prices(iter_rows(request, fmt))
+        except IngestError as e:
+            return JsonResponse({
+                'status': 'error',
+                'message': str(e)
+            }, status=400)
+        except Exception as e:
+            return JsonResponse({
+                'status': 'error',
+                'message': str(e)
+            }, status=500)
+        status = 'success' if not result['rejected'] else 'partial'
+        return JsonResponse({'status': status, **result})
+    return JsonResponse({'status': 'error'}, status=405)
+
+@login_required
+def current_price(request):
+    if request.method == 'GET':
+        # Served from the in-process price cache in the common case
+        prices = current_prices()
+        return JsonResponse({
+            'status': 'success',
+            'buy_price': prices['buy_price'],
+            'sell_price': prices['sell_price']
+        })
+    return JsonResponse({'status': 'error'}, status=405)
+
+@login_required
+def price_history_view(request):
+    if request.method == 'GET':
+        try:
+            start, end, bucket, limit, after = parse_history_params(request.GET)
+        except HistoryQueryError as e:
+            return JsonResponse({
+                'status': 'error',
+                'message': str(e)
+            }, status=400)
+        # Rows are aggregated by the database and streamed out a chunk at a
+        # time: read on the database threads under ASGI, and in the request
+        # thread under WSGI, which would buffer an async iterator in full
+        stream = stream_history_json if isinstance(request, ASGIRequest) else iter_history_json
+        return StreamingHttpResponse(
+            stream(start, end, bucket, limit, after),
+            content_type='application/json'
+        )
+    return JsonResponse({'status': 'error'}, status=405)
+
+@staff_member_required
+def metrics_view(request):
+    # Counters and histograms of the worker process that serves the request
+    return JsonResponse(metrics.snapshot())
+
 # New view to check site connection status
 @login_required
 def site_status(request, site_id):
     site = get_object_or_404(Site, id=site_id, user=request.user)
+    connected, last_connected = presence.status(site)
     
     return JsonResponse({
         'id': site.id,
         'name': site.name,
         'site_id': site.site_id,
-        'connected': site.ws_connected,
-        'last_connected': site.last_connected.isoformat() if site.last_connected else None
+        'connected': connected,
+        'last_connected': last_connected.isoformat() if last_connected else None
     })
\ No newline at end of file
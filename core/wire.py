@@ -0,0 +1,193 @@
+"""Websocket frame encodings negotiated through the sub-protocol header.
+
+A client lists the encodings it accepts in ``Sec-WebSocket-Protocol``; the
+first one the server knows is selected when the connection is accepted:
+
+- ``opp.json``: JSON text frames. Also used when no sub-protocol is offered.
+- ``opp.msgpack``: MessagePack binary frames, if msgpack is installed.
+
+Either can be offered with a ``+deflate`` suffix (``opp.json+deflate``) to
+enable per-message compression: frames of at least
+OPP_WS_COMPRESSION_THRESHOLD bytes are sent as zlib streams in binary
+frames, smaller ones as usual. A zlib stream starts with 0x78, which no
+encoded message does (JSON text frames are text, and a MessagePack message
+is a map), so the receiver can tell them apart frame by frame. Clients may
+compress their frames the same way.
+
+The messages are the same whichever encoding carries them. Consumers use
+``WireProtocolMixin.send_message`` for outgoing messages and
+``decode_frame`` for incoming ones instead of touching JSON directly.
+"""
+import asyncio
+from functools import lru_cache
+import time
+import zlib
+
+from django.conf import settings
+
+from . import codec
+from .metrics import metrics
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional; JSON works without it
+    msgpack = None
+
+# Frames at least this many bytes long are compressed on +deflate connections
+COMPRESSION_THRESHOLD = getattr(settings, 'OPP_WS_COMPRESSION_THRESHOLD', 16 * 1024)
+# zlib level, capped at 6 so a large frame can't take unbounded CPU
+COMPRESSION_LEVEL = min(max(getattr(settings, 'OPP_WS_COMPRESSION_LEVEL', 3), 1), 6)
+# Frames this large are compressed in a worker thread (zlib releases the
+# GIL) instead of blocking the event loop
+COMPRESSION_THREAD_SIZE = 1024 * 1024
+# Largest decompressed frame accepted from a client
+MAX_INFLATED_SIZE = getattr(settings, 'OPP_WS_MAX_INFLATED_SIZE', 16 * 1024 * 1024)
+
+DEFLATE_SUFFIX = '+deflate'
+ZLIB_HEADER = 0x78
+RATIO_BUCKETS = (0.05, 0.1, 0.15, 0.2, 0.3, 0.4, 0.5, 0.6, 0.8, 1.0)
+
+
+class Wire:
+    """One frame encoding: how to turn a message into a frame and back."""
+
+    def __init__(self, name, subprotocol, binary, encode, decode):
+        self.name = name
+        self.subprotocol = subprotocol
+        self.binary = binary
+        self.encode = encode
+        self.decode = decode
+
+    def __repr__(self):
+        return f"<Wire {self.name}>"
+
+
+JSON_WIRE = Wire('json', 'opp.json', False, codec.dumps, codec.loads)
+WIRES = {'json': JSON_WIRE}
+
+if msgpack is not None:
+
+    def _msgpack_encode(message):
+        return msgpack.packb(message, default=codec.default, use_bin_type=True)
+
+    def _msgpack_decode(frame):
+        try:
+            return msgpack.unpackb(frame, raw=False, strict_map_key=False)
+        except (ValueError, TypeError, msgpack.UnpackException) as e:
+            raise codec.DecodeError(f"Invalid MessagePack frame: {e}", '', 0) from None
+
+    MSGPACK_WIRE = Wire('msgpack', 'opp.msgpack', True, _msgpack_encode, _msgpack_decode)
+    WIRES['msgpack'] = MSGPACK_WIRE
+
+# Sub-protocol name -> (wire, compressed)
+SUBPROTOCOLS = {}
+for _wire in WIRES.values():
+    SUBPROTOCOLS[_wire.subprotocol] = (_wire, False)
+    SUBPROTOCOLS[_wire.subprotocol + DEFLATE_SUFFIX] = (_wire, True)
+
+
+def negotiate(offered):
+    """Return the first offered sub-protocol we support and its (wire, compressed)."""
+    for subprotocol in offered or ():
+        if subprotocol in SUBPROTOCOLS:
+            return subprotocol, SUBPROTOCOLS[subprotocol]
+    return None, (JSON_WIRE, False)
+
+
+def deflate(data, level=COMPRESSION_LEVEL):
+    return zlib.compress(data, level)
+
+
+def inflate(data, max_size=MAX_INFLATED_SIZE):
+    """Decompress a zlib frame, refusing to inflate past ``max_size`` bytes."""
+    decompressor = zlib.decompressobj()
+    try:
+        inflated = decompressor.decompress(data, max_size)
+    except zlib.error as e:
+        raise codec.DecodeError(f"Invalid compressed frame: {e}", '', 0) from None
+    if decompressor.unconsumed_tail:
+        raise codec.DecodeError(f"Compressed frame inflates past {max_size} bytes", '', 0)
+    return inflated
+
+
+@lru_cache(maxsize=32)
+def transcode_json(frame, wire_name):
+    """Re-encode a JSON text frame for another wire.
+
+    Cached because it is used for frames shared by many connections, such
+    as the price broadcasts.
+    """
+    return WIRES[wire_name].encode(codec.loads(frame))
+
+
+class WireProtocolMixin:
+    """Negotiate the frame encoding of a websocket consumer and use it."""
+
+    wire = JSON_WIRE
+    compress = False
+
+    async def accept(self, subprotocol=None):
+        """Accept the connection with the negotiated sub-protocol."""
+        if subprotocol is None:
+            subprotocol, (self.wire, self.compress) = negotiate(self.scope.get('subprotocols'))
+        await super().accept(subprotocol=subprotocol)
+
+    def inflate_frame(self, bytes_data):
+        """Return a binary frame decompressed if it is a zlib stream."""
+        if self.compress and bytes_data and bytes_data[0] == ZLIB_HEADER:
+            return inflate(bytes_data)
+        return bytes_data
+
+    def decode_frame(self, text_data=None, bytes_data=None):
+        """Decode an incoming frame. Text frames are always JSON."""
+        if bytes_data is not None:
+            bytes_data = self.inflate_frame(bytes_data)
+            if self.wire.binary:
+                return self.wire.decode(bytes_data)
+        return codec.loads(text_data if text_data is not None else bytes_data)
+
+    async def send_message(self, message, **options):
+        """Encode ``message`` for this connection and send it."""
+        return await self.send_frame(self.wire.encode(message), **options)
+
+    async def send_frame(self, frame, **options):
+        """Send an already encoded frame, compressed if it is large enough.
+
+        ``options`` are passed to ``write_frame``, whose result is
+        returned; see ``core.outbound.OutboundQueueMixin``.
+        """
+        if self.compress and len(frame) >= COMPRESSION_THRESHOLD:
+            frame = await self._deflate_frame(frame)
+        return await self.write_frame(frame, **options)
+
+    async def send_json_frame(self, frame, **options):
+        """Send a pre-serialized JSON text frame, re-encoded if needed."""
+        if self.wire is not JSON_WIRE:
+            frame = transcode_json(frame, self.wire.name)
+        return await self.send_frame(frame, **options)
+
+    async def write_frame(self, frame, **options):
+        """Write a frame to the socket; returns whether it was sent."""
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+        return True
+
+    async def _deflate_frame(self, frame):
+        data = frame.encode() if isinstance(frame, str) else frame
+        start = time.perf_counter()
+        if len(data) >= COMPRESSION_THREAD_SIZE:
+            compressed = await asyncio.to_thread(deflate, data)
+        else:
+            compressed = deflate(data)
+        metrics.histogram('ws_compression_seconds', wire=self.wire.name).observe(time.perf_counter() - start)
+        metrics.histogram('ws_compression_ratio', RATIO_BUCKETS, wire=self.wire.name).observe(
+            len(compressed) / len(data)
+        )
+        metrics.counter('ws_compression_bytes_in', wire=self.wire.name).inc(len(data))
+        metrics.counter('ws_compression_bytes_out', wire=self.wire.name).inc(len(compressed))
+        if len(compressed) >= len(data):
+            # Incompressible; the original frame is cheaper to send
+            return frame
+        return compressed
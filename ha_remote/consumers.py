@@ -12,26 +12,30 @@
 
 
 
-import json
 import logging
-import asyncio
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from channels.layers import get_channel_layer
-from django.shortcuts import get_object_or_404
+from django.shortcuts import aget_object_or_404
+from core import codec
+from core.db import run_sync
 from core.models import Site
+from core.relay import response_frame
+from core.idle import FRONTEND_IDLE_TIMEOUT, IdleTimeoutMixin
+from core.outbound import OutboundQueueMixin
+from core.wire import WireProtocolMixin
 
 # Import the integration's domain
 OPP_ENERGY_DOMAIN = 'opp_energy'
 
 _LOGGER = logging.getLogger(__name__)
 
-class HomeAssistantRelayConsumer(AsyncWebsocketConsumer):
+class HomeAssistantRelayConsumer(IdleTimeoutMixin, OutboundQueueMixin, WireProtocolMixin, AsyncWebsocketConsumer):
     """
     WebSocket consumer that relays commands to the existing OppEnergyConsumer
     for a specific site.
     """
     
+    idle_timeout = FRONTEND_IDLE_TIMEOUT
+    
     async def connect(self):
         # Get site ID from URL path
         self.site_id = self.scope['url_route']['kwargs']['site_id']
@@ -67,22 +71,21 @@ class HomeAssistantRelayConsumer(AsyncWebsocketConsumer):
         self.subscriptions = []
         
         # Send initial connection status
-        await self.send(text_data=json.dumps({
+        await self.send_message({
             "type": "auth_ok",
             "ha_connected": self.coordinator._is_connected()
-        }))
+        })
         
-    @database_sync_to_async
-    def verify_site_access(self):
+    async def verify_site_access(self):
         """Verify user has access to the specified site."""
         try:
-            site = get_object_or_404(Site, id=self.site_id, user=self.user)
+            site = await aget_object_or_404(Site, id=self.site_id, user=self.user)
             self.site = site
             return True
         except:
             return False
     
-    @database_sync_to_async
+    @run_sync
     def get_site_coordinator(self):
         """Get the OppEnergyDataUpdateCoordinator for this site."""
         # Get Home Assistant instance
@@ -126,17 +129,22 @@ class HomeAssistantRelayConsumer(AsyncWebsocketConsumer):
                     if callable(unsub):
                         unsub()
             
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """
         Receive command from frontend and relay to the OppEnergyDataUpdateCoordinator.
         """
         try:
-            message = json.loads(text_data)
+            message = self.decode_frame(text_data, bytes_data)
             message_type = message.get('type')
             message_id = message.get('id')
             
-            # Handle different message types
-            if message_type == 'get_states':
+            # Handle different message types; heartbeats only keep the
+            # connection from idling out
+            if message_type == 'ping':
+                await self.send_message({"type": "pong", "id": message_id})
+            elif message_type == 'pong':
+                pass
+            elif message_type == 'get_states':
                 await self.handle_get_states(message_id)
             elif message_type == 'call_service':
                 await self.handle_call_service(message)
@@ -146,18 +154,18 @@ class HomeAssistantRelayConsumer(AsyncWebsocketConsumer):
                 # Forward to coordinator
                 await self.forward_to_coordinator(message)
                 
-        except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({
+        except codec.DecodeError:
+            await self.send_message({
                 'type': 'error',
                 'error': 'Invalid JSON'
-            }))
+            })
         except Exception as e:
             _LOGGER.error(f"Error processing message: {str(e)}")
-            await self.send(text_data=json.dumps({
+            await self.send_message({
                 'type': 'error',
                 'id': message.get('id') if 'message' in locals() else None,
                 'error': str(e)
-            }))
+            })
     
     async def handle_get_states(self, message_id):
         """Handle get_states command."""
@@ -169,19 +177,19 @@ class HomeAssistantRelayConsumer(AsyncWebsocketConsumer):
             states = await self.coordinator._handle_get_states({})
             
             # Send the response
-            await self.send(text_data=json.dumps({
+            await self.send_message({
                 "type": "result",
                 "id": message_id,
                 "result": states
-            }))
+            })
             
         except Exception as e:
             _LOGGER.error(f"Error getting states: {str(e)}")
-            await self.send(text_data=json.dumps({
+            await self.send_message({
                 "type": "error",
                 "id": message_id,
                 "error": str(e)
-            }))
+            })
     
     async def handle_call_service(self, message):
         """Handle call_service command."""
@@ -205,19 +213,19 @@ class HomeAssistantRelayConsumer(AsyncWebsocketConsumer):
             })
             
             # Send the response
-            await self.send(text_data=json.dumps({
+            await self.send_message({
                 "type": "result",
                 "id": message.get('id'),
                 "result": result
-            }))
+            })
             
         except Exception as e:
             _LOGGER.error(f"Error calling service: {str(e)}")
-            await self.send(text_data=json.dumps({
+            await self.send_message({
                 "type": "error",
                 "id": message.get('id'),
                 "error": str(e)
-            }))
+            })
     
     async def handle_subscribe_events(self, message):
         """Handle subscribe_events command."""
@@ -243,19 +251,19 @@ class HomeAssistantRelayConsumer(AsyncWebsocketConsumer):
                 # The coordinator will forward events to us through the channel layer
                 
             # Send confirmation response
-            await self.send(text_data=json.dumps({
+            await self.send_message({
                 "type": "result",
                 "id": message.get('id'),
                 "result": {"subscribed": True, "subscription_id": subscription_id}
-            }))
+            })
             
         except Exception as e:
             _LOGGER.error(f"Error subscribing to events: {str(e)}")
-            await self.send(text_data=json.dumps({
+            await self.send_message({
                 "type": "error",
                 "id": message.get('id'),
                 "error": str(e)
-            }))
+            })
     
     async def forward_to_coordinator(self, message):
         """Forward message to the coordinator."""
@@ -270,19 +278,19 @@ class HomeAssistantRelayConsumer(AsyncWebsocketConsumer):
             response = await self.coordinator._send_message_with_response(message)
             
             # Send response back to client
-            await self.send(text_data=json.dumps({
+            await self.send_message({
                 "type": "result",
                 "id": message.get('id'),
                 "result": response
-            }))
+            })
             
         except Exception as e:
             _LOGGER.error(f"Error forwarding message to coordinator: {str(e)}")
-            await self.send(text_data=json.dumps({
+            await self.send_message({
                 "type": "error",
                 "id": message.get('id'),
                 "error": str(e)
-            }))
+            })
             
     async def ha_command(self, event):
         """Handle relayed command."""
@@ -291,13 +299,17 @@ class HomeAssistantRelayConsumer(AsyncWebsocketConsumer):
             
     async def ha_response(self, event):
         """Handle response from coordinator."""
-        # Send response back to frontend
-        await self.send(text_data=json.dumps(event['response']))
+        # Send response back to frontend, as received if it was relayed raw
+        # in the encoding this connection uses
+        await self.send_frame(response_frame(event, self.wire)[1])
         
     async def ha_event(self, event):
         """Handle event from Home Assistant."""
-        # Forward event to frontend
-        await self.send(text_data=json.dumps({
+        # Forward event to frontend. Events are low priority: a newer state
+        # of an entity replaces one still queued, and they are dropped
+        # rather than queued without bound for a slow client
+        entity_id = event['data'].get('entity_id') if isinstance(event['data'], dict) else None
+        await self.send_message({
             "type": event['event_type'],
             "data": event['data']
-        }))
\ No newline at end of file
+        }, low_priority=True, key=(event['event_type'], entity_id) if entity_id else None)
\ No newline at end of file
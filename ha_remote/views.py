@@ -1,20 +1,23 @@
 # ha_remote/views.py
-import json
 import logging
 from datetime import datetime
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponseForbidden, JsonResponse
+from django.http import HttpResponseForbidden
 from django.shortcuts import get_object_or_404, redirect, render
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 
+from core.codec import JsonResponse
 from core.models import Site
+from core.presence import presence
+from core.routers import mark_written, reads_from_replica
 
 # Get logger
 _LOGGER = logging.getLogger(__name__)
 
 @login_required
+@reads_from_replica
 def dashboard(request):
     """Show all available HA sites for the user"""
     # Get sites owned by the user
@@ -28,6 +31,7 @@ def dashboard(request):
     })
 
 @login_required
+@reads_from_replica
 def site_interface(request, site_id):
     """Interface for controlling a specific HA site"""
     site = get_object_or_404(Site, id=site_id)
@@ -44,18 +48,20 @@ def site_interface(request, site_id):
     })
 
 @login_required
+@reads_from_replica
 def site_status(request, site_id):
     """Check if a site has an active WebSocket connection."""
     site = get_object_or_404(Site, id=site_id, user=request.user)
     
-    # The site's connection status is stored in the database
-    # Just return that value
+    # Live presence comes from the registry; sites connected to another
+    # worker fall back to the values the presence flusher stored in the DB
+    connected, last_connected = presence.status(site)
     
     return JsonResponse({
         'id': site.id,
         'name': site.name,
-        'connected': site.ws_connected,
-        'last_connected': site.last_connected.isoformat() if site.last_connected else None
+        'connected': connected,
+        'last_connected': last_connected.isoformat() if last_connected else None
     })
 
 @login_required
@@ -71,6 +77,7 @@ def delete_site(request, site_id):
     # Delete the site
     site_name = site.name
     site.delete()
+    mark_written(request.session)
     
     messages.success(request, f"Site '{site_name}' has been deleted.")
     return redirect('dashboard')
@@ -160,32 +160,158 @@ TEMPLATES = [
 
 WSGI_APPLICATION = "opp_cloud.wsgi.application"
 
+# Database connections. With OPP_DB_POOL_SIZE > 0 each worker process (ASGI or
+# Passenger WSGI) keeps up to that many MySQL connections in a pool shared by its
+# threads, and a thread hands its connection back after every request or consumer
+# database call; under ASGI allow for OPP_DB_THREADS plus the shared sync thread.
+# A thread waits up to OPP_DB_POOL_TIMEOUT seconds for a free connection.
+# Connections are replaced after OPP_DB_POOL_MAX_AGE seconds and pinged before
+# reuse once idle for OPP_DB_POOL_CHECK_IDLE seconds. With 0, each thread keeps
+# its own connection for OPP_DB_CONN_MAX_AGE seconds, health checked per request.
+OPP_DB_POOL_SIZE = 10
+OPP_DB_POOL_TIMEOUT = 5
+OPP_DB_POOL_MAX_AGE = 600
+OPP_DB_POOL_CHECK_IDLE = 30
+OPP_DB_CONN_MAX_AGE = 60
+
 # Database settings
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.mysql',
+        'ENGINE': 'core.backends.mysql',
         'NAME': secrets['database']['name'],
         'USER': secrets['database']['user'],
         'PASSWORD': secrets['database']['password'],
         'HOST': secrets['database']['host'],
         'PORT': secrets['database']['port'],
         'sql_mode': 'STRICT_TRANS_TABLES',
+        'CONN_MAX_AGE': 0 if OPP_DB_POOL_SIZE else OPP_DB_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'pool': {
+                'max_size': OPP_DB_POOL_SIZE,
+                'timeout': OPP_DB_POOL_TIMEOUT,
+                'max_age': OPP_DB_POOL_MAX_AGE,
+                'check_idle': OPP_DB_POOL_CHECK_IDLE,
+            },
+        } if OPP_DB_POOL_SIZE else {},
     }
 }
 
+# Read replica for the dashboard and site status reads, see core.routers. Its
+# host and port (or any other connection setting) come from [database_replica]
+# in secrets.toml or DB_REPLICA_HOST/DB_REPLICA_PORT, the rest from default.
+# Without one everything uses the default database. A session that wrote
+# something reads from the primary for OPP_DB_REPLICA_STICKY seconds after.
+OPP_DB_REPLICA = 'replica'
+OPP_DB_REPLICA_STICKY = 10
+DB_REPLICA = secrets.get('database_replica') or {
+    key: value for key, value in (
+        ('host', os.environ.get('DB_REPLICA_HOST')),
+        ('port', os.environ.get('DB_REPLICA_PORT')),
+    ) if value
+}
+if DB_REPLICA:
+    DATABASES[OPP_DB_REPLICA] = {
+        **DATABASES['default'],
+        **{key.upper(): value for key, value in DB_REPLICA.items()},
+        'TEST': {'MIRROR': 'default'},
+    }
+DATABASE_ROUTERS = ['core.routers.ReadReplicaRouter']
+
 # Channels settings
 ASGI_APPLICATION = 'opp_cloud.asgi.application'
-CHANNEL_LAYERS = {
-    # 'default': {
-    #     'BACKEND': 'channels_redis.core.RedisChannelLayer',
-    #     'CONFIG': {
-    #         "hosts": [('127.0.0.1', 6379)],
-    #     },
-    # },
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer"
+
+# Redis hosts for the sharded channel layer, e.g. "redis://10.0.0.1:6379,redis://10.0.0.2:6379".
+# Groups are spread over the hosts by consistent hashing. Without any hosts we
+# fall back to the in-process layer, which only supports a single worker.
+CHANNEL_REDIS_HOSTS = secrets.get('redis', {}).get('hosts') or [
+    host.strip() for host in os.environ.get('CHANNEL_REDIS_HOSTS', '').split(',') if host.strip()
+]
+if CHANNEL_REDIS_HOSTS:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'core.layers.ShardedChannelLayer',
+            'CONFIG': {
+                'hosts': CHANNEL_REDIS_HOSTS,
+            },
+        },
     }
-}
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "core.layers.LocalChannelLayer"
+        }
+    }
+
+# Site presence: a site is offline after OPP_PRESENCE_TTL seconds without traffic.
+# Presence changes are written to the Site table in bulk every flush interval.
+OPP_PRESENCE_TTL = 120
+OPP_PRESENCE_FLUSH_INTERVAL = 5
+
+# Seconds between price_update broadcasts to subscribe_prices clients
+OPP_PRICE_UPDATE_INTERVAL = 30
+# Maximum number of upcoming EnergyPrice rows sent in a price_schedule message
+OPP_PRICE_SCHEDULE_LIMIT = 288
+# Upper bound in seconds on caching the resolved current price
+OPP_PRICE_CACHE_MAX_AGE = 60
+# Rows per bulk_create when ingesting uploads on api/update_prices/bulk/
+OPP_PRICE_INGEST_BATCH_SIZE = 1000
+# Raw EnergyPrice rows older than this many days are rolled up into hourly and
+# daily tables by "manage.py rollup_prices", deleting this many rows per statement
+OPP_PRICE_RETENTION_DAYS = 90
+OPP_PRICE_RETENTION_BATCH_SIZE = 1000
+
+# Relayed Home Assistant commands: seconds to wait for a response and the
+# number of unanswered commands allowed per connection
+OPP_RELAY_TIMEOUT = 30
+OPP_RELAY_MAX_PENDING = 100
+# Seconds an HA connection found through the channel layer is reused for routing
+OPP_UPSTREAM_CACHE_TTL = 5
+# Relay frontend commands and HA responses as the original frame instead of
+# decoding and re-encoding them
+OPP_RELAY_RAW_FRAMES = True
+# JSON implementation used by the websocket consumers and views: 'auto' picks
+# orjson or ujson when installed, else 'orjson', 'ujson' or 'json' (stdlib)
+OPP_JSON_BACKEND = 'auto'
+# Websocket frames of at least this many bytes are zlib compressed for clients
+# that negotiate a +deflate sub-protocol, at this level (1-6)
+OPP_WS_COMPRESSION_THRESHOLD = 16 * 1024
+OPP_WS_COMPRESSION_LEVEL = 3
+# Largest decompressed frame accepted from a client
+OPP_WS_MAX_INFLATED_SIZE = 16 * 1024 * 1024
+# Milliseconds state updates are coalesced for before going to a frontend,
+# unless the site sets its own window; 0 sends every update at once
+OPP_STATE_COALESCE_WINDOW = 100
+# Longest window a slowly draining frontend is backed off to, in milliseconds
+OPP_STATE_COALESCE_MAX_WINDOW = 2000
+# Outbound websocket queue limits per connection; a client with more queued,
+# or a frame waiting longer (seconds), is disconnected as too slow
+OPP_WS_MAX_QUEUE_BYTES = 4 * 1024 * 1024
+OPP_WS_MAX_QUEUE_FRAMES = 1000
+OPP_WS_MAX_QUEUE_DELAY = 30
+# Seconds without a frame after which a websocket is closed: HA site
+# connections and browser connections (0, the default, keeps them open).
+# Silent connections are pinged half way there and kept by any answer; only
+# enable a timeout once those clients answer pings
+OPP_WS_IDLE_TIMEOUT = 0
+OPP_WS_FRONTEND_IDLE_TIMEOUT = 0
+# Admission control of HA connections: connections per second and burst per
+# source address, authentications per second and burst per site (0 disables
+# a limit), and authentications in flight, each waiting up to
+# OPP_AUTH_QUEUE_TIMEOUT seconds for a slot
+OPP_ADMISSION_SOURCE_RATE = 2
+OPP_ADMISSION_SOURCE_BURST = 20
+OPP_ADMISSION_SITE_RATE = 0.1
+OPP_ADMISSION_SITE_BURST = 3
+OPP_AUTH_CONCURRENCY = 4
+OPP_AUTH_QUEUE_TIMEOUT = 2
+# Processes hashing passwords off the database thread (0 hashes on it), and
+# hashes allowed to wait before registrations are turned away
+OPP_HASHING_WORKERS = 2
+OPP_HASHING_MAX_QUEUE = 32
+# Threads for sync database work of the consumers that has no async ORM
+# method; each may hold its own database connection
+OPP_DB_THREADS = 4
 
 # JWT Settings
 REST_FRAMEWORK = {
@@ -10,3 +10,9 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'opp_cloud.settings')
 # Load Django WSGI application (for HTTP requests)
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
+
+# Passenger's smart spawning forks workers from this process. Don't let them
+# inherit a connection opened while loading; each worker fills its own pool
+# (see core.backends.pool).
+from django.db import connections
+connections.close_all()